@@ -9,6 +9,7 @@ import datetime
 # --- CORRECTION DU CHEMIN POUR IMPORTS ---
 sys.path.append(os.path.dirname(__file__))
 from database import get_form_config, get_options_for_table, save_entretien_complet
+from file_attente import SAISIE_ASYNC, mettre_en_file, demarrer_ecrivain, etat_dossiers, nb_en_attente
 
 def build_home():
     st.set_page_config(
@@ -75,6 +76,11 @@ def build_home():
     st.header("📝 Nouvel Entretien")
     st.info("Remplissez ce formulaire pour enregistrer un nouveau passage usager.")
 
+    if SAISIE_ASYNC:
+        # Reprend aussi les dossiers restés dans la file lors d'un redémarrage
+        demarrer_ecrivain()
+        render_file_attente()
+
     # 1. Chargement de la configuration dynamique depuis la BDD
     form_config = get_form_config()
     if not form_config:
@@ -177,7 +183,20 @@ def build_home():
             st.warning("⚠️ Veuillez qualifier au moins une 'Nature de la demande'.")
             is_valid = False
 
-        if is_valid:
+        if is_valid and SAISIE_ASYNC:
+            try:
+                reference = mettre_en_file(user_inputs, selected_demandes_codes, selected_solutions_codes)
+                st.session_state.setdefault("references_provisoires", []).append(reference)
+                st.success(
+                    f"✅ Dossier **{reference}** enregistré avec succès "
+                    "(référence provisoire, le n° définitif est attribué à l'écriture en base)."
+                )
+                if st.button("Saisir un nouveau dossier"):
+                    st.rerun()
+            except Exception as e:
+                st.error(f"❌ Erreur lors de l'enregistrement local : {e}")
+
+        elif is_valid:
             try:
                 new_num = save_entretien_complet(
                     user_inputs, 
@@ -194,5 +213,22 @@ def build_home():
             except Exception as e:
                 st.error(f"❌ Erreur lors de l'enregistrement en base : {e}")
 
+def render_file_attente():
+    """Dossiers de la session encore en file, et n° définitifs de ceux déjà écrits en base"""
+    references = st.session_state.get("references_provisoires", [])
+    attente = nb_en_attente()
+    if not references and not attente:
+        return
+    with st.expander(f"📮 File d'enregistrement ({attente} dossier(s) en attente d'écriture en base)"):
+        etats = etat_dossiers(references)
+        for reference in reversed(references):
+            statut, num, erreur = etats.get(reference, ("inconnu", None, None))
+            if statut == "enregistre":
+                st.write(f"✅ {reference} → dossier n° **{num}**")
+            elif statut == "rejete":
+                st.write(f"❌ {reference} refusé par la base : {erreur}")
+            else:
+                st.write(f"⏳ {reference} en attente" + (f" ({erreur})" if erreur else ""))
+
 if __name__ == "__main__":
     build_home()
\ No newline at end of file
@@ -0,0 +1,172 @@
+# agregats.py
+# -*- coding: utf-8 -*-
+"""
+Agrégats mensuels STAT_MENSUELLE : nombre de lignes par mois x table x variable x modalité,
+tenus à jour par des triggers (une exécution par ordre SQL, pas par ligne) sur ENTRETIEN,
+DEMANDE et SOLUTION. Les listes de mois et les répartitions standard se lisent ici
+sans parcourir les données brutes. STAT_MODIFICATIONS compte les mises à jour et
+suppressions : les caches de données s'en servent pour savoir s'ils sont périmés.
+"""
+from contextlib import contextmanager
+
+from psycopg2 import extensions
+
+TABLES_AGREGEES = ("ENTRETIEN", "DEMANDE", "SOLUTION")
+
+SQL_STAT_MENSUELLE = """
+CREATE TABLE IF NOT EXISTS STAT_MENSUELLE(
+   MOIS VARCHAR(7) NOT NULL,
+   TAB VARCHAR(50) NOT NULL,
+   VARIABLE VARCHAR(63) NOT NULL,
+   CODE VARCHAR(255) NOT NULL,
+   NB INTEGER NOT NULL,
+   PRIMARY KEY(MOIS, TAB, VARIABLE, CODE)
+);
+COMMENT ON TABLE STAT_MENSUELLE IS 'Nombre de lignes par mois (YYYY-MM, vide si sans date), table, variable et code (vide si non renseigné) ; variable * = total de la table';
+
+CREATE TABLE IF NOT EXISTS STAT_MODIFICATIONS(
+   TAB VARCHAR(50) PRIMARY KEY,
+   NB BIGINT NOT NULL
+);
+COMMENT ON TABLE STAT_MODIFICATIONS IS 'Mises à jour, suppressions et vidages cumulés par table : marqueur de changement des caches, visible au commit des données';
+
+-- Compté en premier dans la transaction : deux modifications concurrentes de la même table
+-- se suivent au lieu de se disputer les lignes de STAT_MENSUELLE
+CREATE OR REPLACE FUNCTION stat_compter_modification(p_tab TEXT)
+RETURNS VOID LANGUAGE plpgsql AS $$
+BEGIN
+    INSERT INTO STAT_MODIFICATIONS (TAB, NB) VALUES (p_tab, 1)
+    ON CONFLICT (TAB) DO UPDATE SET NB = STAT_MODIFICATIONS.NB + 1;
+END $$;
+
+-- Applique les lignes (en jsonb) au cumul, avec le signe +1 (ajout) ou -1 (retrait).
+-- Les lignes de STAT_MENSUELLE sont verrouillées dans l'ordre (tab, variable, code, mois) :
+-- deux enregistrements simultanés ne peuvent pas s'interbloquer.
+CREATE OR REPLACE FUNCTION stat_appliquer(p_tab TEXT, p_lignes JSONB[], p_signe INTEGER)
+RETURNS VOID LANGUAGE plpgsql AS $$
+BEGIN
+    IF p_tab = 'ENTRETIEN' THEN
+        -- Toutes les colonnes, y compris celles ajoutées depuis l'administration
+        INSERT INTO STAT_MENSUELLE (MOIS, TAB, VARIABLE, CODE, NB)
+        SELECT COALESCE(LEFT(l->>'date_ent', 7), ''), p_tab, c.key, COALESCE(c.value, ''), p_signe * COUNT(*)
+        FROM unnest(p_lignes) AS l
+        CROSS JOIN LATERAL jsonb_each_text((l - 'num' - 'date_ent') || '{"*": ""}'::jsonb) AS c
+        GROUP BY 1, 3, 4
+        ORDER BY 2, 3, 4, 1
+        ON CONFLICT (MOIS, TAB, VARIABLE, CODE) DO UPDATE SET NB = STAT_MENSUELLE.NB + EXCLUDED.NB;
+    ELSE
+        -- Le mois d'une demande / solution est celui de son entretien
+        INSERT INTO STAT_MENSUELLE (MOIS, TAB, VARIABLE, CODE, NB)
+        SELECT COALESCE(TO_CHAR(e.date_ent, 'YYYY-MM'), ''), p_tab, c.key, COALESCE(c.value, ''), p_signe * COUNT(*)
+        FROM unnest(p_lignes) AS l
+        LEFT JOIN ENTRETIEN e ON e.num = (l->>'num')::INTEGER
+        CROSS JOIN LATERAL jsonb_each_text(jsonb_build_object('nature', l->>'nature', '*', '')) AS c
+        GROUP BY 1, 3, 4
+        ORDER BY 2, 3, 4, 1
+        ON CONFLICT (MOIS, TAB, VARIABLE, CODE) DO UPDATE SET NB = STAT_MENSUELLE.NB + EXCLUDED.NB;
+    END IF;
+END $$;
+
+CREATE OR REPLACE FUNCTION stat_trigger() RETURNS TRIGGER LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM stat_compter_modification(UPPER(TG_TABLE_NAME));
+        PERFORM stat_appliquer(UPPER(TG_TABLE_NAME), ARRAY(SELECT to_jsonb(o) FROM anciennes o), -1);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM stat_appliquer(UPPER(TG_TABLE_NAME), ARRAY(SELECT to_jsonb(n) FROM nouvelles n), 1);
+    END IF;
+    -- Entretien changé de mois : ses demandes et solutions le suivent
+    IF TG_OP = 'UPDATE' AND TG_TABLE_NAME = 'entretien' THEN
+        INSERT INTO STAT_MENSUELLE (MOIS, TAB, VARIABLE, CODE, NB)
+        SELECT d.mois, f.tab, c.key, COALESCE(c.value, ''), SUM(d.signe)
+        FROM (
+            SELECT n.num, COALESCE(TO_CHAR(o.date_ent, 'YYYY-MM'), '') AS ancien,
+                   COALESCE(TO_CHAR(n.date_ent, 'YYYY-MM'), '') AS nouveau
+            FROM anciennes o JOIN nouvelles n ON n.num = o.num
+            WHERE o.date_ent IS DISTINCT FROM n.date_ent
+        ) m
+        JOIN (
+            SELECT 'DEMANDE' AS tab, num, nature::text AS nature FROM DEMANDE
+            UNION ALL
+            SELECT 'SOLUTION', num, nature::text FROM SOLUTION
+        ) f ON f.num = m.num
+        CROSS JOIN LATERAL (VALUES (m.ancien, -1), (m.nouveau, 1)) AS d(mois, signe)
+        CROSS JOIN LATERAL jsonb_each_text(jsonb_build_object('nature', f.nature, '*', '')) AS c
+        WHERE m.ancien <> m.nouveau
+        GROUP BY 1, 2, 3, 4
+        ORDER BY 2, 3, 4, 1
+        ON CONFLICT (MOIS, TAB, VARIABLE, CODE) DO UPDATE SET NB = STAT_MENSUELLE.NB + EXCLUDED.NB;
+    END IF;
+    RETURN NULL;
+END $$;
+
+CREATE OR REPLACE FUNCTION stat_vider() RETURNS TRIGGER LANGUAGE plpgsql AS $$
+BEGIN
+    PERFORM stat_compter_modification(UPPER(TG_TABLE_NAME));
+    DELETE FROM STAT_MENSUELLE WHERE TAB = UPPER(TG_TABLE_NAME);
+    RETURN NULL;
+END $$;
+"""
+
+# Une table de transition n'est permise que pour un seul événement : trois triggers par table
+SQL_TRIGGERS = """
+DROP TRIGGER IF EXISTS stat_{t}_ins ON {T};
+DROP TRIGGER IF EXISTS stat_{t}_upd ON {T};
+DROP TRIGGER IF EXISTS stat_{t}_del ON {T};
+DROP TRIGGER IF EXISTS stat_{t}_tru ON {T};
+CREATE TRIGGER stat_{t}_ins AFTER INSERT ON {T}
+    REFERENCING NEW TABLE AS nouvelles FOR EACH STATEMENT EXECUTE FUNCTION stat_trigger();
+CREATE TRIGGER stat_{t}_upd AFTER UPDATE ON {T}
+    REFERENCING OLD TABLE AS anciennes NEW TABLE AS nouvelles FOR EACH STATEMENT EXECUTE FUNCTION stat_trigger();
+CREATE TRIGGER stat_{t}_del AFTER DELETE ON {T}
+    REFERENCING OLD TABLE AS anciennes FOR EACH STATEMENT EXECUTE FUNCTION stat_trigger();
+CREATE TRIGGER stat_{t}_tru AFTER TRUNCATE ON {T}
+    FOR EACH STATEMENT EXECUTE FUNCTION stat_vider();
+"""
+
+
+@contextmanager
+def _transaction(cur):
+    """
+    Tout ou rien : sur une connexion en autocommit (hors transaction), ouvre sa propre
+    transaction ; sinon les ordres font partie de celle de l'appelant, qui valide.
+    """
+    conn = cur.connection
+    autonome = conn.autocommit and conn.info.transaction_status == extensions.TRANSACTION_STATUS_IDLE
+    if autonome:
+        cur.execute("BEGIN")
+    try:
+        yield
+    except Exception:
+        if autonome:
+            cur.execute("ROLLBACK")
+        raise
+    if autonome:
+        cur.execute("COMMIT")
+
+
+def reconstruire_agregats(cur):
+    """Recalcule entièrement STAT_MENSUELLE à partir des données (après un incident ou une reprise)"""
+    with _transaction(cur):
+        cur.execute("LOCK TABLE STAT_MENSUELLE IN EXCLUSIVE MODE")
+        cur.execute("DELETE FROM STAT_MENSUELLE")
+        for table in TABLES_AGREGEES:
+            cur.execute(f"SELECT stat_appliquer(%s, ARRAY(SELECT to_jsonb(t) FROM {table} t), 1)", (table,))
+
+
+def installer_agregats(cur):
+    """
+    Crée (ou met à jour) la table, les fonctions et les triggers ; calcule les agrégats existants.
+    L'installation est atomique : un échec ne laisse pas de table vide que la suivante croirait calculée.
+    Renvoie True si la table vient d'être créée (et donc déjà calculée).
+    """
+    with _transaction(cur):
+        cur.execute("SELECT to_regclass('stat_mensuelle') IS NOT NULL")
+        deja_installe = cur.fetchone()[0]
+        cur.execute(SQL_STAT_MENSUELLE)
+        for table in TABLES_AGREGEES:
+            cur.execute(SQL_TRIGGERS.format(t=table.lower(), T=table))
+        if not deja_installe:
+            reconstruire_agregats(cur)
+    return not deja_installe
@@ -1,9 +1,19 @@
 import os
+import io
 import glob
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
 import pandas as pd
+import openpyxl
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
 import psycopg2
-from datetime import date
+from datetime import date, datetime
 from dotenv import load_dotenv
+from transcodage import normaliser_code
 
 # =========================
 # 0. SÉCURITÉ & CONFIG
@@ -20,7 +30,15 @@ DB_NAME = os.getenv("DB_NAME")
 # Chemins (Relatifs pour la portabilité)
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DOSSIER_EXCEL = os.path.join(BASE_DIR, "data_entretien")
+# Lignes rejetées, un sous-dossier horodaté par exécution et une feuille par fichier source
+# (corrigeables puis réimportables avec --dossier). Hors de data_entretien : un import ne
+# réécrit ni ne supprime jamais un fichier qu'on est en train de réimporter.
+DOSSIER_QUARANTAINE = os.path.join(BASE_DIR, "quarantaine")
 ANNEE_FICHIERS = 2024
+# Formats acceptés (même mapping de colonnes pour tous)
+EXTENSIONS_SOURCES = (".xlsx", ".csv", ".parquet")
+# Encodage des exports CSV des partenaires (ex : "cp1252" pour un export Excel Windows)
+ENCODAGE_CSV = os.getenv("CSV_ENCODING", "utf-8")
 
 # =========================
 # 1. CONFIGURATION DU MAPPING
@@ -68,14 +86,682 @@ def clean_value(val):
 
 def clean_varchar_limit(val, limit=2):
     """Coupe les chaînes trop longues (ex: sit_fam)"""
-    if val is None: return None
+    if clean_value(val) is None: return None
     s = str(val).strip()
     return s[:limit] if s else None
 
 # =========================
-# 3. MOTEUR D'IMPORTATION
+# 3. NETTOYAGE VECTORISÉ (MODE BULK)
 # =========================
-def importer_dossier_excel():
+# Règle par colonne ENTRETIEN : ("entier", dtype nullable) ou ("texte", longueur max ou None).
+# Valeurs par défaut = schéma de creation_base.py ; charger_regles_nettoyage() les relit en base.
+REGLES_NETTOYAGE = {
+    "mode": ("entier", "Int16"),
+    "duree": ("entier", "Int16"),
+    "sexe": ("entier", "Int16"),
+    "age": ("entier", "Int16"),
+    "vient_pr": ("entier", "Int16"),
+    "sit_fam": ("texte", 2),
+    "enfant": ("entier", "Int16"),
+    "modele_fam": ("entier", "Int16"),
+    "profession": ("entier", "Int16"),
+    "ress": ("entier", "Int16"),
+    "origine": ("texte", 2),
+    "commune": ("texte", 50),
+    "partenaire": ("texte", 50)
+}
+
+TYPES_ENTIERS = {"smallint": "Int16", "integer": "Int32", "bigint": "Int64"}
+BORNES_ENTIERS = {
+    "Int16": (-2**15, 2**15 - 1),
+    "Int32": (-2**31, 2**31 - 1),
+    "Int64": (-2**63, 2**63 - 1)
+}
+LONGUEUR_NATURE = 50
+
+def charger_regles_nettoyage(cur):
+    """Règles déduites du schéma réel de ENTRETIEN (types et longueurs VARCHAR)"""
+    regles = dict(REGLES_NETTOYAGE)
+    cur.execute("""
+        SELECT column_name, data_type, character_maximum_length
+        FROM information_schema.columns WHERE table_name = 'entretien'
+    """)
+    for col, data_type, longueur in cur.fetchall():
+        if col not in regles:
+            continue
+        if data_type in TYPES_ENTIERS:
+            regles[col] = ("entier", TYPES_ENTIERS[data_type])
+        elif data_type in ("character varying", "character", "text"):
+            regles[col] = ("texte", longueur)
+    return regles
+
+def colonne_vide(df):
+    """Série de None alignée sur le DataFrame (colonne absente du fichier)"""
+    return pd.Series([None] * len(df), index=df.index, dtype=object)
+
+def texte_nettoye(serie):
+    """Équivalent colonne de clean_value : strip, et vides/blancs -> NaN"""
+    texte = serie.astype(str).str.strip().where(serie.notna())
+    return texte.where(texte != "")
+
+def nettoyer_entier(texte, dtype):
+    """Conversion numérique tronquée comme int(float(v)), hors bornes -> NULL"""
+    nombres = pd.to_numeric(texte, errors='coerce')
+    entiers = np.trunc(nombres)
+    mini, maxi = BORNES_ENTIERS[dtype]
+    hors_plage = entiers.notna() & ((entiers < mini) | (entiers > maxi))
+    rapport = {
+        "non_numeriques": int((texte.notna() & nombres.isna()).sum()),
+        "decimaux_tronques": int((nombres.notna() & (nombres != entiers)).sum()),
+        "hors_plage": int(hors_plage.sum())
+    }
+    return entiers.mask(hors_plage).astype(dtype), rapport
+
+def nettoyer_texte(texte, longueur):
+    """Coupe à la longueur du VARCHAR"""
+    if not longueur:
+        return texte, {}
+    return texte.str[:longueur], {"tronques": int((texte.str.len() > longueur).sum())}
+
+def nettoyer_colonnes(df, regles=None):
+    """
+    Applique les règles colonne par colonne sur les colonnes de MAPPING_ENTRETIEN.
+    Renvoie (DataFrame nettoyé, rapport {colonne: {motif: nombre de valeurs modifiées}}).
+    """
+    regles = regles or REGLES_NETTOYAGE
+    out = pd.DataFrame(index=df.index)
+    rapport = {}
+
+    for col_excel, col_sql in MAPPING_ENTRETIEN.items():
+        serie = df[col_excel] if col_excel in df.columns else colonne_vide(df)
+        texte = texte_nettoye(serie)
+        type_col, parametre = regles.get(col_sql, ("texte", None))
+
+        if type_col == "entier":
+            out[col_sql], compte = nettoyer_entier(texte, parametre)
+        else:
+            out[col_sql], compte = nettoyer_texte(texte, parametre)
+
+        compte = {motif: nb for motif, nb in compte.items() if nb}
+        if compte:
+            rapport[col_sql] = compte
+
+    return out, rapport
+
+def fusionner_rapports(total, rapport):
+    """Cumule un rapport de nettoyage dans `total`"""
+    for col, compte in rapport.items():
+        for motif, nb in compte.items():
+            total.setdefault(col, {}).setdefault(motif, 0)
+            total[col][motif] += nb
+    return total
+
+def afficher_rapport(rapport, nom_fichier):
+    for col, compte in rapport.items():
+        details = ", ".join(f"{nb} {motif.replace('_', ' ')}" for motif, nb in compte.items())
+        print(f"   ⚠️ {nom_fichier} / {col} : {details}")
+
+def preparer_entretien(df, date_default, regles=None):
+    """Transforme la feuille Excel en colonnes ENTRETIEN ; renvoie aussi le rapport de nettoyage"""
+    colonnes, rapport = nettoyer_colonnes(df, regles)
+    colonnes.insert(0, 'date_ent', date_default)
+    return colonnes, rapport
+
+def preparer_liens(df, colonnes, nums):
+    """Passe les colonnes Dem.x / Sol.x au format long (num, pos, nature)"""
+    presentes = [col for col in colonnes if col in df.columns]
+    if not presentes:
+        return pd.DataFrame(columns=["num", "pos", "nature"])
+
+    liens = pd.DataFrame({
+        "num": np.tile(np.asarray(nums), len(presentes)),
+        "ordre": np.repeat(np.arange(len(presentes)), len(df)),
+        "valeur": np.concatenate([df[col].to_numpy(dtype=object) for col in presentes])
+    })
+    texte = texte_nettoye(liens["valeur"])
+    nombres = pd.to_numeric(texte, errors='coerce')
+    # Codes numériques saisis en nombre dans Excel (100.0) -> "100", comme dans MODALITE
+    entiers = nombres.notna() & (nombres == np.trunc(nombres))
+    liens["nature"] = texte.mask(entiers, nombres[entiers].astype('Int64').astype(str)).str[:LONGUEUR_NATURE]
+    # Mêmes valeurs ignorées que clean_value + "if val" : vides, blancs et zéros
+    garder = liens["nature"].notna() & (nombres != 0)
+    liens = liens[garder].sort_values(["num", "ordre"], kind="stable")
+
+    return pd.DataFrame({
+        "num": liens["num"].to_numpy(),
+        "pos": liens.groupby("num").cumcount().to_numpy() + 1,
+        "nature": liens["nature"].to_numpy()
+    })
+
+def allouer_nums(cur, nb):
+    """Réserve `nb` identifiants dans la séquence de ENTRETIEN.NUM en un seul appel"""
+    if nb == 0:
+        return []
+    cur.execute(
+        "SELECT nextval(pg_get_serial_sequence('entretien', 'num')) FROM generate_series(1, %s)",
+        (nb,)
+    )
+    return [row[0] for row in cur.fetchall()]
+
+def copier_table(cur, table, df):
+    """Charge un DataFrame dans une table via COPY FROM STDIN (format CSV)"""
+    if df.empty:
+        return
+    buffer = io.StringIO()
+    df.to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+    cur.copy_expert(f"COPY {table} ({', '.join(df.columns)}) FROM STDIN WITH (FORMAT CSV)", buffer)
+
+# =========================
+# 4. CONTRÔLES ET QUARANTAINE
+# =========================
+def charger_controles(cur):
+    """
+    Référentiel de validation lu dans les métadonnées :
+    codes autorisés (MODALITE) et bornes (PLAGE) par colonne ENTRETIEN,
+    natures autorisées pour DEMANDE / SOLUTION.
+    """
+    controles = {"modalites": {}, "plages": {}, "natures": {}}
+    cur.execute("""
+        SELECT LOWER(v.lib), v.type_v, m.code, p.val_min, p.val_max
+        FROM VARIABLE v
+        LEFT JOIN MODALITE m ON m.tab = v.tab AND m.pos = v.pos
+        LEFT JOIN PLAGE p ON p.tab = v.tab AND p.pos = v.pos
+        WHERE v.tab = 'ENTRETIEN'
+    """)
+    for col, type_v, code, val_min, val_max in cur.fetchall():
+        if type_v == 'MOD' and code is not None:
+            controles["modalites"].setdefault(col, set()).add(normaliser_code(code))
+        if val_min is not None or val_max is not None:
+            controles["plages"][col] = (val_min, val_max)
+
+    cur.execute("SELECT tab, code FROM MODALITE WHERE tab IN ('DEMANDE', 'SOLUTION') AND pos = 3")
+    for tab, code in cur.fetchall():
+        controles["natures"].setdefault(tab.lower(), set()).add(normaliser_code(code))
+    return controles
+
+def codes_normalises(serie):
+    """normaliser_code appliqué une fois par valeur distincte"""
+    table = {v: normaliser_code(v) for v in serie.dropna().unique()}
+    return serie.map(table)
+
+def motifs_rejet(lot, controles):
+    """Série (index = position de ligne) des motifs de rejet ; vide si tout est valide"""
+    motifs = []
+    entretiens = lot["entretien"]
+
+    for col, codes in controles["modalites"].items():
+        if col not in entretiens.columns:
+            continue
+        valeurs = codes_normalises(entretiens[col])
+        invalides = valeurs.notna() & ~valeurs.isin(codes)
+        motifs.append(pd.Series(col + "=" + valeurs[invalides] + " hors modalités", dtype=object))
+
+    for col, (val_min, val_max) in controles["plages"].items():
+        if col not in entretiens.columns:
+            continue
+        nombres = pd.to_numeric(entretiens[col], errors='coerce')
+        invalides = nombres.notna() & (
+            (nombres < val_min if val_min is not None else False) |
+            (nombres > val_max if val_max is not None else False)
+        )
+        motifs.append(pd.Series(
+            f"{col}=" + nombres[invalides].astype('Int64').astype(str) + f" hors plage [{val_min};{val_max}]",
+            dtype=object
+        ))
+
+    for table in ("demande", "solution"):
+        codes = controles["natures"].get(table)
+        liens = lot[table]
+        if not codes or liens.empty:
+            continue
+        invalides = ~codes_normalises(liens["nature"]).isin(codes)
+        motifs.append(pd.Series(
+            (f"{table}=" + liens.loc[invalides, "nature"] + " inconnue").to_numpy(),
+            index=liens.loc[invalides, "num"].to_numpy(), dtype=object
+        ))
+
+    motifs = [m for m in motifs if not m.empty]
+    if not motifs:
+        return pd.Series(dtype=object)
+    return pd.concat(motifs).groupby(level=0).agg("; ".join)
+
+def dossier_quarantaine_execution(dossier_source):
+    """Nouveau sous-dossier de quarantaine pour cette exécution, jamais égal au dossier importé"""
+    base = os.path.join(DOSSIER_QUARANTAINE, datetime.now().strftime("%Y%m%d-%H%M%S"))
+    dossier, i = base, 1
+    while os.path.exists(dossier) or os.path.abspath(dossier) == os.path.abspath(dossier_source):
+        dossier, i = f"{base}-{i}", i + 1
+    return dossier
+
+def ecrire_quarantaine(rejets, nom_fichier, dossier=None):
+    """Écrit la feuille de quarantaine du fichier source dans le dossier de l'exécution"""
+    if rejets is None or rejets.empty:
+        return None
+    dossier = dossier or dossier_quarantaine_execution(DOSSIER_EXCEL)
+    chemin = os.path.join(dossier, os.path.splitext(nom_fichier)[0] + ".xlsx")
+    os.makedirs(dossier, exist_ok=True)
+    rejets.to_excel(chemin, index=False)
+    return chemin
+
+# =========================
+# 5. CHARGEMENT EN MASSE
+# =========================
+def preparer_lot(df, date_default, regles=None, controles=None):
+    """
+    Prépare tout ce qui ne dépend pas de la base. Les lignes sont repérées
+    par leur position dans la feuille ; les vrais NUM sont attribués au chargement.
+    Les lignes qui ne passent pas les contrôles partent dans lot["rejets"].
+    """
+    positions = np.arange(len(df))
+    entretiens, rapport = preparer_entretien(df, date_default, regles)
+    entretiens.index = positions
+    lot = {
+        "entretien": entretiens,
+        "rapport": rapport,
+        "demande": preparer_liens(df, COLS_DEMANDES, positions),
+        "solution": preparer_liens(df, COLS_SOLUTIONS, positions),
+        "rejets": None
+    }
+
+    if controles:
+        motifs = motifs_rejet(lot, controles)
+        if not motifs.empty:
+            rejetees = motifs.index.to_numpy()
+            lot["rejets"] = df.iloc[rejetees].assign(motif_rejet=motifs.to_numpy())
+            lot["entretien"] = entretiens.drop(index=rejetees)
+            for table in ("demande", "solution"):
+                liens = lot[table]
+                lot[table] = liens[~liens["num"].isin(rejetees)]
+    return lot
+
+def charger_lot(cur, lot, source=None):
+    """Charge un lot préparé : 1 appel de séquence + 3 COPY (+ 1 pour le fichier source)"""
+    entretiens = lot["entretien"]
+    nums = pd.Series(allouer_nums(cur, len(entretiens)), index=entretiens.index, dtype=np.int64)
+    copier_table(cur, "ENTRETIEN", entretiens.assign(num=nums)[['num'] + list(entretiens.columns)])
+
+    for table, liens in (("DEMANDE", lot["demande"]), ("SOLUTION", lot["solution"])):
+        if liens.empty:
+            continue
+        liens = liens.assign(num=nums.loc[liens["num"].to_numpy()].to_numpy())
+        copier_table(cur, table, liens)
+
+    if source is not None:
+        copier_table(cur, "ENTRETIEN_SOURCE", pd.DataFrame({"num": nums.to_numpy(), "fichier": source}))
+    return len(entretiens)
+
+def importer_fichier_bulk(cur, df, date_default, regles=None, controles=None):
+    """Charge toute la feuille en une fois"""
+    return charger_lot(cur, preparer_lot(df, date_default, regles, controles))
+
+def noms_colonnes(entete):
+    """Noms de colonnes comme pd.read_excel : 'Unnamed: i' si vide, suffixe .1, .2 si doublon"""
+    noms, vus = [], {}
+    for i, nom in enumerate(entete):
+        nom = f"Unnamed: {i}" if nom is None else nom
+        if nom in vus:
+            vus[nom] += 1
+            nom = f"{nom}.{vus[nom]}"
+        else:
+            vus[nom] = 0
+        noms.append(nom)
+    return noms
+
+def lire_blocs_excel(fichier, taille_bloc):
+    """
+    Lit la première feuille par blocs de `taille_bloc` lignes (openpyxl en lecture seule),
+    sans jamais charger tout le classeur. L'index de chaque bloc est la position de la ligne
+    dans la feuille, comme avec pd.read_excel. Les lignes entièrement vides sont ignorées.
+    """
+    classeur = openpyxl.load_workbook(fichier, read_only=True, data_only=True)
+    try:
+        lignes = classeur.worksheets[0].iter_rows(values_only=True)
+        entete = next(lignes, None)
+        if entete is None:
+            return
+        colonnes = noms_colonnes(entete)
+        nb_col = len(colonnes)
+
+        bloc, index = [], []
+        for position, ligne in enumerate(lignes):
+            if all(v is None for v in ligne):
+                continue
+            # En lecture seule une ligne peut être plus courte ou plus longue que l'en-tête
+            bloc.append(tuple(ligne[:nb_col]) + (None,) * (nb_col - len(ligne)))
+            index.append(position)
+            if len(bloc) == taille_bloc:
+                yield pd.DataFrame(bloc, columns=colonnes, index=index)
+                bloc, index = [], []
+        if bloc:
+            yield pd.DataFrame(bloc, columns=colonnes, index=index)
+    finally:
+        classeur.close()
+
+def options_csv(fichier):
+    """Options pyarrow d'un CSV : séparateur deviné sur l'en-tête, toutes les colonnes en texte"""
+    with open(fichier, encoding=ENCODAGE_CSV, errors="replace") as f:
+        entete = f.readline()
+    separateur = ";" if entete.count(";") > entete.count(",") else ","
+    lecture = pacsv.ReadOptions(encoding=ENCODAGE_CSV)
+    analyse = pacsv.ParseOptions(delimiter=separateur)
+    # Lues en texte : le nettoyage convertit ensuite colonne par colonne,
+    # et l'inférence de type ne peut pas échouer sur un bloc ultérieur ("5a" après des "5")
+    noms = pacsv.open_csv(fichier, read_options=lecture, parse_options=analyse).schema.names
+    conversion = pacsv.ConvertOptions(column_types={nom: pa.string() for nom in noms}, strings_can_be_null=True)
+    return {"read_options": lecture, "parse_options": analyse, "convert_options": conversion}
+
+def regrouper_batches(batches, taille_bloc):
+    """Regroupe des RecordBatch Arrow en DataFrames de `taille_bloc` lignes (index = position)"""
+    tampon, nb, debut = [], 0, 0
+    for batch in batches:
+        tampon.append(batch)
+        nb += batch.num_rows
+        while nb >= taille_bloc:
+            table = pa.Table.from_batches(tampon)
+            bloc = table.slice(0, taille_bloc).to_pandas()
+            bloc.index = pd.RangeIndex(debut, debut + taille_bloc)
+            yield bloc
+            tampon = table.slice(taille_bloc).to_batches()
+            nb -= taille_bloc
+            debut += taille_bloc
+    if nb:
+        bloc = pa.Table.from_batches(tampon).to_pandas()
+        bloc.index = pd.RangeIndex(debut, debut + nb)
+        yield bloc
+
+def lire_source(fichier):
+    """Fichier entier en DataFrame, lecteur natif Arrow pour CSV et Parquet"""
+    extension = os.path.splitext(fichier)[1].lower()
+    if extension == ".csv":
+        return pacsv.read_csv(fichier, **options_csv(fichier)).to_pandas()
+    if extension == ".parquet":
+        return pq.read_table(fichier).to_pandas()
+    return pd.read_excel(fichier)
+
+def lire_blocs(fichier, taille_bloc=None):
+    """Fichier entier en un bloc, ou par blocs de `taille_bloc` lignes"""
+    if not taille_bloc:
+        yield lire_source(fichier)
+        return
+    extension = os.path.splitext(fichier)[1].lower()
+    if extension == ".csv":
+        yield from regrouper_batches(pacsv.open_csv(fichier, **options_csv(fichier)), taille_bloc)
+    elif extension == ".parquet":
+        yield from regrouper_batches(pq.ParquetFile(fichier).iter_batches(batch_size=taille_bloc), taille_bloc)
+    else:
+        yield from lire_blocs_excel(fichier, taille_bloc)
+
+def preparer_blocs(fichier, date_default, taille_bloc, regles=None, controles=None):
+    """Lots successifs d'un fichier lu en flux : mémoire bornée par la taille de bloc"""
+    for bloc in lire_blocs(fichier, taille_bloc):
+        yield preparer_lot(bloc, date_default, regles, controles)
+
+def lire_et_preparer(fichier, date_default, regles=None, controles=None):
+    """Lecture + préparation ; exécutée dans un processus du pool en mode parallèle"""
+    return preparer_lot(lire_source(fichier), date_default, regles, controles)
+
+def iterer_lots(taches, workers=1, regles=None, controles=None):
+    """
+    Rend (tache, lot, erreur) pour chaque fichier. Avec workers > 1 la lecture
+    des classeurs (coûteuse en CPU) se fait dans un pool de processus et les
+    lots sont rendus dans l'ordre où ils sont prêts.
+    """
+    if workers <= 1:
+        for tache in taches:
+            try:
+                yield tache, lire_et_preparer(tache[0], tache[2], regles, controles), None
+            except Exception as e:
+                yield tache, None, e
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(lire_et_preparer, tache[0], tache[2], regles, controles): tache for tache in taches}
+        for future in as_completed(futures):
+            tache = futures[future]
+            try:
+                yield tache, future.result(), None
+            except Exception as e:
+                yield tache, None, e
+
+# =========================
+# 6. MODE LIGNE PAR LIGNE (DIAGNOSTIC)
+# =========================
+def importer_fichier_ligne(cur, df, date_default, nom_fichier, source=None):
+    """
+    Ancien chemin ligne à ligne, conservé pour diagnostiquer les lignes en erreur.
+    Chaque ligne est protégée par un SAVEPOINT : une ligne refusée par la base
+    part en quarantaine sans annuler les autres.
+    """
+    # --- BOUCLE LIGNE PAR LIGNE ---
+    # Nécessaire pour récupérer l'ID généré (RETURNING num)
+    count_local = 0
+    rejets = []
+
+    for index, row in df.iterrows():
+        cur.execute("SAVEPOINT ligne")
+        try:
+            # A. PRÉPARATION DONNÉES ENTRETIEN
+            # --------------------------------
+            vals_entretien = {}
+            vals_entretien['date_ent'] = date_default
+
+            # Mapping dynamique
+            for col_excel, col_sql in MAPPING_ENTRETIEN.items():
+                raw_val = row.get(col_excel) # Récupère valeur ou None
+
+                # Nettoyage spécifique selon colonne
+                if col_sql in ["sit_fam", "origine"]:
+                     vals_entretien[col_sql] = clean_varchar_limit(raw_val, 2)
+                elif col_sql in ["commune", "partenaire"]:
+                     vals_entretien[col_sql] = clean_value(raw_val) # Texte normal
+                else:
+                    # Numériques (Integer)
+                    v = clean_value(raw_val)
+                    try:
+                        vals_entretien[col_sql] = int(float(v)) if v is not None else None
+                    except:
+                        vals_entretien[col_sql] = None
+
+            # B. INSERTION ENTRETIEN & RÉCUPÉRATION ID
+            # ----------------------------------------
+            columns = list(vals_entretien.keys())
+            values = list(vals_entretien.values())
+
+            # Construction requête SQL dynamique
+            sql_ent = f"""
+                INSERT INTO ENTRETIEN ({', '.join(columns)}) 
+                VALUES ({', '.join(['%s'] * len(values))})
+                RETURNING num;
+            """
+
+            cur.execute(sql_ent, values)
+            # C'EST ICI QU'ON RÉCUPÈRE LA CLÉ PRIMAIRE GÉNÉRÉE
+            new_id = cur.fetchone()[0]
+            if source is not None:
+                cur.execute("INSERT INTO ENTRETIEN_SOURCE (num, fichier) VALUES (%s, %s)", (new_id, source))
+
+            # C. INSERTION DEMANDES (Table liée)
+            # ----------------------------------
+            pos_demande = 1
+            for col_dem in COLS_DEMANDES:
+                val_dem = clean_value(row.get(col_dem))
+                if val_dem:
+                    sql_dem = "INSERT INTO DEMANDE (num, pos, nature) VALUES (%s, %s, %s)"
+                    cur.execute(sql_dem, (new_id, pos_demande, str(val_dem)))
+                    pos_demande += 1
+
+            # D. INSERTION SOLUTIONS (Table liée)
+            # -----------------------------------
+            pos_sol = 1
+            for col_sol in COLS_SOLUTIONS:
+                val_sol = clean_value(row.get(col_sol))
+                if val_sol:
+                    sql_sol = "INSERT INTO SOLUTION (num, pos, nature) VALUES (%s, %s, %s)"
+                    cur.execute(sql_sol, (new_id, pos_sol, str(val_sol)))
+                    pos_sol += 1
+
+            cur.execute("RELEASE SAVEPOINT ligne")
+            count_local += 1
+
+        except Exception as row_error:
+            print(f"❌ Erreur ligne {index} dans {nom_fichier}: {row_error}")
+            cur.execute("ROLLBACK TO SAVEPOINT ligne")
+            rejets.append({**row.to_dict(), "motif_rejet": str(row_error).strip()})
+
+    return count_local, pd.DataFrame(rejets)
+
+# =========================
+# 7. IMPORT INCRÉMENTAL (MANIFESTE)
+# =========================
+# Même schéma que creation_base.py, recréé au besoin sur une base existante
+SQL_MANIFESTE = """
+CREATE TABLE IF NOT EXISTS IMPORT_MANIFEST(
+   FICHIER VARCHAR(255),
+   TAILLE BIGINT NOT NULL,
+   EMPREINTE CHAR(64) NOT NULL,
+   NB_LIGNES INTEGER NOT NULL,
+   DATE_IMPORT TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+   PRIMARY KEY(FICHIER)
+);
+CREATE TABLE IF NOT EXISTS ENTRETIEN_SOURCE(
+   NUM INTEGER,
+   FICHIER VARCHAR(255) NOT NULL,
+   PRIMARY KEY(NUM),
+   FOREIGN KEY(NUM) REFERENCES ENTRETIEN(NUM) ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS IDX_ENTRETIEN_SOURCE_FICHIER ON ENTRETIEN_SOURCE(FICHIER);
+"""
+
+def cle_source(fichier):
+    """Identifiant stable d'un fichier : chemin relatif au projet (absolu s'il est ailleurs)"""
+    chemin = os.path.abspath(fichier)
+    try:
+        relatif = os.path.relpath(chemin, BASE_DIR)
+        if not relatif.startswith(".."):
+            chemin = relatif
+    except ValueError:
+        # Autre lecteur sous Windows
+        pass
+    return chemin.replace(os.sep, "/")
+
+def empreinte_fichier(fichier, taille_bloc=1024 * 1024):
+    """(taille, SHA-256) du contenu, lu par blocs"""
+    sha = hashlib.sha256()
+    with open(fichier, "rb") as f:
+        for bloc in iter(lambda: f.read(taille_bloc), b""):
+            sha.update(bloc)
+    return os.path.getsize(fichier), sha.hexdigest()
+
+def lire_manifeste(cur):
+    """{fichier: empreinte} des classeurs déjà importés"""
+    cur.execute(SQL_MANIFESTE)
+    cur.execute("SELECT fichier, empreinte FROM IMPORT_MANIFEST")
+    return dict(cur.fetchall())
+
+def purger_source(cur, source):
+    """Supprime les entretiens (et leurs demandes/solutions) importés depuis ce fichier"""
+    sous_requete = "SELECT num FROM ENTRETIEN_SOURCE WHERE fichier = %s"
+    cur.execute(f"DELETE FROM DEMANDE WHERE num IN ({sous_requete})", (source,))
+    cur.execute(f"DELETE FROM SOLUTION WHERE num IN ({sous_requete})", (source,))
+    # ENTRETIEN_SOURCE suit par ON DELETE CASCADE
+    cur.execute(f"DELETE FROM ENTRETIEN WHERE num IN ({sous_requete})", (source,))
+    return cur.rowcount
+
+def enregistrer_manifeste(cur, source, taille, empreinte, nb_lignes):
+    cur.execute("""
+        INSERT INTO IMPORT_MANIFEST (fichier, taille, empreinte, nb_lignes, date_import)
+        VALUES (%s, %s, %s, %s, CURRENT_TIMESTAMP)
+        ON CONFLICT (fichier) DO UPDATE
+        SET taille = EXCLUDED.taille, empreinte = EXCLUDED.empreinte,
+            nb_lignes = EXCLUDED.nb_lignes, date_import = EXCLUDED.date_import
+    """, (source, taille, empreinte, nb_lignes))
+
+def filtrer_inchanges(taches, manifeste, forcer=False):
+    """Écarte les fichiers dont l'empreinte est déjà au manifeste ; renvoie (taches, {fichier: signature})"""
+    a_importer, signatures = [], {}
+    for tache in taches:
+        fichier, nom_fichier = tache[0], tache[1]
+        source = cle_source(fichier)
+        taille, empreinte = empreinte_fichier(fichier)
+        if not forcer and manifeste.get(source) == empreinte:
+            print(f" Inchangé depuis le dernier import, ignoré : {nom_fichier}")
+            continue
+        signatures[fichier] = (source, taille, empreinte, source in manifeste)
+        a_importer.append(tache)
+    return a_importer, signatures
+
+# =========================
+# 8. MOTEUR D'IMPORTATION
+# =========================
+def lister_fichiers(dossier=DOSSIER_EXCEL):
+    """Fichiers à importer : [(chemin, nom, date par défaut)]"""
+    taches = []
+    fichiers = sorted(
+        fichier for extension in EXTENSIONS_SOURCES
+        for fichier in glob.glob(os.path.join(dossier, "*" + extension))
+    )
+    for fichier in fichiers:
+        nom_fichier = os.path.basename(fichier)
+        nom_mois = os.path.splitext(nom_fichier)[0].lower().strip()
+        mois_num = MOIS_FR.get(nom_mois)
+
+        if not mois_num:
+            print(f" Fichier ignoré (nom de mois inconnu) : {nom_fichier}")
+            continue
+
+        # Ajout de la date (1er du mois par défaut)
+        taches.append((fichier, nom_fichier, date(ANNEE_FICHIERS, mois_num, 1)))
+    return taches
+
+def lire_metadonnees(cur, conn):
+    """Règles de nettoyage et contrôles, ou valeurs par défaut si les métadonnées sont illisibles"""
+    try:
+        regles = charger_regles_nettoyage(cur)
+        controles = charger_controles(cur)
+        conn.commit()
+        return regles, controles
+    except Exception as e:
+        conn.rollback()
+        print(f" Métadonnées illisibles, nettoyage par défaut et sans contrôle : {e}")
+        return REGLES_NETTOYAGE, None
+
+def remplacer_fichier(cur, signature, nom_fichier):
+    """Début de transaction d'un fichier : retire les lignes de son import précédent"""
+    source, _, _, deja_importe = signature
+    if deja_importe:
+        nb = purger_source(cur, source)
+        print(f"   ♻️ {nb} entretiens de l'import précédent de {nom_fichier} remplacés")
+    return source
+
+def importer_ligne_a_ligne(cur, conn, fichier, nom_fichier, date_default, signature,
+                           regles=None, controles=None, taille_bloc=None):
+    """
+    Importe un fichier ligne à ligne dans sa propre transaction ; renvoie (lignes chargées, rejets).
+    Avec `controles`, les lignes hors référentiel sont écartées comme en mode bulk avant l'insertion.
+    """
+    count_local, rejets = 0, []
+    try:
+        source = remplacer_fichier(cur, signature, nom_fichier)
+        for bloc in lire_blocs(fichier, taille_bloc):
+            if controles:
+                rejets_controles = preparer_lot(bloc, date_default, regles, controles)["rejets"]
+                if rejets_controles is not None:
+                    bloc = bloc.drop(index=rejets_controles.index)
+                    rejets.append(rejets_controles)
+            count_bloc, rejets_bloc = importer_fichier_ligne(cur, bloc, date_default, nom_fichier, source)
+            count_local += count_bloc
+            rejets.append(rejets_bloc)
+        enregistrer_manifeste(cur, source, signature[1], signature[2], count_local)
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        print(f" Erreur lecture {nom_fichier} : {e}")
+        return 0, None
+    rejets = [r for r in rejets if not r.empty]
+    return count_local, pd.concat(rejets) if rejets else None
+
+def importer_dossier_excel(mode="bulk", workers=1, dossier=DOSSIER_EXCEL, forcer=False, taille_bloc=None):
     conn = None
     try:
         print("Connexion à la base de données...")
@@ -85,116 +771,123 @@ def importer_dossier_excel():
         conn.autocommit = False # On gère les transactions manuellement
         cur = conn.cursor()
 
-        fichiers = glob.glob(os.path.join(DOSSIER_EXCEL, "*.xlsx"))
-        print(f" {len(fichiers)} fichiers trouvés.")
+        taches = lister_fichiers(dossier)
+        print(f" {len(taches)} fichiers trouvés.")
+
+        # Seuls les fichiers nouveaux ou modifiés depuis le dernier import sont relus
+        manifeste = lire_manifeste(cur)
+        conn.commit()
+        taches, signatures = filtrer_inchanges(taches, manifeste, forcer)
+        print(f" {len(taches)} fichiers nouveaux ou modifiés à importer.")
 
         total_lignes_traitees = 0
+        total_rejets = 0
+        regles, controles = lire_metadonnees(cur, conn)
+        dossier_rejets = dossier_quarantaine_execution(dossier)
 
-        for fichier in fichiers:
-            nom_fichier = os.path.basename(fichier)
-            nom_mois = os.path.splitext(nom_fichier)[0].lower().strip()
-            mois_num = MOIS_FR.get(nom_mois)
+        if mode == "ligne":
+            for fichier, nom_fichier, date_default in taches:
+                print(f"📄 Traitement de : {nom_fichier}")
+                count_local, rejets = importer_ligne_a_ligne(
+                    cur, conn, fichier, nom_fichier, date_default, signatures[fichier],
+                    regles=regles, controles=controles, taille_bloc=taille_bloc
+                )
+                print(f"✅ {count_local} entretiens (+ demandes/réponses) insérés pour {nom_fichier}")
+                if ecrire_quarantaine(rejets, nom_fichier, dossier_rejets):
+                    print(f"   🚧 {len(rejets)} lignes en quarantaine")
+                    total_rejets += len(rejets)
+                total_lignes_traitees += count_local
+        else:
+            rapport_total = {}
 
-            if not mois_num:
-                print(f" Fichier ignoré (nom de mois inconnu) : {nom_fichier}")
-                continue
+            if taille_bloc:
+                # Lecture en flux par l'écrivain lui-même : un fichier à la fois, mémoire bornée
+                flux = ((tache, preparer_blocs(tache[0], tache[2], taille_bloc, regles, controles), None)
+                        for tache in taches)
+            else:
+                flux = ((tache, [lot], erreur) for tache, lot, erreur in iterer_lots(taches, workers, regles, controles))
 
-            print(f"📄 Traitement de : {nom_fichier} (Mois : {mois_num})")
-            
-            try:
-                df = pd.read_excel(fichier)
-            except Exception as e:
-                print(f" Erreur lecture Excel {nom_fichier} : {e}")
-                continue
+            # Un seul écrivain (ce processus) : une transaction par fichier,
+            # purge de l'import précédent et manifeste compris
+            for (fichier, nom_fichier, date_default), lots, erreur in flux:
+                if erreur is not None:
+                    print(f" Erreur lecture {nom_fichier} : {erreur}")
+                    continue
 
-            # Ajout de la date (1er du mois par défaut)
-            date_default = date(ANNEE_FICHIERS, mois_num, 1)
-
-            # --- BOUCLE LIGNE PAR LIGNE ---
-            # Nécessaire pour récupérer l'ID généré (RETURNING num)
-            count_local = 0
-            
-            for index, row in df.iterrows():
+                print(f"📄 Chargement de : {nom_fichier}")
+                signature = signatures[fichier]
+                count_local, rapport, rejets = 0, {}, []
                 try:
-                    # A. PRÉPARATION DONNÉES ENTRETIEN
-                    # --------------------------------
-                    vals_entretien = {}
-                    vals_entretien['date_ent'] = date_default
-                    
-                    # Mapping dynamique
-                    for col_excel, col_sql in MAPPING_ENTRETIEN.items():
-                        raw_val = row.get(col_excel) # Récupère valeur ou None
-                        
-                        # Nettoyage spécifique selon colonne
-                        if col_sql in ["sit_fam", "origine"]:
-                             vals_entretien[col_sql] = clean_varchar_limit(raw_val, 2)
-                        elif col_sql in ["commune", "partenaire"]:
-                             vals_entretien[col_sql] = clean_value(raw_val) # Texte normal
-                        else:
-                            # Numériques (Integer)
-                            v = clean_value(raw_val)
-                            try:
-                                vals_entretien[col_sql] = int(float(v)) if v is not None else None
-                            except:
-                                vals_entretien[col_sql] = None
-
-                    # B. INSERTION ENTRETIEN & RÉCUPÉRATION ID
-                    # ----------------------------------------
-                    columns = list(vals_entretien.keys())
-                    values = list(vals_entretien.values())
-                    
-                    # Construction requête SQL dynamique
-                    sql_ent = f"""
-                        INSERT INTO ENTRETIEN ({', '.join(columns)}) 
-                        VALUES ({', '.join(['%s'] * len(values))})
-                        RETURNING num;
-                    """
-                    
-                    cur.execute(sql_ent, values)
-                    # C'EST ICI QU'ON RÉCUPÈRE LA CLÉ PRIMAIRE GÉNÉRÉE
-                    new_id = cur.fetchone()[0]
-
-                    # C. INSERTION DEMANDES (Table liée)
-                    # ----------------------------------
-                    pos_demande = 1
-                    for col_dem in COLS_DEMANDES:
-                        val_dem = clean_value(row.get(col_dem))
-                        if val_dem:
-                            sql_dem = "INSERT INTO DEMANDE (num, pos, nature) VALUES (%s, %s, %s)"
-                            cur.execute(sql_dem, (new_id, pos_demande, str(val_dem)))
-                            pos_demande += 1
-
-                    # D. INSERTION SOLUTIONS (Table liée)
-                    # -----------------------------------
-                    pos_sol = 1
-                    for col_sol in COLS_SOLUTIONS:
-                        val_sol = clean_value(row.get(col_sol))
-                        if val_sol:
-                            sql_sol = "INSERT INTO SOLUTION (num, pos, nature) VALUES (%s, %s, %s)"
-                            cur.execute(sql_sol, (new_id, pos_sol, str(val_sol)))
-                            pos_sol += 1
-                    
-                    count_local += 1
-
-                except Exception as row_error:
-                    print(f"❌ Erreur ligne {index} dans {nom_fichier}: {row_error}")
-                    conn.rollback() # On annule tout pour ce fichier si critique, ou continue
-                    # Ici je choisis de stopper le fichier courant
-                    break 
-
-            # Validation de la transaction pour le fichier entier
-            conn.commit()
-            print(f"✅ {count_local} entretiens (+ demandes/réponses) insérés pour {nom_fichier}")
-            total_lignes_traitees += count_local
+                    source = remplacer_fichier(cur, signature, nom_fichier)
+                    for lot in lots:
+                        count_local += charger_lot(cur, lot, source)
+                        fusionner_rapports(rapport, lot["rapport"])
+                        if lot["rejets"] is not None:
+                            rejets.append(lot["rejets"])
+                    enregistrer_manifeste(cur, source, signature[1], signature[2], count_local)
+                    conn.commit()
+                    rejets = pd.concat(rejets) if rejets else None
+                except Exception as bulk_error:
+                    # Refus de la base malgré les contrôles : on rejoue ce fichier ligne à ligne
+                    # pour ne mettre en quarantaine que les lignes fautives
+                    conn.rollback()
+                    print(f"❌ Erreur chargement {nom_fichier} : {bulk_error}")
+                    print("   Reprise ligne à ligne de ce fichier...")
+                    # Les contrôles sont rejoués sur tout le fichier : les lots non encore
+                    # préparés (lecture en flux) ont aussi leurs lignes invalides écartées
+                    count_local, rejets = importer_ligne_a_ligne(
+                        cur, conn, fichier, nom_fichier, date_default, signature,
+                        regles=regles, controles=controles, taille_bloc=taille_bloc
+                    )
+
+                print(f"✅ {count_local} entretiens (+ demandes/réponses) insérés pour {nom_fichier}")
+                afficher_rapport(rapport, nom_fichier)
+                fusionner_rapports(rapport_total, rapport)
+                if ecrire_quarantaine(rejets, nom_fichier, dossier_rejets):
+                    print(f"   🚧 {len(rejets)} lignes en quarantaine")
+                    total_rejets += len(rejets)
+                total_lignes_traitees += count_local
+
+            if rapport_total:
+                print("Valeurs corrigées au nettoyage (toutes les feuilles) :")
+                afficher_rapport(rapport_total, "total")
 
         cur.close()
         conn.close()
         print("-" * 30)
         print(f"🎉 TERMINÉ. Total entretiens importés : {total_lignes_traitees}")
+        if total_rejets:
+            print(f"🚧 {total_rejets} lignes en quarantaine dans {dossier_rejets}")
+            print(f"   Après correction : python alimentation_base.py --dossier {dossier_rejets}")
 
     except Exception as e:
         print(f"❌ Erreur générale : {e}")
         if conn: conn.rollback()
 
 if __name__ == "__main__":
-    importer_dossier_excel()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Import des fichiers mensuels (Excel, CSV, Parquet) dans la base")
+    parser.add_argument(
+        "--mode", choices=["bulk", "ligne"], default="bulk",
+        help="bulk : COPY en une transaction par fichier ; ligne : INSERT ligne à ligne (diagnostic)"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1,
+        help="processus de lecture des classeurs en mode bulk (0 = un par cœur)"
+    )
+    parser.add_argument(
+        "--dossier", default=DOSSIER_EXCEL,
+        help="dossier des classeurs à importer (ex : dossier de quarantaine corrigé)"
+    )
+    parser.add_argument(
+        "--forcer", action="store_true",
+        help="réimporte aussi les fichiers inchangés (leurs lignes précédentes sont remplacées)"
+    )
+    parser.add_argument(
+        "--taille-bloc", type=int, default=0,
+        help="lit les classeurs en flux par blocs de N lignes (mémoire bornée, sans --workers) ; 0 = feuille entière"
+    )
+    args = parser.parse_args()
+    workers = args.workers if args.workers > 0 else (os.cpu_count() or 1)
+    importer_dossier_excel(
+        mode=args.mode, workers=workers, dossier=args.dossier, forcer=args.forcer, taille_bloc=args.taille_bloc
+    )
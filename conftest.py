@@ -3,6 +3,7 @@
 import pytest
 import psycopg2
 from database import LOCAL_DB_CONFIG
+from agregats import installer_agregats
 
 @pytest.fixture(scope="session", autouse=True)
 def init_db_schema():
@@ -52,6 +53,7 @@ def init_db_schema():
                 CREATE TABLE IF NOT EXISTS DEMANDE (NUM INTEGER, POS INTEGER, NATURE INTEGER);
                 CREATE TABLE IF NOT EXISTS SOLUTION (NUM INTEGER, POS INTEGER, NATURE INTEGER);
             """)
+            installer_agregats(cur)
 
             # 2. Injection conditionnelle de la configuration
             # On vérifie si la table VARIABLE contient déjà des données pour ne pas dupliquer
@@ -2,6 +2,7 @@ import psycopg2
 from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
 import os
 from dotenv import load_dotenv
+from agregats import installer_agregats
 
 # Charge les variables du fichier .env
 load_dotenv()
@@ -32,6 +33,11 @@ DROP TABLE IF EXISTS MODALITE CASCADE;
 DROP TABLE IF EXISTS PLAGE CASCADE;
 DROP TABLE IF EXISTS VARIABLE CASCADE;
 DROP TABLE IF EXISTS RUBRIQUE CASCADE;
+DROP TABLE IF EXISTS METADATA_VERSION CASCADE;
+DROP TABLE IF EXISTS ENTRETIEN_SOURCE CASCADE;
+DROP TABLE IF EXISTS IMPORT_MANIFEST CASCADE;
+DROP TABLE IF EXISTS STAT_MENSUELLE CASCADE;
+DROP TABLE IF EXISTS STAT_MODIFICATIONS CASCADE;
 
 -- 2. CREATION PRINCIPALE
 CREATE TABLE ENTRETIEN(
@@ -94,6 +100,10 @@ COMMENT ON COLUMN SOLUTION.NATURE IS 'Nature de la solution (1 : Information;2a
 COMMENT ON COLUMN DEMANDE.NUM IS 'Clé étrangère vers l''identifiant de l''entretien, Rubrique Entretien';
 COMMENT ON COLUMN SOLUTION.NUM IS 'Clé étrangère vers l''identifiant de l''entretien, Rubrique Entretien';
 
+-- Exports et listes par période (intervalles de dates). DEMANDE / SOLUTION : la clé primaire
+-- (NUM, POS) commence par NUM et sert déjà les recherches et jointures par entretien.
+CREATE INDEX IDX_ENTRETIEN_DATE_ENT ON ENTRETIEN(DATE_ENT);
+
 SELECT UPPER(TABLE_NAME),ordinal_position,UPPER(COLUMN_NAME) FROM INFORMATION_SCHEMA.COLUMNS WHERE UPPER(TABLE_NAME) IN ('ENTRETIEN','DEMANDE','SOLUTION') ORDER BY 1,2,3;
 
 SELECT UPPER(TABLE_NAME),ordinal_position,UPPER(COLUMN_NAME),
@@ -228,6 +238,34 @@ COMMENT ON COLUMN VALEURS_C.POS IS 'Position de la variable dans table de stocka
 COMMENT ON COLUMN VALEURS_C.POS_C IS 'Identifiant de l''élément de la liste';
 COMMENT ON COLUMN VALEURS_C.LIB IS 'Libellé de l''élément de la liste';
 
+CREATE TABLE METADATA_VERSION(
+   ID SMALLINT,
+   VERSION BIGINT NOT NULL,
+   PRIMARY KEY(ID)
+);
+COMMENT ON TABLE METADATA_VERSION IS 'Compteur incrémenté à chaque modification des métadonnées (VARIABLE, MODALITE) depuis l''administration';
+INSERT INTO METADATA_VERSION (ID, VERSION) VALUES (1, 0);
+
+CREATE TABLE IMPORT_MANIFEST(
+   FICHIER VARCHAR(255),
+   TAILLE BIGINT NOT NULL,
+   EMPREINTE CHAR(64) NOT NULL,
+   NB_LIGNES INTEGER NOT NULL,
+   DATE_IMPORT TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+   PRIMARY KEY(FICHIER)
+);
+COMMENT ON TABLE IMPORT_MANIFEST IS 'Classeurs déjà importés par alimentation_base.py : un fichier dont l''empreinte n''a pas changé n''est pas rechargé';
+COMMENT ON COLUMN IMPORT_MANIFEST.EMPREINTE IS 'Empreinte SHA-256 du contenu du fichier';
+
+CREATE TABLE ENTRETIEN_SOURCE(
+   NUM INTEGER,
+   FICHIER VARCHAR(255) NOT NULL,
+   PRIMARY KEY(NUM),
+   FOREIGN KEY(NUM) REFERENCES ENTRETIEN(NUM) ON DELETE CASCADE
+);
+CREATE INDEX IDX_ENTRETIEN_SOURCE_FICHIER ON ENTRETIEN_SOURCE(FICHIER);
+COMMENT ON TABLE ENTRETIEN_SOURCE IS 'Fichier d''origine de chaque entretien importé, pour remplacer les lignes d''un classeur modifié';
+
 INSERT INTO VARIABLE (TAB, POS, LIB, COMMENTAIRE,MOIS_DEBUT_VALIDITE, MOIS_FIN_VALIDITE, TYPE_V, DEFVAL, EST_CONTRAINTE, POS_R, RUBRIQUE)
 SELECT UPPER(TABLE_NAME),ordinal_position,UPPER(COLUMN_NAME),
 CASE
@@ -447,6 +485,10 @@ def execute_ddl_and_exports():
         conn.commit()
         print("✅ Tables créées et métadonnées générées avec succès.")
 
+        # Agrégats mensuels tenus à jour par triggers
+        installer_agregats(cur)
+        conn.commit()
+
         if not os.path.exists(OUTPUT_DIR):
             print(f"⚠️ Création du dossier {OUTPUT_DIR}...")
             os.makedirs(OUTPUT_DIR)
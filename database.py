@@ -1,10 +1,17 @@
 # database.py
 # -*- coding: utf-8 -*-
 import psycopg2
+from psycopg2 import pool as pg_pool
 import streamlit as st
 import datetime
+import threading
+import time
+import copy
+from contextlib import contextmanager
 import pandas as pd
 from sqlalchemy import create_engine
+from transcodage import normaliser_code
+from agregats import reconstruire_agregats, installer_agregats
 import os
 from dotenv import load_dotenv
 
@@ -21,60 +28,247 @@ LOCAL_DB_CONFIG = {
     "options": "-c client_encoding=WIN1252"
 }
 
-def get_db_url():
-    """Génère l'URL de connexion pour SQLAlchemy"""
+# --- POOL DE CONNEXIONS ---
+# DB_POOL_MIN : connexions gardées ouvertes au repos (ouvertes dès la création du pool)
+# DB_POOL_MAX : connexions simultanées au maximum (au-delà, on attend DB_POOL_TIMEOUT secondes)
+POOL_MIN_CONN = int(os.getenv("DB_POOL_MIN", "2"))
+POOL_MAX_CONN = int(os.getenv("DB_POOL_MAX", "10"))
+POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+
+# --- MOTEUR SQLALCHEMY (lectures Pandas) ---
+ENGINE_POOL_SIZE = int(os.getenv("DB_ENGINE_POOL_SIZE", "5"))
+ENGINE_MAX_OVERFLOW = int(os.getenv("DB_ENGINE_MAX_OVERFLOW", "5"))
+ENGINE_POOL_RECYCLE = int(os.getenv("DB_ENGINE_POOL_RECYCLE", "1800"))
+
+# --- REQUÊTES PRÉPARÉES (PREPARE / EXECUTE) ---
+# DB_PREPARED_MAX : requêtes préparées gardées par connexion du pool (0 = désactivé)
+PREPARED_MAX = int(os.getenv("DB_PREPARED_MAX", "32"))
+
+_pool = None
+_pool_slots = None
+_pool_lock = threading.Lock()
+_engine = None
+_engine_lock = threading.Lock()
+
+# --- CACHE DES MÉTADONNÉES (VARIABLE / MODALITE / RUBRIQUE) ---
+# DB_METADATA_SYNC : intervalle (secondes) de lecture du compteur METADATA_VERSION en base,
+# pour que plusieurs instances de l'application voient les modifications de l'administration.
+# 0 = désactivé (instance unique : seule l'invalidation locale compte).
+METADATA_SYNC_SECONDS = float(os.getenv("DB_METADATA_SYNC", "0"))
+
+_metadata_cache = {}
+_metadata_lock = threading.Lock()
+_metadata_state = {"local": 0, "db": None, "checked_at": 0.0}
+
+def get_connection_params():
+    """Paramètres Psycopg2 : secrets Streamlit en priorité, sinon configuration locale"""
     try:
         creds = st.secrets["postgres"]
-        return f"postgresql+psycopg2://{creds['user']}:{creds['password']}@{creds['host']}:{creds['port']}/{creds['database']}"
+        return {
+            "host": creds["host"],
+            "port": creds["port"],
+            "database": creds["database"],
+            "user": creds["user"],
+            "password": creds["password"],
+            "options": "-c client_encoding=WIN1252"
+        }
     except (FileNotFoundError, KeyError, AttributeError):
-        c = LOCAL_DB_CONFIG
-        return f"postgresql+psycopg2://{c['user']}:{c['password']}@{c['host']}:{c['port']}/{c['database']}"
+        return dict(LOCAL_DB_CONFIG)
+
+def get_db_url():
+    """Génère l'URL de connexion pour SQLAlchemy"""
+    c = get_connection_params()
+    return f"postgresql+psycopg2://{c['user']}:{c['password']}@{c['host']}:{c['port']}/{c['database']}"
 
 def get_db_connection():
-    """Connexion Psycopg2 classique"""
+    """Connexion Psycopg2 classique (hors pool, à fermer par l'appelant)"""
+    return psycopg2.connect(**get_connection_params())
+
+class _StatementCacheConnection(psycopg2.extensions.connection):
+    """Connexion du pool qui garde la liste de ses requêtes préparées côté serveur"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared_statements = {}
+        self.prepared_version = None
+        self.prepared_dirty = False
+        self.prepared_counter = 0
+
+def get_db_pool():
+    """Pool de connexions partagé par tout le processus (une session Streamlit = un thread)"""
+    global _pool, _pool_slots
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                max_conn = max(POOL_MAX_CONN, 1)
+                min_conn = min(max(POOL_MIN_CONN, 0), max_conn)
+                _pool_slots = threading.BoundedSemaphore(max_conn)
+                _pool = pg_pool.ThreadedConnectionPool(
+                    min_conn, max_conn, connection_factory=_StatementCacheConnection, **get_connection_params()
+                )
+    return _pool
+
+def close_db_pool():
+    """Ferme toutes les connexions du pool (il sera recréé au prochain accès)"""
+    global _pool, _pool_slots
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+        _pool = None
+        _pool_slots = None
+
+def _is_connection_alive(conn):
+    """Vérifie qu'une connexion sortie du pool répond encore (coupure serveur, timeout réseau...)"""
+    if conn.closed:
+        return False
     try:
-        return psycopg2.connect(
-            host=st.secrets["postgres"]["host"],
-            port=st.secrets["postgres"]["port"],
-            database=st.secrets["postgres"]["database"],
-            user=st.secrets["postgres"]["user"],
-            password=st.secrets["postgres"]["password"],
-            options="-c client_encoding=WIN1252"
-        )
-    except (FileNotFoundError, KeyError, AttributeError):
-        return psycopg2.connect(**LOCAL_DB_CONFIG)
+        # En autocommit, le ping n'ouvre pas de transaction : un seul aller-retour
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+        conn.autocommit = False
+        return True
+    except psycopg2.Error:
+        return False
+
+@contextmanager
+def db_connection():
+    """
+    Emprunte une connexion au pool et la rend automatiquement.
+    La connexion est testée avant d'être prêtée ; une transaction laissée
+    ouverte est annulée au retour dans le pool.
+    """
+    db_pool = get_db_pool()
+    slots = _pool_slots
+    if not slots.acquire(timeout=POOL_TIMEOUT):
+        raise pg_pool.PoolError("Pool de connexions saturé")
+    conn = None
+    try:
+        conn = db_pool.getconn()
+        if not _is_connection_alive(conn):
+            # Connexion morte : on la jette et on en ouvre une neuve
+            db_pool.putconn(conn, close=True)
+            # Déjà rendue : si la nouvelle connexion échoue, rien à rendre au pool
+            conn = None
+            conn = db_pool.getconn()
+        yield conn
+    finally:
+        try:
+            if conn is not None:
+                db_pool.putconn(conn, close=bool(conn.closed))
+        finally:
+            slots.release()
+
+def get_engine():
+    """Moteur SQLAlchemy unique pour le processus, réutilisé par toutes les lectures Pandas"""
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = create_engine(
+                    get_db_url(),
+                    pool_size=ENGINE_POOL_SIZE,
+                    max_overflow=ENGINE_MAX_OVERFLOW,
+                    pool_recycle=ENGINE_POOL_RECYCLE,
+                    pool_pre_ping=True
+                )
+    return _engine
+
+def dispose_engine():
+    """Ferme les connexions du moteur (il sera recréé au prochain accès)"""
+    global _engine
+    with _engine_lock:
+        if _engine is not None:
+            _engine.dispose()
+        _engine = None
 
 def get_pandas_data(query, params=None):
-    db_url = get_db_url()
-    engine = create_engine(db_url)
     try:
-        with engine.connect() as conn:
+        with get_engine().connect() as conn:
             return pd.read_sql(query, conn, params=params)
     except Exception as e:
         print(f"Erreur SQL (Pandas) : {e}")
         return pd.DataFrame()
-    finally:
-        engine.dispose()
+
+# --- CACHE DES MÉTADONNÉES ---
+
+# Même schéma que creation_base.py, recréé au besoin sur une base existante
+SQL_METADATA_VERSION = """
+CREATE TABLE IF NOT EXISTS METADATA_VERSION(
+   ID SMALLINT,
+   VERSION BIGINT NOT NULL,
+   PRIMARY KEY(ID)
+);
+INSERT INTO METADATA_VERSION (ID, VERSION) VALUES (1, 0) ON CONFLICT (ID) DO NOTHING;
+"""
+
+def get_metadata_version():
+    """Version courante des métadonnées : (compteur local, compteur en base ou None)"""
+    if METADATA_SYNC_SECONDS > 0 and time.monotonic() - _metadata_state["checked_at"] >= METADATA_SYNC_SECONDS:
+        _metadata_state["checked_at"] = time.monotonic()
+        try:
+            with db_connection() as conn:
+                with conn.cursor() as cur:
+                    # Table absente (base antérieure) : créée à la première modification
+                    cur.execute("SELECT to_regclass('metadata_version') IS NOT NULL")
+                    row = None
+                    if cur.fetchone()[0]:
+                        cur.execute("SELECT version FROM METADATA_VERSION WHERE id = 1")
+                        row = cur.fetchone()
+            with _metadata_lock:
+                _metadata_state["db"] = row[0] if row else None
+        except Exception as e:
+            print(f"Erreur lecture METADATA_VERSION : {e}")
+    with _metadata_lock:
+        return (_metadata_state["local"], _metadata_state["db"])
+
+def invalidate_metadata_cache():
+    """Vide le cache des métadonnées : le prochain accès relit la base"""
+    with _metadata_lock:
+        _metadata_state["local"] += 1
+        _metadata_state["checked_at"] = 0.0
+        _metadata_cache.clear()
+
+def _bump_metadata_version(cur):
+    """Incrémente le compteur partagé dans la transaction d'administration en cours"""
+    if METADATA_SYNC_SECONDS > 0:
+        cur.execute("SELECT to_regclass('metadata_version') IS NOT NULL")
+        if not cur.fetchone()[0]:
+            cur.execute(SQL_METADATA_VERSION)
+        cur.execute("UPDATE METADATA_VERSION SET version = version + 1 WHERE id = 1")
+
+def _get_cached_metadata(key, loader, select=None):
+    """
+    Renvoie une copie de la valeur en cache, rechargée si la version a changé.
+    `select` extrait la partie utile avant la copie.
+    """
+    version = get_metadata_version()
+    with _metadata_lock:
+        entry = _metadata_cache.get(key)
+    if entry is None or entry[0] != version:
+        entry = (version, loader())
+        with _metadata_lock:
+            _metadata_cache[key] = entry
+    value = select(entry[1]) if select else entry[1]
+    return copy.deepcopy(value)
 
 # --- LECTURE CONFIG FORMULAIRE ---
 
-def get_rubriques():
-    """Récupère la liste des sections (Rubriques) disponibles"""
-    conn = get_db_connection()
-    try:
+def _load_rubriques():
+    with db_connection() as conn:
         with conn.cursor() as cur:
             cur.execute("SELECT pos, lib FROM RUBRIQUE ORDER BY pos")
             return cur.fetchall()
+
+def get_rubriques():
+    """Récupère la liste des sections (Rubriques) disponibles"""
+    try:
+        return _get_cached_metadata("rubriques", _load_rubriques)
     except Exception:
         return []
-    finally:
-        if conn: conn.close()
 
-def get_form_config():
-    """Récupère la config pour la table principale ENTRETIEN"""
-    conn = get_db_connection()
+def _load_form_config():
     config = []
-    try:
+    with db_connection() as conn:
         with conn.cursor() as cur:
             # On récupère les variables actives
             query_vars = """
@@ -87,6 +281,12 @@ def get_form_config():
             cur.execute(query_vars)
             vars_rows = cur.fetchall()
 
+            # Toutes les modalités ENTRETIEN en une requête, regroupées par variable
+            cur.execute("SELECT pos, code, lib_m FROM MODALITE WHERE tab='ENTRETIEN' ORDER BY pos, pos_m")
+            modalites = {}
+            for pos, code, lib in cur.fetchall():
+                modalites.setdefault(pos, []).append((code, lib))
+
             for row in vars_rows:
                 pos, lib_col, type_v, label_ui, rubrique = row
                 field_info = {
@@ -98,65 +298,185 @@ def get_form_config():
                     "options": {}
                 }
                 if type_v == 'MOD':
-                    cur.execute("SELECT code, lib_m FROM MODALITE WHERE tab='ENTRETIEN' AND pos=%s ORDER BY pos_m", (pos,))
-                    for code, lib in cur.fetchall():
+                    for code, lib in modalites.get(pos, []):
                         field_info["options"][lib] = code
                 config.append(field_info)
-        return config
+    return config
+
+def get_form_config():
+    """Récupère la config pour la table principale ENTRETIEN"""
+    try:
+        return _get_cached_metadata("form_config", _load_form_config)
     except Exception as e:
         st.error(f"Erreur config : {e}")
         return []
-    finally:
-        if conn: conn.close()
 
-def get_options_for_table(table_name, column_pos=3):
-    conn = get_db_connection()
+def _load_options_for_table(table_name, column_pos):
     options = {}
-    try:
+    with db_connection() as conn:
         with conn.cursor() as cur:
             query = "SELECT code, lib_m FROM MODALITE WHERE tab=%s AND pos=%s ORDER BY pos_m"
             cur.execute(query, (table_name, column_pos))
-            rows = cur.fetchall()
-            for code, lib in rows:
+            for code, lib in cur.fetchall():
                 options[lib] = code
-        return options
+    return options
+
+def get_options_for_table(table_name, column_pos=3):
+    try:
+        return _get_cached_metadata(
+            ("options", table_name, column_pos),
+            lambda: _load_options_for_table(table_name, column_pos)
+        )
     except Exception as e:
         st.error(f"Erreur options {table_name}: {e}")
         return {}
-    finally:
-        if conn: conn.close()
 
 # --- ECRITURE (SAISIE) ---
 
-def save_entretien_complet(data_entretien, liste_demandes, liste_solutions):
-    conn = get_db_connection()
-    try:
-        with conn.cursor() as cur:
-            clean_data = {k: v for k, v in data_entretien.items() if v is not None}
-            clean_data["DATE_ENT"] = datetime.date.today()
+# --- REQUÊTES PRÉPARÉES ---
 
-            columns = list(clean_data.keys())
-            values = list(clean_data.values())
-            cols_str = ", ".join(columns)
-            placeholders = ", ".join(["%s"] * len(values))
-            
-            query_ent = f"INSERT INTO ENTRETIEN ({cols_str}) VALUES ({placeholders}) RETURNING NUM"
-            cur.execute(query_ent, values)
-            new_num = cur.fetchone()[0]
+def _execute_prepared(cur, key, query, params, version):
+    """
+    Exécute `query` via une requête préparée de la connexion, créée au premier appel
+    pour `key` : le serveur n'analyse et ne planifie la requête qu'une fois par connexion.
+    Le cache est vidé quand les métadonnées changent (colonne ajoutée à ENTRETIEN) :
+    `version` (get_metadata_version) est lue par l'appelant avant d'emprunter la connexion,
+    pour ne jamais en demander une seconde au pool pendant qu'il tient la première.
+    """
+    conn = cur.connection
+    cache = getattr(conn, "prepared_statements", None)
+    if cache is None or PREPARED_MAX <= 0:
+        # Connexion hors pool (get_db_connection) : exécution classique
+        cur.execute(query, params)
+        return
 
-            for i, code_demande in enumerate(liste_demandes):
-                cur.execute("INSERT INTO DEMANDE (NUM, POS, NATURE) VALUES (%s, %s, %s)", (new_num, i+1, code_demande))
+    if conn.prepared_dirty or conn.prepared_version != version:
+        if cache or conn.prepared_dirty:
+            cur.execute("DEALLOCATE ALL")
+        cache.clear()
+        conn.prepared_version = version
+        conn.prepared_dirty = False
 
-            for i, code_sol in enumerate(liste_solutions):
-                cur.execute("INSERT INTO SOLUTION (NUM, POS, NATURE) VALUES (%s, %s, %s)", (new_num, i+1, code_sol))
-            
+    name = cache.get(key)
+    if name is None:
+        if len(cache) >= PREPARED_MAX:
+            # La plus ancienne laisse sa place
+            cur.execute(f"DEALLOCATE {cache.pop(next(iter(cache)))}")
+        conn.prepared_counter += 1
+        name = f"stmt_{conn.prepared_counter}"
+        morceaux = query.split("%s")
+        sql_prepare = morceaux[0] + "".join(f"${i}{m}" for i, m in enumerate(morceaux[1:], start=1))
+        cur.execute(f"PREPARE {name} AS {sql_prepare}")
+        cache[key] = name
+
+    cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+
+def _reset_prepared(conn):
+    """Après une erreur : les requêtes préparées seront toutes recréées (DEALLOCATE ALL)"""
+    if getattr(conn, "prepared_statements", None) is not None:
+        conn.prepared_statements.clear()
+        conn.prepared_dirty = True
+
+def _sql_dossier_complet(columns, nb_demandes, nb_solutions):
+    """
+    INSERT ENTRETIEN + DEMANDE + SOLUTION en une seule requête : les lignes filles
+    reprennent le NUM du RETURNING via la CTE (un aller-retour au lieu de 1 + n).
+    """
+    ctes = [
+        f"ent AS (INSERT INTO ENTRETIEN ({', '.join(columns)}) "
+        f"VALUES ({', '.join(['%s'] * len(columns))}) RETURNING NUM)"
+    ]
+    for alias, table, nb in (("dem", "DEMANDE", nb_demandes), ("sol", "SOLUTION", nb_solutions)):
+        if nb:
+            # VALUES directement dans l'INSERT : NATURE garde la conversion vers le type de la colonne
+            valeurs = ", ".join(f"((SELECT NUM FROM ent), {pos}, %s)" for pos in range(1, nb + 1))
+            ctes.append(f"{alias} AS (INSERT INTO {table} (NUM, POS, NATURE) VALUES {valeurs})")
+    return "WITH " + ",\n".join(ctes) + "\nSELECT NUM FROM ent"
+
+def _insert_dossier(cur, data_entretien, liste_demandes, liste_solutions, date_ent, version):
+    """
+    Insère un dossier complet avec le curseur fourni (sans commit) ; renvoie son NUM.
+    `version` : version des métadonnées, pour le cache des requêtes préparées.
+    """
+    clean_data = {k: v for k, v in data_entretien.items() if v is not None}
+    clean_data["DATE_ENT"] = date_ent or datetime.date.today()
+
+    # Ordre des colonnes fixe : même requête préparée pour un même jeu de champs
+    columns = sorted(clean_data)
+    values = [clean_data[c] for c in columns] + list(liste_demandes) + list(liste_solutions)
+
+    query = _sql_dossier_complet(columns, len(liste_demandes), len(liste_solutions))
+    key = ("dossier", tuple(columns), len(liste_demandes), len(liste_solutions))
+    _execute_prepared(cur, key, query, values, version)
+    return cur.fetchone()[0]
+
+def save_entretien_complet(data_entretien, liste_demandes, liste_solutions, date_ent=None):
+    # Avant l'emprunt : la lecture de la version peut elle-même demander une connexion
+    version = get_metadata_version()
+    with db_connection() as conn:
+        try:
+            with conn.cursor() as cur:
+                new_num = _insert_dossier(cur, data_entretien, liste_demandes, liste_solutions, date_ent, version)
+                conn.commit()
+                return new_num
+        except Exception as e:
+            conn.rollback()
+            _reset_prepared(conn)
+            raise e
+
+# Même table que l'import (alimentation_base.py) : la source d'une saisie différée est sa clé de journal
+SQL_ENTRETIEN_SOURCE = """
+CREATE TABLE IF NOT EXISTS ENTRETIEN_SOURCE(
+   NUM INTEGER,
+   FICHIER VARCHAR(255) NOT NULL,
+   PRIMARY KEY(NUM),
+   FOREIGN KEY(NUM) REFERENCES ENTRETIEN(NUM) ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS IDX_ENTRETIEN_SOURCE_FICHIER ON ENTRETIEN_SOURCE(FICHIER);
+"""
+
+def ensure_entretien_source():
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(SQL_ENTRETIEN_SOURCE)
+        conn.commit()
+
+def save_entretiens_lot(dossiers):
+    """
+    Enregistre une liste de dossiers {cle, data, demandes, solutions, date_ent} en une transaction.
+    Chaque dossier est protégé par un SAVEPOINT et étiqueté par sa clé dans ENTRETIEN_SOURCE :
+    un dossier déjà écrit (nouvel essai après coupure) n'est pas inséré deux fois.
+    Renvoie {cle: NUM ou exception}. Une erreur de connexion annule tout le lot et remonte.
+    """
+    resultats = {}
+    version = get_metadata_version()
+    with db_connection() as conn:
+        try:
+            with conn.cursor() as cur:
+                cles = [d["cle"] for d in dossiers]
+                cur.execute("SELECT fichier, num FROM ENTRETIEN_SOURCE WHERE fichier = ANY(%s)", (cles,))
+                resultats.update(dict(cur.fetchall()))
+
+                for d in dossiers:
+                    if d["cle"] in resultats:
+                        continue
+                    cur.execute("SAVEPOINT dossier")
+                    try:
+                        num = _insert_dossier(cur, d["data"], d["demandes"], d["solutions"], d["date_ent"], version)
+                        cur.execute("INSERT INTO ENTRETIEN_SOURCE (NUM, FICHIER) VALUES (%s, %s)", (num, d["cle"]))
+                        cur.execute("RELEASE SAVEPOINT dossier")
+                        resultats[d["cle"]] = num
+                    except (psycopg2.DataError, psycopg2.IntegrityError, psycopg2.ProgrammingError) as e:
+                        # Dossier refusé par la base : inutile de le réessayer
+                        cur.execute("ROLLBACK TO SAVEPOINT dossier")
+                        _reset_prepared(conn)
+                        resultats[d["cle"]] = e
             conn.commit()
-            return new_num
-    except Exception as e:
-        if conn: conn.rollback()
-        raise e
-    finally:
-        if conn: conn.close()
+            return resultats
+        except Exception as e:
+            conn.rollback()
+            _reset_prepared(conn)
+            raise e
 
 # --- ADMINISTRATION (CORRIGÉ) ---
 
@@ -168,116 +488,407 @@ def add_new_variable_db(nom_colonne, label_ui, type_var, id_rubrique, modalites_
     2. mois_fin_validite = 9999.
     3. est_contrainte = FALSE (pour satisfaire le NOT NULL).
     """
-    conn = get_db_connection()
-    try:
-        with conn.cursor() as cur:
-            safe_col_name = "".join(c for c in nom_colonne if c.isalnum() or c == '_').upper()
-            if not safe_col_name:
-                raise ValueError("Nom de colonne invalide")
-
-            # Vérifie si la colonne existe déjà
-            cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name = 'entretien' AND column_name = %s", (safe_col_name.lower(),))
-            if cur.fetchone():
-                raise ValueError(f"La colonne {safe_col_name} existe déjà.")
-
-            # 1. ALTER TABLE
-            sql_type = "VARCHAR(255)" if type_var in ['CHAINE', 'MOD'] else "INTEGER"
-            cur.execute(f"ALTER TABLE ENTRETIEN ADD COLUMN {safe_col_name} {sql_type}")
-
-            # 2. INSERT INTO VARIABLE
-            cur.execute("SELECT COALESCE(MAX(pos), 0) + 1 FROM VARIABLE WHERE tab='ENTRETIEN'")
-            new_pos = cur.fetchone()[0]
-            
-            cur.execute("SELECT COALESCE(MAX(pos_r), 0) + 1 FROM VARIABLE WHERE tab='ENTRETIEN' AND rubrique=%s", (id_rubrique,))
-            new_pos_r = cur.fetchone()[0]
+    with db_connection() as conn:
+        try:
+            with conn.cursor() as cur:
+                safe_col_name = "".join(c for c in nom_colonne if c.isalnum() or c == '_').upper()
+                if not safe_col_name:
+                    raise ValueError("Nom de colonne invalide")
 
-            # --- CORRECTION DATES & CONTRAINTES ---
-            today = datetime.date.today()
-            current_month_int = int(today.strftime('%y%m')) # Ex: 2601
-            end_month_infinite = 9999 
-            est_contrainte_val = False # Valeur par défaut : pas de contrainte
+                # Vérifie si la colonne existe déjà
+                cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name = 'entretien' AND column_name = %s", (safe_col_name.lower(),))
+                if cur.fetchone():
+                    raise ValueError(f"La colonne {safe_col_name} existe déjà.")
 
-            # Ajout de la colonne 'est_contrainte' dans l'INSERT
-            cur.execute("""
-                INSERT INTO VARIABLE (tab, pos, lib, type_v, rubrique, pos_r, commentaire, mois_debut_validite, mois_fin_validite, est_contrainte)
-                VALUES ('ENTRETIEN', %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            """, (new_pos, safe_col_name, type_var, id_rubrique, new_pos_r, label_ui, current_month_int, end_month_infinite, est_contrainte_val))
-
-            # 3. INSERT INTO MODALITE
-            if type_var == 'MOD' and modalites_initiales:
-                for i, mod_label in enumerate(modalites_initiales):
-                    code_mod = str(i + 1)
-                    cur.execute("""
-                        INSERT INTO MODALITE (tab, pos, code, lib_m, pos_m)
-                        VALUES ('ENTRETIEN', %s, %s, %s, %s)
-                    """, (new_pos, code_mod, mod_label, i+1))
+                # 1. ALTER TABLE
+                sql_type = "VARCHAR(255)" if type_var in ['CHAINE', 'MOD'] else "INTEGER"
+                cur.execute(f"ALTER TABLE ENTRETIEN ADD COLUMN {safe_col_name} {sql_type}")
+                _ajouter_variable_stat(cur, safe_col_name.lower())
+
+                # 2. INSERT INTO VARIABLE
+                cur.execute("SELECT COALESCE(MAX(pos), 0) + 1 FROM VARIABLE WHERE tab='ENTRETIEN'")
+                new_pos = cur.fetchone()[0]
             
-            conn.commit()
-            return True
-    except Exception as e:
-        if conn: conn.rollback()
-        raise e
-    finally:
-        if conn: conn.close()
+                cur.execute("SELECT COALESCE(MAX(pos_r), 0) + 1 FROM VARIABLE WHERE tab='ENTRETIEN' AND rubrique=%s", (id_rubrique,))
+                new_pos_r = cur.fetchone()[0]
+
+                # --- CORRECTION DATES & CONTRAINTES ---
+                today = datetime.date.today()
+                current_month_int = int(today.strftime('%y%m')) # Ex: 2601
+                end_month_infinite = 9999 
+                est_contrainte_val = False # Valeur par défaut : pas de contrainte
+
+                # Ajout de la colonne 'est_contrainte' dans l'INSERT
+                cur.execute("""
+                    INSERT INTO VARIABLE (tab, pos, lib, type_v, rubrique, pos_r, commentaire, mois_debut_validite, mois_fin_validite, est_contrainte)
+                    VALUES ('ENTRETIEN', %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                """, (new_pos, safe_col_name, type_var, id_rubrique, new_pos_r, label_ui, current_month_int, end_month_infinite, est_contrainte_val))
+
+                # 3. INSERT INTO MODALITE
+                if type_var == 'MOD' and modalites_initiales:
+                    for i, mod_label in enumerate(modalites_initiales):
+                        code_mod = str(i + 1)
+                        cur.execute("""
+                            INSERT INTO MODALITE (tab, pos, code, lib_m, pos_m)
+                            VALUES ('ENTRETIEN', %s, %s, %s, %s)
+                        """, (new_pos, code_mod, mod_label, i+1))
+
+                _bump_metadata_version(cur)
+                conn.commit()
+                invalidate_metadata_cache()
+                return True
+        except Exception as e:
+            conn.rollback()
+            raise e
 
 def add_new_modality_db(variable_pos, new_label):
-    conn = get_db_connection()
-    try:
-        with conn.cursor() as cur:
-            cur.execute("SELECT COALESCE(MAX(pos_m), 0) + 1 FROM MODALITE WHERE tab='ENTRETIEN' AND pos=%s", (variable_pos,))
-            new_pos_m = cur.fetchone()[0]
-            new_code = str(new_pos_m)
+    with db_connection() as conn:
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT COALESCE(MAX(pos_m), 0) + 1 FROM MODALITE WHERE tab='ENTRETIEN' AND pos=%s", (variable_pos,))
+                new_pos_m = cur.fetchone()[0]
+                new_code = str(new_pos_m)
 
-            cur.execute("""
-                INSERT INTO MODALITE (tab, pos, code, lib_m, pos_m)
-                VALUES ('ENTRETIEN', %s, %s, %s, %s)
-            """, (variable_pos, new_code, new_label, new_pos_m))
-            
-            conn.commit()
-    except Exception as e:
-        if conn: conn.rollback()
-        raise e
-    finally:
-        if conn: conn.close()
+                cur.execute("""
+                    INSERT INTO MODALITE (tab, pos, code, lib_m, pos_m)
+                    VALUES ('ENTRETIEN', %s, %s, %s, %s)
+                """, (variable_pos, new_code, new_label, new_pos_m))
+
+                _bump_metadata_version(cur)
+                conn.commit()
+                invalidate_metadata_cache()
+        except Exception as e:
+            conn.rollback()
+            raise e
 
 # --- ANALYSE ET EXPORT ---
 
-def get_translation_dictionary():
-    conn = get_db_connection()
-    transco = {}
-    try:
+def _load_translation_dictionaries():
+    """Tous les transcodages (ENTRETIEN + natures DEMANDE/SOLUTION) en une seule requête"""
+    transco = {"ENTRETIEN": {}, "DEMANDE": {"nature": {}}, "SOLUTION": {"nature": {}}}
+    with db_connection() as conn:
         with conn.cursor() as cur:
-            cur.execute("SELECT pos, lib, type_v FROM VARIABLE WHERE tab = 'ENTRETIEN' AND (type_v = 'MOD' OR type_v = 'CHAINE')")
-            vars_rows = cur.fetchall()
-            for pos, col_name, type_v in vars_rows:
-                col_key = col_name.lower()
-                transco[col_key] = {}
-                if type_v == 'MOD':
-                    cur.execute("SELECT code, lib_m FROM MODALITE WHERE tab='ENTRETIEN' AND pos=%s", (pos,))
-                    for code, lib in cur.fetchall():
-                        try: key_val = int(code)
-                        except ValueError: key_val = code
-                        transco[col_key][key_val] = lib
-                        transco[col_key][str(key_val)] = lib
-        return transco
+            cur.execute("""
+                SELECT v.tab, v.lib, m.code, m.lib_m, m.pos_m
+                FROM VARIABLE v
+                LEFT JOIN MODALITE m ON m.tab = v.tab AND m.pos = v.pos AND v.type_v = 'MOD'
+                WHERE v.tab = 'ENTRETIEN' AND (v.type_v = 'MOD' OR v.type_v = 'CHAINE')
+                UNION ALL
+                SELECT m.tab, 'NATURE', m.code, m.lib_m, m.pos_m
+                FROM MODALITE m
+                WHERE m.tab IN ('DEMANDE', 'SOLUTION') AND m.pos = 3
+                ORDER BY 1, 2, 5
+            """)
+            for tab, col_name, code, lib, _ in cur.fetchall():
+                col_map = transco.setdefault(tab, {}).setdefault(col_name.lower(), {})
+                if code is None:
+                    continue
+                try: key_val = int(code)
+                except ValueError: key_val = code
+                col_map[key_val] = lib
+                col_map[str(key_val)] = lib
+    return transco
+
+def get_translation_dictionary(table_name='ENTRETIEN'):
+    """Transcodage {colonne: {code: libellé}} d'une table (ENTRETIEN, DEMANDE ou SOLUTION)"""
+    try:
+        return _get_cached_metadata(
+            "transco",
+            _load_translation_dictionaries,
+            select=lambda transco: transco.get(table_name, {})
+        )
     except Exception:
         return {}
-    finally:
-        if conn: conn.close()
 
-def get_recent_dossiers_list(limit=50):
-    conn = get_db_connection()
-    try:
+# --- AGRÉGATS CÔTÉ SERVEUR (page Analyse) ---
+
+# Dimensions calculées disponibles en plus des colonnes de ENTRETIEN
+DIMENSIONS_CALCULEES = {"mois": "TO_CHAR(date_ent, 'YYYY-MM')"}
+
+def _load_colonnes_entretien():
+    with db_connection() as conn:
         with conn.cursor() as cur:
-            cur.execute("SELECT num, date_ent FROM ENTRETIEN ORDER BY date_ent DESC, num DESC LIMIT %s", (limit,))
-            return cur.fetchall()
+            cur.execute("""
+                SELECT lower(column_name) FROM information_schema.columns
+                WHERE lower(table_name) = 'entretien' ORDER BY ordinal_position
+            """)
+            return [row[0] for row in cur.fetchall()]
+
+def get_colonnes_entretien():
+    """Colonnes de ENTRETIEN (en minuscules), relues quand l'administration en ajoute une"""
+    return _get_cached_metadata("colonnes_entretien", _load_colonnes_entretien)
+
+def _expression_dimension(nom, colonnes):
+    """Expression SQL d'une dimension ; seules les colonnes connues sont acceptées"""
+    nom = nom.lower()
+    if nom in DIMENSIONS_CALCULEES:
+        return DIMENSIONS_CALCULEES[nom]
+    if nom in colonnes:
+        return nom
+    raise ValueError(f"Colonne inconnue : {nom}")
+
+def _clause_filtres(filtres, colonnes):
+    """
+    WHERE à partir de {colonne: [valeurs]} ; None dans la liste désigne les valeurs vides.
+    Comparaison sur la forme texte des codes (1, 1.0 et '1' désignent la même modalité).
+    """
+    conditions, params = [], {}
+    for i, (col, valeurs) in enumerate((filtres or {}).items()):
+        if not valeurs:
+            continue
+        expr = _expression_dimension(col, colonnes)
+        non_vides = [normaliser_code(v) for v in valeurs if normaliser_code(v) is not None]
+        options = []
+        if non_vides:
+            params[f"f{i}"] = non_vides
+            options.append(f"{expr}::TEXT = ANY(%(f{i})s)")
+        if len(non_vides) < len(valeurs):
+            options.append(f"{expr} IS NULL")
+        conditions.append("(" + " OR ".join(options) + ")")
+    return (" WHERE " + " AND ".join(conditions) if conditions else ""), params
+
+def _load_stat_disponible():
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT to_regclass('stat_mensuelle') IS NOT NULL")
+            return cur.fetchone()[0]
+
+def _stat_disponible():
+    """La base possède-t-elle les agrégats mensuels (agregats.py) ?"""
+    try:
+        return _get_cached_metadata("stat_mensuelle", _load_stat_disponible)
     except Exception:
+        return False
+
+def _aggregat_stat(dimensions, colonnes):
+    """
+    Répartition lue dans STAT_MENSUELLE (sans filtre, au plus 'mois' + une variable) ;
+    None si la demande ne correspond pas à un agrégat tenu à jour.
+    """
+    variables = [d for d in dimensions if d != "mois"]
+    if len(variables) > 1 or len(dimensions) != len(set(dimensions)):
+        return None
+    if variables and (variables[0] in ("num", "date_ent") or variables[0] not in colonnes):
+        return None
+
+    variable = variables[0] if variables else "*"
+    select = []
+    for dim in dimensions:
+        select.append("NULLIF(mois, '') AS mois" if dim == "mois" else f"NULLIF(code, '') AS {dim}")
+    query = f"""
+        SELECT {', '.join(select + ['COALESCE(SUM(nb), 0) AS nb'])}
+        FROM STAT_MENSUELLE
+        WHERE tab = 'ENTRETIEN' AND variable = %(variable)s
+    """
+    if dimensions:
+        positions = ", ".join(str(i) for i in range(1, len(dimensions) + 1))
+        query += f" GROUP BY {positions} HAVING SUM(nb) > 0 ORDER BY {positions}"
+    return get_pandas_data(query, {"variable": variable})
+
+def get_aggregat(dimensions, filtres=None):
+    """
+    Nombre d'entretiens (colonne nb) par combinaison des `dimensions`, calculé par PostgreSQL :
+    seules les lignes agrégées sont transférées. Sans dimension : une ligne, le total.
+    Sans filtre, les répartitions par mois et/ou par variable viennent de STAT_MENSUELLE.
+    """
+    colonnes = get_colonnes_entretien()
+    dimensions = [d.lower() for d in dimensions]
+    expressions = [_expression_dimension(d, colonnes) for d in dimensions]
+    where, params = _clause_filtres(filtres, colonnes)
+
+    if not where and _stat_disponible():
+        data = _aggregat_stat(dimensions, colonnes)
+        if data is not None:
+            return data
+
+    select = [f"{expr} AS {dim}" for expr, dim in zip(expressions, dimensions)]
+    query = f"SELECT {', '.join(select + ['COUNT(*) AS nb'])} FROM ENTRETIEN{where}"
+    if dimensions:
+        positions = ", ".join(str(i) for i in range(1, len(dimensions) + 1))
+        query += f" GROUP BY {positions} ORDER BY {positions}"
+    return get_pandas_data(query, params or None)
+
+def get_mois_disponibles():
+    """Mois (YYYY-MM) ayant au moins un entretien, du plus récent au plus ancien"""
+    if _stat_disponible():
+        query = """
+            SELECT mois FROM STAT_MENSUELLE
+            WHERE tab = 'ENTRETIEN' AND variable = '*' AND nb > 0 AND mois <> ''
+            ORDER BY mois DESC
+        """
+    else:
+        # Sans agrégats : un saut d'index par mois (IDX_ENTRETIEN_DATE_ENT) au lieu d'un parcours complet
+        query = """
+            WITH RECURSIVE m AS (
+                SELECT date_trunc('month', MIN(date_ent))::date AS debut FROM ENTRETIEN
+                UNION ALL
+                SELECT (SELECT date_trunc('month', MIN(date_ent))::date FROM ENTRETIEN
+                        WHERE date_ent >= (m.debut + INTERVAL '1 month')::date)
+                FROM m WHERE m.debut IS NOT NULL
+            )
+            SELECT TO_CHAR(debut, 'YYYY-MM') AS mois FROM m WHERE debut IS NOT NULL ORDER BY mois DESC
+        """
+    df = get_pandas_data(query)
+    if df.empty:
         return []
-    finally:
-        if conn: conn.close()
+    return df['mois'].tolist()
+
+def _mois_suivant(jour):
+    return datetime.date(jour.year + jour.month // 12, jour.month % 12 + 1, 1)
+
+def plages_mois(mois):
+    """Mois 'YYYY-MM' -> intervalles de dates [début, fin[, les mois consécutifs étant fusionnés"""
+    debuts = sorted({datetime.date(int(m[:4]), int(m[5:7]), 1) for m in mois})
+    plages = []
+    for debut in debuts:
+        if plages and plages[-1][1] == debut:
+            plages[-1][1] = _mois_suivant(debut)
+        else:
+            plages.append([debut, _mois_suivant(debut)])
+    return [tuple(p) for p in plages]
+
+def clause_plages_dates(colonne, plages):
+    """
+    Condition (colonne >= début AND colonne < fin) OR ... et ses paramètres :
+    contrairement à TO_CHAR(colonne, ...) = ..., elle se résout par un parcours d'index.
+    """
+    conditions, params = [], {}
+    for i, (debut, fin) in enumerate(plages):
+        conditions.append(f"({colonne} >= %(debut_{i})s AND {colonne} < %(fin_{i})s)")
+        params[f"debut_{i}"] = debut
+        params[f"fin_{i}"] = fin
+    return " OR ".join(conditions) or "FALSE", params
+
+def requete_export_mois(mois, colonnes="*", limite=None):
+    """SELECT des entretiens des mois choisis, plus récents d'abord : (requête, paramètres)"""
+    condition, params = clause_plages_dates("date_ent", plages_mois(mois))
+    query = f"SELECT {colonnes} FROM ENTRETIEN WHERE {condition} ORDER BY date_ent DESC"
+    if limite is not None:
+        query += " LIMIT %(limite)s"
+        params["limite"] = int(limite)
+    return query, params
+
+def get_entretiens_mois(mois, limite=None):
+    query, params = requete_export_mois(mois, limite=limite)
+    return get_pandas_data(query, params)
+
+def _ajouter_variable_stat(cur, variable):
+    """Nouvelle colonne de ENTRETIEN : toutes les lignes existantes comptent comme non renseignées"""
+    cur.execute("SELECT to_regclass('stat_mensuelle') IS NOT NULL")
+    if cur.fetchone()[0]:
+        cur.execute("""
+            INSERT INTO STAT_MENSUELLE (mois, tab, variable, code, nb)
+            SELECT mois, tab, %s, '', nb FROM STAT_MENSUELLE
+            WHERE tab = 'ENTRETIEN' AND variable = '*'
+            ORDER BY mois
+            ON CONFLICT DO NOTHING
+        """, (variable,))
+
+def reconstruire_stat_mensuelle():
+    """
+    Recalcule les agrégats mensuels depuis les données (bouton de l'administration).
+    Installe d'abord table, fonctions et triggers s'ils manquent (base antérieure aux agrégats).
+    """
+    with db_connection() as conn:
+        try:
+            with conn.cursor() as cur:
+                installe = installer_agregats(cur)
+                if installe:
+                    # Les autres instances doivent relire _stat_disponible
+                    _bump_metadata_version(cur)
+                else:
+                    reconstruire_agregats(cur)
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            raise e
+    if installe:
+        invalidate_metadata_cache()
+
+def get_signature_mois(mois):
+    """
+    État des mois choisis pour le cache des exports : (entretiens, demandes, solutions des mois,
+    modifications + suppressions cumulées des trois tables). Le premier terme sert aussi
+    de total pour la progression.
+    """
+    mois = sorted(set(mois))
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            if _stat_disponible():
+                cur.execute("""
+                    SELECT COALESCE(SUM(nb) FILTER (WHERE tab = 'ENTRETIEN'), 0),
+                           COALESCE(SUM(nb) FILTER (WHERE tab = 'DEMANDE'), 0),
+                           COALESCE(SUM(nb) FILTER (WHERE tab = 'SOLUTION'), 0)
+                    FROM STAT_MENSUELLE WHERE variable = '*' AND mois = ANY(%s)
+                """, (mois,))
+                comptes = tuple(int(n) for n in cur.fetchone())
+            else:
+                condition, params = clause_plages_dates("date_ent", plages_mois(mois))
+                cur.execute(f"SELECT COUNT(*), MAX(num) FROM ENTRETIEN WHERE {condition}", params)
+                comptes = cur.fetchone()
+            return comptes + (_compteur_modifications(cur, ["ENTRETIEN", "DEMANDE", "SOLUTION"]),)
+
+# --- JEU DE DONNÉES DÉTAILLÉ (rafraîchi par deltas) ---
+
+def _compteur_modifications(cur, tables):
+    """
+    Mises à jour + suppressions cumulées des tables : lues dans STAT_MODIFICATIONS,
+    incrémenté par les triggers dans la transaction même (visible au commit).
+    Base sans ce marqueur : statistiques du serveur, mises à jour en différé et remises
+    à zéro par pg_stat_reset() ou un arrêt brutal ; une modification toute récente peut
+    alors rester invisible jusqu'au changement suivant (Administration : recalcul des
+    statistiques mensuelles pour installer le marqueur).
+    """
+    cur.execute("SELECT to_regclass('stat_modifications') IS NOT NULL")
+    if cur.fetchone()[0]:
+        cur.execute(
+            "SELECT COALESCE(SUM(nb), 0) FROM STAT_MODIFICATIONS WHERE tab = ANY(%s)",
+            ([t.upper() for t in tables],)
+        )
+    else:
+        cur.execute(
+            "SELECT COALESCE(SUM(n_tup_upd + n_tup_del), 0) FROM pg_stat_user_tables WHERE relname = ANY(%s)",
+            ([t.lower() for t in tables],)
+        )
+    return int(cur.fetchone()[0])
+
+def get_entretien_signature():
+    """
+    État de ENTRETIEN pour le cache détaillé : (NUM max, nombre de lignes,
+    modifications + suppressions cumulées).
+    """
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT MAX(num), COUNT(*) FROM ENTRETIEN")
+            max_num, nb = cur.fetchone()
+            return max_num, nb, _compteur_modifications(cur, ["ENTRETIEN"])
+
+def get_entretiens_depuis(num_min=None):
+    """Lignes de ENTRETIEN de NUM supérieur à `num_min` (toutes si None)"""
+    if num_min is None:
+        return get_pandas_data("SELECT * FROM ENTRETIEN ORDER BY date_ent")
+    return get_pandas_data(
+        "SELECT * FROM ENTRETIEN WHERE num > %(num)s ORDER BY date_ent", {"num": num_min}
+    )
+
+def get_recent_dossiers_list(limit=50):
+    with db_connection() as conn:
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT num, date_ent FROM ENTRETIEN ORDER BY date_ent DESC, num DESC LIMIT %s", (limit,))
+                return cur.fetchall()
+        except Exception:
+            return []
 
 def get_dossier_complete_data(num_dossier):
-    df_ent = get_pandas_data("SELECT * FROM ENTRETIEN WHERE num = %(num)s", params={"num": num_dossier})
-    df_dem = get_pandas_data("SELECT * FROM DEMANDE WHERE num = %(num)s ORDER BY pos", params={"num": num_dossier})
-    df_sol = get_pandas_data("SELECT * FROM SOLUTION WHERE num = %(num)s ORDER BY pos", params={"num": num_dossier})
-    return df_ent, df_dem, df_sol
\ No newline at end of file
+    """Les trois tables du dossier, lues sur une seule connexion du moteur partagé"""
+    params = {"num": num_dossier}
+    try:
+        with get_engine().connect() as conn:
+            df_ent = pd.read_sql("SELECT * FROM ENTRETIEN WHERE num = %(num)s", conn, params=params)
+            df_dem = pd.read_sql("SELECT * FROM DEMANDE WHERE num = %(num)s ORDER BY pos", conn, params=params)
+            df_sol = pd.read_sql("SELECT * FROM SOLUTION WHERE num = %(num)s ORDER BY pos", conn, params=params)
+            return df_ent, df_dem, df_sol
+    except Exception as e:
+        print(f"Erreur SQL (Pandas) : {e}")
+        return pd.DataFrame(), pd.DataFrame(), pd.DataFrame()
@@ -1,24 +1,75 @@
+import os
+import gzip
 import psycopg2
 import pandas as pd
+from moteur_export import SQL_DOSSIERS, lots_curseur_serveur, ecrire_colonnes_flux
+
+# Formats colonnes : chaque lot lu en base devient un row group (Parquet) ou un batch (Arrow)
+FORMATS_COLONNES = {".parquet": "parquet", ".arrows": "arrow"}
+
+def colonnes_entretien(conn):
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT lower(column_name) FROM information_schema.columns
+            WHERE lower(table_name) = 'entretien' ORDER BY ordinal_position
+        """)
+        return [row[0] for row in cur.fetchall()]
+
+def valider_colonne_date(conn, colonne_date: str):
+    """La colonne est insérée telle quelle dans le SQL : seules les colonnes de ENTRETIEN sont acceptées"""
+    colonne = str(colonne_date).strip().lower()
+    if colonne not in colonnes_entretien(conn):
+        raise ValueError(f"Colonne inconnue dans ENTRETIEN : {colonne_date!r}")
+    return colonne
+
+def ouvrir_sortie(fichier: str):
+    """Fichier binaire de sortie, compressé en gzip si son nom finit par .gz"""
+    if str(fichier).endswith(".gz"):
+        return gzip.open(fichier, "wb")
+    return open(fichier, "wb")
 
 def export_entretien(
     conn_params: dict,
     date_debut,
     date_fin,
     colonne_date: str,
-    fichier_csv: str
+    fichier_csv: str,
+    flux: bool = False
 ):
     conn = psycopg2.connect(**conn_params)
+    try:
+        colonne_date = valider_colonne_date(conn, colonne_date)
+
+        query = f"""
+        SELECT *
+        FROM entretien
+        WHERE {colonne_date} BETWEEN %s AND %s
+        ORDER BY {colonne_date}
+        """
 
-    query = f"""
-    SELECT *
-    FROM entretien
-    WHERE {colonne_date} BETWEEN %s AND %s
-    ORDER BY {colonne_date}
-    """
+        format_colonnes = FORMATS_COLONNES.get(os.path.splitext(str(fichier_csv))[1].lower())
+        if format_colonnes:
+            # Parquet / Arrow : types conservés, demandes et solutions en colonnes liste
+            query = SQL_DOSSIERS.format(condition=f"e.{colonne_date} BETWEEN %s AND %s", ordre=f"e.{colonne_date}")
+            with open(fichier_csv, "wb") as sortie:
+                return ecrire_colonnes_flux(
+                    lots_curseur_serveur(conn, query, (date_debut, date_fin), types=True), sortie, format=format_colonnes
+                )
 
-    df = pd.read_sql(query, conn, params=(date_debut, date_fin))
-    df.to_csv(fichier_csv, index=False, encoding="utf-8")
+        if flux:
+            # COPY ... TO STDOUT écrit directement dans le fichier, sans DataFrame.
+            # COPY n'accepte pas de paramètres : les dates sont liées par mogrify.
+            # ENCODING : UTF-8 comme le mode pandas, quel que soit le client_encoding de la connexion
+            with conn.cursor() as cur:
+                copie = "COPY ({}) TO STDOUT WITH (FORMAT CSV, HEADER, ENCODING 'UTF8')".format(
+                    cur.mogrify(query, (date_debut, date_fin)).decode()
+                )
+                with ouvrir_sortie(fichier_csv) as sortie:
+                    cur.copy_expert(copie, sortie)
+                return cur.rowcount
 
-    conn.close()
-    return len(df)
+        df = pd.read_sql(query, conn, params=(date_debut, date_fin))
+        df.to_csv(fichier_csv, index=False, encoding="utf-8")
+        return len(df)
+    finally:
+        conn.close()
@@ -0,0 +1,218 @@
+# file_attente.py
+# -*- coding: utf-8 -*-
+"""
+File d'attente locale des dossiers saisis (journal SQLite, écrit avant toute réponse).
+L'accueil rend la main immédiatement avec une référence provisoire ; un thread
+d'arrière-plan écrit ensuite les dossiers dans PostgreSQL, par lots, avec reprises.
+"""
+import os
+import json
+import uuid
+import sqlite3
+import datetime
+import threading
+
+from database import save_entretiens_lot, ensure_entretien_source
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# SAISIE_ASYNC=1 : l'accueil passe par la file (sinon écriture directe en base)
+SAISIE_ASYNC = os.getenv("SAISIE_ASYNC", "0") == "1"
+# Un journal par instance de l'application (un seul écrivain par fichier)
+CHEMIN_JOURNAL = os.getenv("SAISIE_JOURNAL", os.path.join(BASE_DIR, "data", "file_saisie.sqlite3"))
+TAILLE_LOT = int(os.getenv("SAISIE_TAILLE_LOT", "50"))
+# Attente entre deux essais quand la base ne répond pas : doublée à chaque échec, plafonnée
+DELAI_REPRISE_MIN = 1.0
+DELAI_REPRISE_MAX = float(os.getenv("SAISIE_DELAI_MAX", "60"))
+# Dossiers écrits en base : contenu vidé aussitôt, ligne gardée ce délai pour afficher le n° définitif
+CONSERVATION_HEURES = float(os.getenv("SAISIE_CONSERVATION_HEURES", "24"))
+
+SQL_JOURNAL = """
+CREATE TABLE IF NOT EXISTS dossier (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    cle TEXT NOT NULL UNIQUE,
+    recu_le TEXT NOT NULL,
+    date_ent TEXT NOT NULL,
+    contenu TEXT NOT NULL,
+    statut TEXT NOT NULL DEFAULT 'attente',
+    num INTEGER,
+    tentatives INTEGER NOT NULL DEFAULT 0,
+    erreur TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_dossier_statut ON dossier(statut, id);
+"""
+
+_ecrivain = None
+_ecrivain_lock = threading.Lock()
+_reveil = threading.Event()
+
+
+def _journal():
+    """Connexion au journal (une par appel : sqlite3 ne se partage pas entre threads)"""
+    dossier = os.path.dirname(CHEMIN_JOURNAL)
+    if dossier:
+        os.makedirs(dossier, exist_ok=True)
+    conn = sqlite3.connect(CHEMIN_JOURNAL, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    # Le dossier est sur disque avant que l'accueil n'affiche sa référence
+    conn.execute("PRAGMA synchronous=FULL")
+    conn.executescript(SQL_JOURNAL)
+    return conn
+
+
+def reference_provisoire(id_journal):
+    return f"P-{id_journal}"
+
+
+def mettre_en_file(data_entretien, liste_demandes, liste_solutions):
+    """Enregistre le dossier dans le journal local ; renvoie sa référence provisoire"""
+    contenu = json.dumps({
+        "data": data_entretien,
+        "demandes": list(liste_demandes),
+        "solutions": list(liste_solutions)
+    })
+    maintenant = datetime.datetime.now()
+    conn = _journal()
+    try:
+        with conn:
+            # Date de l'entretien = jour de la saisie, même si l'écriture en base a lieu plus tard
+            cur = conn.execute(
+                "INSERT INTO dossier (cle, recu_le, date_ent, contenu) VALUES (?, ?, ?, ?)",
+                (f"saisie:{uuid.uuid4().hex}", maintenant.isoformat(timespec="seconds"),
+                 maintenant.date().isoformat(), contenu)
+            )
+            id_journal = cur.lastrowid
+    finally:
+        conn.close()
+
+    demarrer_ecrivain()
+    _reveil.set()
+    return reference_provisoire(id_journal)
+
+
+def vider_file(taille_lot=TAILLE_LOT):
+    """
+    Écrit en base les dossiers en attente, un lot à la fois ; renvoie le nombre traité.
+    Une erreur de connexion laisse le lot en attente (compteur de tentatives incrémenté) et remonte.
+    """
+    conn = _journal()
+    total = 0
+    try:
+        while True:
+            lignes = conn.execute(
+                "SELECT id, cle, date_ent, contenu FROM dossier WHERE statut = 'attente' ORDER BY id LIMIT ?",
+                (taille_lot,)
+            ).fetchall()
+            if not lignes:
+                return total
+
+            dossiers = []
+            for id_journal, cle, date_ent, contenu in lignes:
+                valeurs = json.loads(contenu)
+                dossiers.append({
+                    "cle": cle,
+                    "data": valeurs["data"],
+                    "demandes": valeurs["demandes"],
+                    "solutions": valeurs["solutions"],
+                    "date_ent": datetime.date.fromisoformat(date_ent)
+                })
+
+            try:
+                resultats = save_entretiens_lot(dossiers)
+            except Exception as e:
+                with conn:
+                    conn.execute(
+                        f"UPDATE dossier SET tentatives = tentatives + 1, erreur = ? "
+                        f"WHERE id IN ({', '.join('?' * len(lignes))})",
+                        [str(e).strip()] + [ligne[0] for ligne in lignes]
+                    )
+                raise
+
+            with conn:
+                for id_journal, cle, _, _ in lignes:
+                    resultat = resultats.get(cle)
+                    if isinstance(resultat, Exception):
+                        conn.execute(
+                            "UPDATE dossier SET statut = 'rejete', tentatives = tentatives + 1, erreur = ? WHERE id = ?",
+                            (str(resultat).strip(), id_journal)
+                        )
+                    else:
+                        conn.execute(
+                            "UPDATE dossier SET statut = 'enregistre', num = ?, erreur = NULL, contenu = '' WHERE id = ?",
+                            (resultat, id_journal)
+                        )
+            total += len(lignes)
+    finally:
+        conn.close()
+
+
+def purger_journal(conservation_heures=None):
+    """Supprime les dossiers écrits en base depuis plus de `conservation_heures` ; renvoie leur nombre"""
+    conservation_heures = CONSERVATION_HEURES if conservation_heures is None else conservation_heures
+    limite = datetime.datetime.now() - datetime.timedelta(hours=conservation_heures)
+    conn = _journal()
+    try:
+        with conn:
+            cur = conn.execute(
+                "DELETE FROM dossier WHERE statut = 'enregistre' AND recu_le <= ?",
+                (limite.isoformat(timespec="seconds"),)
+            )
+        return cur.rowcount
+    finally:
+        conn.close()
+
+
+def _boucle_ecrivain():
+    delai = DELAI_REPRISE_MIN
+    base_prete = False
+    while True:
+        _reveil.clear()
+        try:
+            # ENTRETIEN_SOURCE peut manquer sur une base existante : tant qu'elle n'est pas
+            # créée, rien n'est écrit (la base peut être indisponible au démarrage)
+            if not base_prete:
+                ensure_entretien_source()
+                base_prete = True
+            vider_file()
+            purger_journal()
+            delai = DELAI_REPRISE_MIN
+            # Rien en attente : on dort jusqu'à la prochaine saisie (ou un contrôle périodique)
+            _reveil.wait(DELAI_REPRISE_MAX)
+        except Exception as e:
+            print(f"Base indisponible, nouvel essai dans {delai:.0f} s : {e}")
+            _reveil.wait(delai)
+            delai = min(delai * 2, DELAI_REPRISE_MAX)
+
+
+def demarrer_ecrivain():
+    """Démarre (une fois par processus) le thread qui vide la file vers PostgreSQL"""
+    global _ecrivain
+    if _ecrivain is None or not _ecrivain.is_alive():
+        with _ecrivain_lock:
+            if _ecrivain is None or not _ecrivain.is_alive():
+                _ecrivain = threading.Thread(target=_boucle_ecrivain, name="ecrivain-saisie", daemon=True)
+                _ecrivain.start()
+    return _ecrivain
+
+
+def etat_dossiers(references):
+    """{référence provisoire: (statut, NUM définitif ou None, erreur)}"""
+    ids = [int(r.split("-", 1)[1]) for r in references]
+    if not ids:
+        return {}
+    conn = _journal()
+    try:
+        lignes = conn.execute(
+            f"SELECT id, statut, num, erreur FROM dossier WHERE id IN ({', '.join('?' * len(ids))})", ids
+        ).fetchall()
+    finally:
+        conn.close()
+    return {reference_provisoire(i): (statut, num, erreur) for i, statut, num, erreur in lignes}
+
+
+def nb_en_attente():
+    conn = _journal()
+    try:
+        return conn.execute("SELECT COUNT(*) FROM dossier WHERE statut = 'attente'").fetchone()[0]
+    finally:
+        conn.close()
@@ -0,0 +1,305 @@
+# moteur_export.py
+# -*- coding: utf-8 -*-
+"""
+Moteur des exports en flux : lecture par lots depuis un curseur côté serveur et
+écriture au fil de l'eau en Excel (xlsxwriter constant_memory), Parquet ou Arrow.
+Aucune dépendance à database.py : la connexion et les requêtes sont fournies par l'appelant.
+"""
+import tempfile
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import xlsxwriter
+from transcodage import normaliser_code, transcoder_dataframe, transcoder_serie
+
+# Lignes lues par aller-retour avec le curseur côté serveur
+TAILLE_LOT_EXPORT = 5000
+# Lignes du premier lot servant à estimer la largeur des colonnes
+LIGNES_ECHANTILLON = 1000
+LARGEUR_MAX = 60
+# Classeur gardé en mémoire jusqu'à cette taille, puis dans un fichier temporaire
+TAILLE_SPOOL = 16 * 1024 * 1024
+# Limite d'une feuille Excel (en-tête compris)
+XLSX_MAX_LIGNES = 1048576
+
+# Types PostgreSQL (OID) -> types Arrow ; les autres types sont exportés en texte
+TYPES_ARROW = {
+    16: pa.bool_(),
+    20: pa.int64(),
+    21: pa.int16(),
+    23: pa.int32(),
+    700: pa.float32(),
+    701: pa.float64(),
+    1082: pa.date32(),
+    1114: pa.timestamp("us"),
+    1005: pa.list_(pa.int16()),
+    1007: pa.list_(pa.int32()),
+    1009: pa.list_(pa.string()),
+    1015: pa.list_(pa.string()),
+}
+# Colonne transcodée : chaque libellé n'est stocké qu'une fois par row group
+TYPE_LIBELLE = pa.dictionary(pa.int32(), pa.string())
+
+# Demandes et solutions d'un entretien en colonnes liste (codes dans l'ordre des positions)
+SQL_DOSSIERS = """
+SELECT e.*, COALESCE(d.codes, '{{}}') AS demandes, COALESCE(s.codes, '{{}}') AS solutions
+FROM ENTRETIEN e
+LEFT JOIN LATERAL (SELECT array_agg(nature ORDER BY pos) AS codes FROM DEMANDE WHERE num = e.num) d ON TRUE
+LEFT JOIN LATERAL (SELECT array_agg(nature ORDER BY pos) AS codes FROM SOLUTION WHERE num = e.num) s ON TRUE
+WHERE {condition}
+ORDER BY {ordre}
+"""
+
+# Libellés des natures (DEMANDE / SOLUTION) lus dans MODALITE, un par code (le premier dans
+# l'ordre pos_m), joints en une fois aux lignes filles ; le code tel quel s'il n'y figure pas.
+# NATURE est VARCHAR dans creation_base.py et INTEGER dans certaines bases : comparaison en texte.
+CTE_LIBELLES_NATURE = """lib AS (
+    SELECT DISTINCT ON (m.tab, TRIM(m.code::text)) m.tab, TRIM(m.code::text) AS code, m.lib_m
+    FROM MODALITE m
+    WHERE m.tab IN ({tables}) AND m.pos = 3
+    ORDER BY m.tab, TRIM(m.code::text), m.pos_m
+)"""
+
+# Dossier complet sur une ligne : codes et libellés des demandes et solutions agrégés par NUM
+SQL_DOSSIERS_DENORMALISES = """
+WITH {libelles}
+SELECT e.*,
+       d.codes AS demandes_codes, d.libelles AS demandes_libelles,
+       s.codes AS solutions_codes, s.libelles AS solutions_libelles
+FROM ENTRETIEN e
+LEFT JOIN LATERAL (
+    SELECT string_agg(t.nature::text, ' ; ' ORDER BY t.pos) AS codes,
+           string_agg(COALESCE(l.lib_m, t.nature::text), ' ; ' ORDER BY t.pos) AS libelles
+    FROM DEMANDE t
+    LEFT JOIN lib l ON l.tab = 'DEMANDE' AND l.code = TRIM(t.nature::text)
+    WHERE t.num = e.num
+) d ON TRUE
+LEFT JOIN LATERAL (
+    SELECT string_agg(t.nature::text, ' ; ' ORDER BY t.pos) AS codes,
+           string_agg(COALESCE(l.lib_m, t.nature::text), ' ; ' ORDER BY t.pos) AS libelles
+    FROM SOLUTION t
+    LEFT JOIN lib l ON l.tab = 'SOLUTION' AND l.code = TRIM(t.nature::text)
+    WHERE t.num = e.num
+) s ON TRUE
+WHERE {condition}
+ORDER BY {ordre}
+"""
+
+# Une ligne par demande (ou solution) des entretiens retenus, pour les feuilles de détail
+SQL_DETAIL_DOSSIERS = """
+WITH {libelles}
+SELECT t.num, t.pos, t.nature::text AS code, COALESCE(l.lib_m, t.nature::text) AS libelle
+FROM {table} t
+JOIN ENTRETIEN e ON e.num = t.num
+LEFT JOIN lib l ON l.code = TRIM(t.nature::text)
+WHERE {condition}
+ORDER BY {ordre}, t.num, t.pos
+"""
+
+def requete_dossiers_denormalises(condition, ordre):
+    """SQL_DOSSIERS_DENORMALISES avec les libellés des deux tables"""
+    return SQL_DOSSIERS_DENORMALISES.format(
+        libelles=CTE_LIBELLES_NATURE.format(tables="'DEMANDE', 'SOLUTION'"),
+        condition=condition,
+        ordre=ordre
+    )
+
+def requete_detail_dossiers(table, condition, ordre):
+    """SQL_DETAIL_DOSSIERS pour DEMANDE ou SOLUTION"""
+    return SQL_DETAIL_DOSSIERS.format(
+        table=table, libelles=CTE_LIBELLES_NATURE.format(tables=f"'{table}'"), condition=condition, ordre=ordre
+    )
+
+def lots_curseur_serveur(conn, query, params=None, taille_lot: int = TAILLE_LOT_EXPORT, types: bool = False,
+                         progression=None):
+    """
+    Rend (colonnes, lignes) par lots depuis un curseur nommé : le résultat n'est jamais entier en mémoire.
+    types=True : colonnes en (nom, OID du type PostgreSQL).
+    progression : appelée avec le nombre de lignes de chaque lot lu.
+    """
+    with conn.cursor(name="export_flux") as cur:
+        cur.itersize = taille_lot
+        cur.execute(query, params)
+        premier = True
+        while True:
+            lignes = cur.fetchmany(taille_lot)
+            # Résultat vide : un lot sans ligne, pour que le fichier ait quand même ses colonnes
+            if not lignes and not (premier and cur.description):
+                break
+            premier = False
+            if progression is not None:
+                progression(len(lignes))
+            if types:
+                yield [(d[0].lower(), d[1]) for d in cur.description], lignes
+            else:
+                yield [d[0].lower() for d in cur.description], lignes
+            if not lignes:
+                break
+
+def largeurs_colonnes(df: pd.DataFrame):
+    """Largeur d'affichage par colonne, estimée sur un échantillon"""
+    largeurs = []
+    for col in df.columns:
+        contenu = df[col].dropna().astype(str).map(len).max() if len(df) else 0
+        largeurs.append(min(max(contenu if pd.notna(contenu) else 0, len(col)) + 2, LARGEUR_MAX))
+    return largeurs
+
+def ecrire_feuille_flux(workbook, lots, transco=None, feuille: str = "Données"):
+    """Écrit les lots sur une feuille (plus ses suites au-delà de la limite d'Excel) ; renvoie le nombre de lignes"""
+    worksheet, colonnes, largeurs = None, None, None
+    ligne, total, num_feuille = 0, 0, 1
+
+    for cols, lignes in lots:
+        df = pd.DataFrame(lignes, columns=cols)
+        if transco:
+            transcoder_dataframe(df, transco, garder_inconnus=True)
+        if largeurs is None:
+            colonnes = cols
+            largeurs = largeurs_colonnes(df.head(LIGNES_ECHANTILLON))
+
+        for valeurs in df.astype(object).where(df.notna(), None).itertuples(index=False, name=None):
+            if worksheet is None or ligne >= XLSX_MAX_LIGNES:
+                # Nouvelle feuille : au-delà de la limite d'Excel, la suite continue sur « Données (2) »...
+                nom = feuille if num_feuille == 1 else f"{feuille} ({num_feuille})"
+                worksheet = workbook.add_worksheet(nom)
+                for i, largeur in enumerate(largeurs):
+                    worksheet.set_column(i, i, largeur)
+                worksheet.write_row(0, 0, colonnes)
+                ligne, num_feuille = 1, num_feuille + 1
+            worksheet.write_row(ligne, 0, valeurs)
+            ligne += 1
+            total += 1
+
+    if worksheet is None:
+        worksheet = workbook.add_worksheet(feuille)
+        if colonnes:
+            worksheet.write_row(0, 0, colonnes)
+    return total
+
+def ecrire_classeur_flux(feuilles, sortie):
+    """
+    Classeur xlsxwriter en mode constant_memory (chaque ligne part sur disque dès qu'elle
+    est écrite), une feuille par élément (nom, lots, transco) rempli l'un après l'autre.
+    Renvoie {nom de feuille: nombre de lignes}.
+    """
+    workbook = xlsxwriter.Workbook(sortie, {"constant_memory": True, "default_date_format": "yyyy-mm-dd"})
+    try:
+        return {nom: ecrire_feuille_flux(workbook, lots, transco, nom) for nom, lots, transco in feuilles}
+    finally:
+        workbook.close()
+
+def ecrire_xlsx_flux(lots, sortie, transco=None, feuille: str = "Données"):
+    """Classeur d'une seule feuille ; renvoie le nombre de lignes écrites"""
+    return ecrire_classeur_flux([(feuille, lots, transco)], sortie)[feuille]
+
+def export_classeur_flux(conn, feuilles, progression=None):
+    """
+    Plusieurs requêtes, une feuille chacune : feuilles = [(nom, requête, paramètres, transco)].
+    Les curseurs serveur s'ouvrent l'un après l'autre. Renvoie (fichier temporaire, {feuille: lignes}).
+    progression ne suit que la première feuille (celle des entretiens).
+    """
+    sortie = tempfile.SpooledTemporaryFile(max_size=TAILLE_SPOOL)
+    nb = ecrire_classeur_flux(
+        [(nom, lots_curseur_serveur(conn, query, params, progression=progression if i == 0 else None), transco)
+         for i, (nom, query, params, transco) in enumerate(feuilles)],
+        sortie
+    )
+    sortie.seek(0)
+    return sortie, nb
+
+def export_excel_flux(conn, query, params=None, transco=None, progression=None):
+    """
+    Résultat de `query` en classeur Excel, sans DataFrame complet ni tampon unique :
+    renvoie (fichier temporaire positionné au début, nombre de lignes).
+    """
+    sortie = tempfile.SpooledTemporaryFile(max_size=TAILLE_SPOOL)
+    nb = ecrire_xlsx_flux(lots_curseur_serveur(conn, query, params, progression=progression), sortie, transco)
+    sortie.seek(0)
+    return sortie, nb
+
+def schema_arrow(colonnes, transco=None, transco_listes=None):
+    """Schéma Arrow d'après les types PostgreSQL ; libellés en chaînes dictionnaire"""
+    transco = transco or {}
+    transco_listes = transco_listes or {}
+    champs = []
+    for nom, oid in colonnes:
+        if nom in transco:
+            type_arrow = TYPE_LIBELLE
+        elif nom in transco_listes:
+            # list<dictionary> ne se relit pas depuis Parquet ; l'encodage dictionnaire
+            # du fichier Parquet s'applique de toute façon aux chaînes
+            type_arrow = pa.list_(pa.string())
+        else:
+            type_arrow = TYPES_ARROW.get(oid, pa.string())
+        champs.append(pa.field(nom, type_arrow))
+    return pa.schema(champs)
+
+def libelles_listes(listes, mapping):
+    """Listes de codes -> listes de libellés (codes inconnus gardés tels quels)"""
+    code_vers_libelle = {}
+    for code, lib in mapping.items():
+        code_vers_libelle.setdefault(normaliser_code(code), lib)
+    resultat = []
+    for codes in listes:
+        if codes is None:
+            resultat.append(None)
+        else:
+            resultat.append([code_vers_libelle.get(normaliser_code(c), normaliser_code(c)) for c in codes])
+    return resultat
+
+def table_arrow(lignes, schema, transco=None, transco_listes=None):
+    """Un lot de tuples -> pa.Table conforme au schéma"""
+    transco = transco or {}
+    transco_listes = transco_listes or {}
+    valeurs = list(zip(*lignes)) if lignes else [()] * len(schema)
+    colonnes = []
+    for champ, colonne in zip(schema, valeurs):
+        if champ.name in transco:
+            serie = transcoder_serie(pd.Series(colonne, dtype=object), transco[champ.name], garder_inconnus=True)
+            tableau = pa.array(serie).cast(TYPE_LIBELLE)
+        elif champ.name in transco_listes:
+            tableau = pa.array(libelles_listes(colonne, transco_listes[champ.name]), type=champ.type)
+        elif pa.types.is_string(champ.type):
+            tableau = pa.array([None if v is None else str(v) for v in colonne], type=champ.type)
+        else:
+            tableau = pa.array(colonne, type=champ.type)
+        colonnes.append(tableau)
+    return pa.Table.from_arrays(colonnes, schema=schema)
+
+def ecrire_colonnes_flux(lots, sortie, transco=None, transco_listes=None, format: str = "parquet"):
+    """
+    Écrit des lots typés (voir lots_curseur_serveur(types=True)) en Parquet ou en flux IPC Arrow.
+    Le dictionnaire des libellés change d'un lot à l'autre : seul le format flux d'Arrow
+    (.arrows) l'accepte, le format fichier exigerait un dictionnaire unique.
+    Renvoie le nombre de lignes écrites.
+    """
+    writer, total = None, 0
+    try:
+        for colonnes, lignes in lots:
+            if writer is None:
+                schema = schema_arrow(colonnes, transco, transco_listes)
+                if format == "parquet":
+                    writer = pq.ParquetWriter(sortie, schema)
+                else:
+                    writer = pa.ipc.new_stream(sortie, schema)
+            table = table_arrow(lignes, schema, transco, transco_listes)
+            if format == "parquet":
+                writer.write_table(table, row_group_size=max(len(lignes), 1))
+            else:
+                writer.write_table(table)
+            total += len(lignes)
+    finally:
+        if writer is not None:
+            writer.close()
+    return total
+
+def export_colonnes_flux(conn, query, params=None, transco=None, transco_listes=None, format: str = "parquet",
+                         progression=None):
+    """Résultat de `query` en Parquet ou Arrow : (fichier temporaire positionné au début, nombre de lignes)"""
+    sortie = tempfile.SpooledTemporaryFile(max_size=TAILLE_SPOOL)
+    nb = ecrire_colonnes_flux(
+        lots_curseur_serveur(conn, query, params, types=True, progression=progression), sortie, transco, transco_listes,
+        format
+    )
+    sortie.seek(0)
+    return sortie, nb
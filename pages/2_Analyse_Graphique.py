@@ -4,10 +4,15 @@ import pandas as pd
 import plotly.express as px
 import sys
 import os
+import threading
 from PIL import Image
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from database import get_db_connection, get_translation_dictionary
+from database import (
+    get_translation_dictionary, get_colonnes_entretien, get_aggregat,
+    get_metadata_version, get_entretien_signature, get_entretiens_depuis
+)
+from transcodage import transcoder_dataframe, transcoder_serie
 
 st.set_page_config(layout="wide", page_title="Analyse Graphique", page_icon="📊")
 
@@ -17,62 +22,133 @@ if os.path.exists(logo_path):
     st.sidebar.image(logo_path, width=100)
 st.sidebar.markdown("---")
 
-@st.cache_data(ttl=60)
+LIBELLE_VIDE = "Non renseigné"
+
+def preparer_donnees(df, transco):
+    """Colonnes en minuscules, mois calculé, codes -> libellés"""
+    df.columns = [c.lower() for c in df.columns]
+    if 'date_ent' in df.columns:
+        df['date_ent'] = pd.to_datetime(df['date_ent'])
+        df['mois'] = df['date_ent'].dt.strftime('%Y-%m')
+
+    # Codes -> libellés en colonnes catégorielles ; les vides deviennent "Non renseigné"
+    # pour éviter le mélange String/Float(NaN)
+    transcoder_dataframe(df, transco, libelle_manquant=LIBELLE_VIDE)
+    return df
+
+@st.cache_resource
+def cache_donnees():
+    """Jeu détaillé partagé par toutes les sessions, complété à chaque accès par les nouvelles lignes"""
+    return {"df": None, "max_num": None, "nb": 0, "modifs": None, "version": None, "lock": threading.Lock()}
+
 def load_and_prep_data():
-    conn = get_db_connection()
-    if not conn: return pd.DataFrame()
-    
-    try:
-        query = "SELECT * FROM ENTRETIEN ORDER BY date_ent"
-        df = pd.read_sql(query, conn)
-        transco = get_translation_dictionary()
-        conn.close()
-
-        if df.empty: return df
-
-        df.columns = [c.lower() for c in df.columns]
-        if 'date_ent' in df.columns:
-            df['date_ent'] = pd.to_datetime(df['date_ent'])
-            df['mois'] = df['date_ent'].dt.strftime('%Y-%m')
-
-        for col, mapping in transco.items():
-            if col in df.columns:
-                # 1. On remplace les codes par les libellés
-                df[col] = df[col].map(mapping)
-                # 2. IMPORTANT : On remplit les vides par une chaine vide pour éviter le mélange String/Float(NaN)
-                df[col] = df[col].fillna("Non renseigné").astype(str)
-        
-        return df
-    except Exception as e:
-        st.error(f"Erreur data : {e}")
-        return pd.DataFrame()
+    """
+    Toutes les lignes transcodées, uniquement pour l'affichage détaillé à la demande.
+    Seules les lignes de NUM supérieur au dernier chargé sont lues et transcodées ;
+    rechargement complet si les métadonnées changent ou si des lignes ont été
+    modifiées, supprimées ou insérées avec un NUM plus petit.
+    """
+    cache = cache_donnees()
+    with cache["lock"]:
+        try:
+            max_num, nb, modifs = get_entretien_signature()
+            version = get_metadata_version()
+            if not nb:
+                cache.update(df=None, max_num=None, nb=0, modifs=modifs, version=version)
+                return pd.DataFrame()
+
+            complet = (
+                cache["df"] is None
+                or cache["version"] != version
+                or cache["modifs"] != modifs
+                or nb < cache["nb"]
+            )
+            if not complet and max_num == cache["max_num"] and nb == cache["nb"]:
+                return cache["df"]
+
+            transco = get_translation_dictionary()
+            if not complet:
+                delta = get_entretiens_depuis(cache["max_num"])
+                if cache["nb"] + len(delta) == nb:
+                    delta = preparer_donnees(delta, transco)
+                    df = pd.concat([cache["df"], delta], ignore_index=True)
+                    if not delta.empty and 'date_ent' in df.columns and delta['date_ent'].min() < cache["df"]['date_ent'].max():
+                        df = df.sort_values('date_ent', kind='stable', ignore_index=True)
+                else:
+                    # Lignes insérées sous le NUM max : on ne sait pas lesquelles
+                    complet = True
+            if complet:
+                df = get_entretiens_depuis(None)
+                if df.empty:
+                    return df
+                df = preparer_donnees(df, transco)
+
+            cache.update(df=df, max_num=max_num, nb=len(df), modifs=modifs, version=version)
+            return df
+        except Exception as e:
+            st.error(f"Erreur data : {e}")
+            return pd.DataFrame()
+
+def libelles(serie, col, transco):
+    """Libellés d'une colonne agrégée (codes -> libellés, vides -> "Non renseigné")"""
+    if col in transco:
+        return transcoder_serie(serie, transco[col], libelle_manquant=LIBELLE_VIDE)
+    if col == 'date_ent':
+        return pd.to_datetime(serie)
+    return serie.astype(object).where(serie.notna(), LIBELLE_VIDE).astype(str)
+
+def agreger(dimensions, filtres, transco):
+    """Comptages calculés par la base, puis transcodés (quelques lignes seulement)"""
+    data = get_aggregat(dimensions, filtres)
+    if data.empty or not dimensions:
+        return data
+    for col in dimensions:
+        data[col] = libelles(data[col], col, transco)
+    # Plusieurs codes peuvent partager un libellé (vide et code inconnu -> "Non renseigné")
+    return data.groupby(dimensions, observed=True, sort=False)['nb'].sum().reset_index(name='Count')
 
 st.title("📊 Analyse Graphique")
 st.markdown("---")
 
-df = load_and_prep_data()
+transco = get_translation_dictionary()
+total = get_aggregat([])
+nb_total = int(total['nb'].iloc[0]) if not total.empty else 0
+
+if nb_total > 0:
+    colonnes = get_colonnes_entretien()
 
-if not df.empty:
     # --- FILTRES EN SIDEBAR ---
     st.sidebar.header("🔍 Filtres")
-    df_filtered = df.copy()
     excluded_cols = ['num', 'date_ent', 'mois']
-    available_filters = [c for c in df.columns if c not in excluded_cols]
+    available_filters = [c for c in colonnes if c not in excluded_cols]
     
     filtres_actifs = st.sidebar.multiselect("Critères de filtrage :", available_filters)
     
+    # Filtres transmis à la base en valeurs brutes (codes), choisis par libellé
+    filtres = {}
+    choix_libelles = {}
     for col in filtres_actifs:
-        valeurs = sorted(df[col].astype(str).unique())
-        choix = st.sidebar.multiselect(f"{col}", valeurs)
+        valeurs = get_aggregat([col])
+        valeurs_brutes = [None if pd.isna(v) else v for v in valeurs[col].tolist()]
+        correspondance = {}
+        for lib, brute in zip(libelles(valeurs[col], col, transco).astype(str), valeurs_brutes):
+            correspondance.setdefault(lib, []).append(brute)
+        choix = st.sidebar.multiselect(f"{col}", sorted(correspondance))
         if choix:
-            df_filtered = df_filtered[df_filtered[col].astype(str).isin(choix)]
+            choix_libelles[col] = choix
+            filtres[col] = [brute for lib in choix for brute in correspondance[lib]]
+
+    nb_filtre = nb_total
+    if filtres:
+        filtre = get_aggregat([], filtres)
+        nb_filtre = int(filtre['nb'].iloc[0]) if not filtre.empty else 0
 
     # --- KPI EN HAUT DE PAGE ---
     kpi1, kpi2, kpi3 = st.columns(3)
-    kpi1.metric("Total Dossiers", len(df))
-    kpi2.metric("Dossiers Filtrés", len(df_filtered))
+    kpi1.metric("Total Dossiers", nb_total)
+    kpi2.metric("Dossiers Filtrés", nb_filtre)
     
-    pourcentage = (len(df_filtered)/len(df))*100 if len(df) > 0 else 0
+    pourcentage = (nb_filtre/nb_total)*100 if nb_total > 0 else 0
     kpi3.metric("% du total", f"{pourcentage:.1f} %")
     
     st.markdown("---")
@@ -84,35 +160,41 @@ if not df.empty:
         with c1:
             type_graph = st.selectbox("Type de graphique", ["Barres", "Camembert", "Courbe", "Treemap"])
         with c2:
-            cols_x = [c for c in df.columns if c != 'num']
+            cols_x = [c for c in colonnes if c != 'num'] + ['mois']
             var_x = st.selectbox("Axe X / Groupe principal", cols_x, index=0)
         with c3:
             var_color = st.selectbox("Segmentation (Couleur)", ["Aucun"] + [c for c in cols_x if c != var_x])
 
         color_arg = None if var_color == "Aucun" else var_color
 
-        if not df_filtered.empty:
+        if nb_filtre > 0:
+            grp = [var_x, color_arg] if color_arg and type_graph != "Camembert" else [var_x]
+            data = agreger(grp, filtres, transco)
+
             if type_graph == "Barres":
-                data = df_filtered.groupby([var_x, color_arg] if color_arg else [var_x]).size().reset_index(name='Count')
                 fig = px.bar(data, x=var_x, y='Count', color=color_arg, title=f"Répartition par {var_x}", text_auto=True)
             elif type_graph == "Camembert":
-                data = df_filtered.groupby(var_x).size().reset_index(name='Count')
                 fig = px.pie(data, names=var_x, values='Count', title=f"Répartition {var_x}", hole=0.4)
             elif type_graph == "Courbe":
-                grp = [var_x, color_arg] if color_arg else [var_x]
-                data = df_filtered.groupby(grp).size().reset_index(name='Count').sort_values(var_x)
+                data = data.sort_values(var_x)
                 fig = px.line(data, x=var_x, y='Count', color=color_arg, markers=True)
             elif type_graph == "Treemap":
-                path = [var_x]
-                if color_arg: path.append(color_arg)
-                data = df_filtered.groupby(path).size().reset_index(name='Count')
-                fig = px.treemap(data, path=path, values='Count')
+                fig = px.treemap(data, path=grp, values='Count')
             
             st.plotly_chart(fig, use_container_width=True)
             
-            with st.expander("🔎 Voir les données brutes correspondantes"):
-                st.dataframe(df_filtered, use_container_width=True)
+            with st.expander("🔎 Voir les données agrégées du graphique"):
+                st.dataframe(data, use_container_width=True)
+                # Comptages calculés par la base ; les entretiens eux-mêmes ne sont chargés que sur demande
+                if st.checkbox("Afficher les données brutes (un entretien par ligne)", key="detail_lignes"):
+                    df = load_and_prep_data()
+                    for col, choix in choix_libelles.items():
+                        if col in df.columns:
+                            # Colonnes codées déjà transcodées par load_and_prep_data
+                            valeurs = df[col].astype(str) if col in transco else libelles(df[col], col, transco)
+                            df = df[valeurs.isin(choix)]
+                    st.dataframe(df, use_container_width=True)
         else:
             st.warning("Aucune donnée avec ces filtres.")
 else:
-    st.info("La base de données est vide.")
\ No newline at end of file
+    st.info("La base de données est vide.")
@@ -2,19 +2,20 @@
 
 import streamlit as st
 import pandas as pd
-import io
 import sys
 import os
 from PIL import Image
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from database import (
-    get_db_connection, 
     get_translation_dictionary, 
     get_recent_dossiers_list, 
     get_dossier_complete_data,
-    get_options_for_table
+    get_mois_disponibles,
+    get_entretiens_mois
 )
+from transcodage import transcoder_dataframe, transcoder_serie
+from travaux_export import EXTENSIONS, demander_export, attendre, progression, lire_export
 
 st.set_page_config(layout="wide", page_title="Données & Export", page_icon="📥")
 
@@ -22,27 +23,51 @@ logo_path = "logo_mdd.png"
 if os.path.exists(logo_path):
     st.sidebar.image(logo_path, width=100)
 
-def to_excel(df):
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        df.to_excel(writer, index=False, sheet_name='Données')
-        worksheet = writer.sheets['Données']
-        for i, col in enumerate(df.columns):
-            max_len = max(df[col].astype(str).map(len).max(), len(col)) + 2
-            worksheet.set_column(i, i, max_len)
-    return output.getvalue()
+# Lignes affichées à l'écran : le fichier exporté, lui, contient toute la période
+LIGNES_APERCU = 200
+
+MIME_XLSX = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+# Attente dans le script avant de passer au suivi de progression (petits exports : bouton direct)
+ATTENTE_EXPORT = 3
+
+# Libellé -> (format de travaux_export, type MIME)
+# - dossiers complets : demandes et solutions (codes et libellés) sur la ligne de l'entretien
+# - Parquet et Arrow gardent les types et les listes demandes / solutions
+FORMATS_EXPORT = {
+    "Excel": ("xlsx", MIME_XLSX),
+    "Excel (dossiers complets)": ("dossiers", MIME_XLSX),
+    "Excel (dossiers + demandes + solutions)": ("dossiers_detail", MIME_XLSX),
+    "Parquet": ("parquet", "application/vnd.apache.parquet"),
+    "Arrow": ("arrow", "application/vnd.apache.arrow.stream")
+}
+
+def bouton_telechargement(travail, mime, nom_fichier):
+    if travail["statut"] == "erreur":
+        st.error(f"Erreur export : {travail['erreur']}")
+        return
+    donnees = lire_export(travail)
+    if donnees is None:
+        st.warning("Fichier expiré, relancez l'export.")
+        return
+    st.download_button(
+        f"📥 Télécharger ({EXTENSIONS[travail['format']]})", 
+        data=donnees, 
+        file_name=nom_fichier,
+        mime=mime,
+        type="primary"
+    )
+
+@st.fragment(run_every=1.0)
+def suivi_export(travail):
+    """Progression rafraîchie chaque seconde ; la page est relancée quand le fichier est prêt"""
+    if travail["fini"].is_set():
+        st.rerun()
+    st.progress(progression(travail), text=f"Export en cours : {travail['lignes']} / {travail['total']} lignes")
 
 def get_available_months():
-    conn = get_db_connection()
-    months = []
-    if conn:
-        try:
-            query = "SELECT DISTINCT TO_CHAR(date_ent, 'YYYY-MM') as mois FROM ENTRETIEN ORDER BY mois DESC"
-            df = pd.read_sql(query, conn)
-            months = df['mois'].tolist()
-        except Exception: pass
-        finally: conn.close()
-    return months
+    # Lus dans les agrégats mensuels : coût constant quel que soit l'historique
+    return get_mois_disponibles()
 
 st.title("📥 Données & Archives")
 st.markdown("---")
@@ -54,7 +79,7 @@ tab_export, tab_detail = st.tabs(["📊 Export Global (Excel)", "🔍 Détail Do
 # ONGLET 1 : EXPORT GLOBAL
 # =========================================================
 with tab_export:
-    st.info("Sélectionnez une période pour générer un fichier Excel complet.")
+    st.info("Sélectionnez une période et un format pour générer un fichier complet.")
     
     col_filter, col_action = st.columns([3, 1])
     
@@ -65,43 +90,41 @@ with tab_export:
             selected_months = []
         else:
             selected_months = st.multiselect("Mois à exporter :", options=liste_mois, default=liste_mois[:1])
+        format_export = st.selectbox("Format :", list(FORMATS_EXPORT))
 
     if selected_months:
-        conn = get_db_connection()
-        if conn:
-            try:
-                query = "SELECT * FROM ENTRETIEN WHERE TO_CHAR(date_ent, 'YYYY-MM') = ANY(%s) ORDER BY date_ent DESC"
-                df = pd.read_sql(query, conn, params=(selected_months,))
-                transco = get_translation_dictionary()
-                conn.close()
-
-                if not df.empty:
-                    df.columns = [c.lower() for c in df.columns]
-                    if 'date_ent' in df.columns:
-                        df['date_ent'] = pd.to_datetime(df['date_ent']).dt.date
-                    
-                    for col, mapping in transco.items():
-                        if col in df.columns:
-                            df[col] = df[col].map(mapping).fillna(df[col])
-
-                    st.dataframe(df, use_container_width=True, height=300)
-                    
-                    excel_data = to_excel(df)
-                    
-                    with col_action:
-                        st.write("Action :")
-                        st.download_button(
-                            "📥 Télécharger Excel", 
-                            data=excel_data, 
-                            file_name=f"export_mdd_{selected_months[0]}.xlsx",
-                            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                            type="primary"
+        try:
+            # Mois -> intervalles de dates (parcours de l'index sur DATE_ENT)
+            df = get_entretiens_mois(selected_months, limite=LIGNES_APERCU)
+            transco = get_translation_dictionary()
+
+            if not df.empty:
+                df.columns = [c.lower() for c in df.columns]
+                if 'date_ent' in df.columns:
+                    df['date_ent'] = pd.to_datetime(df['date_ent']).dt.date
+                
+                transcoder_dataframe(df, transco, garder_inconnus=True)
+
+                st.dataframe(df, use_container_width=True, height=300)
+                
+                # Export en arrière-plan (ou servi par le cache) : changer la sélection ne le perd pas
+                format_travail, mime = FORMATS_EXPORT[format_export]
+                travail = demander_export(selected_months, format_travail)
+                if travail["total"] > len(df):
+                    st.caption(f"Aperçu des {len(df)} premières lignes sur {travail['total']} exportées.")
+                
+                with col_action:
+                    st.write("Action :")
+                    if attendre(travail, ATTENTE_EXPORT):
+                        bouton_telechargement(
+                            travail, mime, f"export_mdd_{selected_months[0]}.{EXTENSIONS[format_travail]}"
                         )
-                else:
-                    st.info("Aucune donnée pour cette période.")
-            except Exception as e:
-                st.error(f"Erreur: {e}")
-                if conn: conn.close()
+                    else:
+                        suivi_export(travail)
+            else:
+                st.info("Aucune donnée pour cette période.")
+        except Exception as e:
+            st.error(f"Erreur: {e}")
 
 # =========================================================
 # ONGLET 2 : DÉTAIL DOSSIER
@@ -143,19 +166,14 @@ with tab_detail:
             transco_ent = get_translation_dictionary()
             df_ent.columns = [c.lower() for c in df_ent.columns]
             
-            for col, mapping in transco_ent.items():
-                if col in df_ent.columns:
-                    df_ent[col] = df_ent[col].map(mapping).fillna(df_ent[col])
+            transcoder_dataframe(df_ent, transco_ent, garder_inconnus=True)
             
             with st.container():
                 st.markdown("#### 👤 Informations Usager")
                 st.dataframe(df_ent, use_container_width=True, hide_index=True)
             
-            opts_demande = get_options_for_table('DEMANDE')
-            map_demande = {v: k for k, v in opts_demande.items()}
-            
-            opts_solution = get_options_for_table('SOLUTION')
-            map_solution = {v: k for k, v in opts_solution.items()}
+            map_demande = get_translation_dictionary('DEMANDE').get('nature', {})
+            map_solution = get_translation_dictionary('SOLUTION').get('nature', {})
 
             c_left, c_right = st.columns(2)
 
@@ -164,7 +182,7 @@ with tab_detail:
                 if not df_dem.empty:
                     df_dem.columns = [c.lower() for c in df_dem.columns]
                     if 'nature' in df_dem.columns:
-                        df_dem['nature'] = df_dem['nature'].map(map_demande).fillna(df_dem['nature'])
+                        df_dem['nature'] = transcoder_serie(df_dem['nature'], map_demande, garder_inconnus=True)
                     st.dataframe(df_dem[['pos', 'nature']], use_container_width=True, hide_index=True)
                 else:
                     st.info("Aucune demande.")
@@ -174,7 +192,7 @@ with tab_detail:
                 if not df_sol.empty:
                     df_sol.columns = [c.lower() for c in df_sol.columns]
                     if 'nature' in df_sol.columns:
-                        df_sol['nature'] = df_sol['nature'].map(map_solution).fillna(df_sol['nature'])
+                        df_sol['nature'] = transcoder_serie(df_sol['nature'], map_solution, garder_inconnus=True)
                     st.dataframe(df_sol[['pos', 'nature']], use_container_width=True, hide_index=True)
                 else:
                     st.info("Aucune solution.")
\ No newline at end of file
@@ -10,7 +10,9 @@ from database import (
     get_form_config, 
     add_new_variable_db, 
     add_new_modality_db, 
-    get_rubriques
+    get_rubriques,
+    invalidate_metadata_cache,
+    reconstruire_stat_mensuelle
 )
 
 def administration_page():
@@ -113,6 +115,17 @@ def administration_page():
     # --- Onglet Aperçu ---
     with tab_apercu:
         st.write("Liste des champs configurés dans la base :")
+        # Utile après une modification faite directement en SQL (hors de cette page)
+        if st.button("🔄 Recharger la configuration depuis la base"):
+            invalidate_metadata_cache()
+            st.rerun()
+        # Agrégats mensuels (listes de mois, graphiques) : à recalculer après une correction faite en SQL
+        if st.button("🧮 Recalculer les statistiques mensuelles"):
+            try:
+                reconstruire_stat_mensuelle()
+                st.success("Statistiques mensuelles recalculées.")
+            except Exception as e:
+                st.error(f"Erreur lors du recalcul : {e}")
         df_preview = pd.DataFrame(current_config)
         # Nettoyage pour affichage
         if not df_preview.empty:
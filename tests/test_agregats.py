@@ -0,0 +1,99 @@
+# tests/test_agregats.py
+# -*- coding: utf-8 -*-
+import sys
+import os
+import pytest
+import psycopg2
+from psycopg2 import errors
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from database import LOCAL_DB_CONFIG
+from agregats import installer_agregats, reconstruire_agregats
+
+TABLES_TEST = """
+    CREATE TABLE ENTRETIEN (NUM SERIAL PRIMARY KEY, DATE_ENT DATE, MODE INTEGER);
+    CREATE TABLE DEMANDE (NUM INTEGER, POS INTEGER, NATURE INTEGER);
+    CREATE TABLE SOLUTION (NUM INTEGER, POS INTEGER, NATURE INTEGER);
+"""
+
+
+@pytest.fixture
+def schema_vide():
+    """Schéma de travail sans agrégats, supprimé après le test"""
+    conn = psycopg2.connect(**LOCAL_DB_CONFIG)
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute("DROP SCHEMA IF EXISTS agregats_test CASCADE; CREATE SCHEMA agregats_test")
+        cur.execute("SET search_path TO agregats_test")
+    yield conn
+    with conn.cursor() as cur:
+        cur.execute("DROP SCHEMA IF EXISTS agregats_test CASCADE")
+    conn.close()
+
+
+def comptes(cur, tables=("ENTRETIEN", "DEMANDE", "SOLUTION")):
+    cur.execute("""
+        SELECT mois, tab, variable, code, nb FROM STAT_MENSUELLE
+        WHERE tab = ANY(%s) AND nb <> 0 ORDER BY 1, 2, 3, 4
+    """, (list(tables),))
+    return cur.fetchall()
+
+
+def test_installation_schema_vide(schema_vide):
+    """Connexion en autocommit : l'installation ouvre sa transaction et calcule les données existantes."""
+    with schema_vide.cursor() as cur:
+        cur.execute(TABLES_TEST)
+        cur.execute("INSERT INTO ENTRETIEN (NUM, DATE_ENT, MODE) VALUES (1, '2024-01-15', 1), (2, '2024-02-20', 2)")
+        cur.execute("INSERT INTO DEMANDE VALUES (1, 1, 100)")
+
+        assert installer_agregats(cur) is True
+        assert ("2024-01", "DEMANDE", "*", "", 1) in comptes(cur)
+        assert ("2024-02", "ENTRETIEN", "mode", "2", 1) in comptes(cur)
+
+        # Déjà installé : rien n'est recalculé, les triggers suivent les nouvelles lignes
+        assert installer_agregats(cur) is False
+        cur.execute("INSERT INTO ENTRETIEN (NUM, DATE_ENT, MODE) VALUES (3, '2024-02-21', 2)")
+        assert ("2024-02", "ENTRETIEN", "mode", "2", 2) in comptes(cur)
+
+
+def test_installation_annulee_en_cas_d_erreur(schema_vide):
+    """Une installation qui échoue ne laisse ni table ni trigger : la suivante repart de zéro."""
+    with schema_vide.cursor() as cur:
+        cur.execute("CREATE TABLE ENTRETIEN (NUM SERIAL PRIMARY KEY, DATE_ENT DATE)")
+        with pytest.raises(errors.UndefinedTable):
+            installer_agregats(cur)
+        cur.execute("SELECT to_regclass('stat_mensuelle')")
+        assert cur.fetchone()[0] is None
+
+        cur.execute("""
+            CREATE TABLE DEMANDE (NUM INTEGER, POS INTEGER, NATURE INTEGER);
+            CREATE TABLE SOLUTION (NUM INTEGER, POS INTEGER, NATURE INTEGER);
+            INSERT INTO ENTRETIEN (NUM, DATE_ENT) VALUES (1, '2024-03-01');
+        """)
+        assert installer_agregats(cur) is True
+        assert comptes(cur, ["ENTRETIEN"]) == [("2024-03", "ENTRETIEN", "*", "", 1)]
+
+
+def test_changement_de_mois_deplace_demandes_et_solutions(schema_vide):
+    """Modifier DATE_ENT déplace aussi les demandes et solutions du dossier, comme un recalcul complet."""
+    with schema_vide.cursor() as cur:
+        cur.execute(TABLES_TEST)
+        installer_agregats(cur)
+        cur.execute("INSERT INTO ENTRETIEN (NUM, DATE_ENT, MODE) VALUES (1, '2024-01-15', 1), (2, '2024-01-20', 1)")
+        cur.execute("INSERT INTO DEMANDE VALUES (1, 1, 100), (1, 2, 101), (2, 1, 100)")
+        cur.execute("INSERT INTO SOLUTION VALUES (1, 1, 200)")
+
+        cur.execute("UPDATE ENTRETIEN SET date_ent = '2024-02-03' WHERE num = 1")
+        apres = comptes(cur, ["DEMANDE", "SOLUTION"])
+        assert ("2024-01", "DEMANDE", "*", "", 1) in apres
+        assert ("2024-02", "DEMANDE", "*", "", 2) in apres
+        assert ("2024-02", "DEMANDE", "nature", "101", 1) in apres
+        assert ("2024-02", "SOLUTION", "*", "", 1) in apres
+        assert not [l for l in apres if l[0] == "2024-01" and l[1] == "SOLUTION"]
+
+        # Date retirée puis modification sans changement de mois : toujours cohérent
+        cur.execute("UPDATE ENTRETIEN SET date_ent = NULL WHERE num = 2")
+        cur.execute("UPDATE ENTRETIEN SET date_ent = '2024-02-04', mode = 2 WHERE num = 1")
+        attendu = comptes(cur)
+        reconstruire_agregats(cur)
+        assert comptes(cur) == attendu
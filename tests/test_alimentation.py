@@ -0,0 +1,228 @@
+# tests/test_alimentation.py
+# -*- coding: utf-8 -*-
+import sys
+import os
+from datetime import date
+import pandas as pd
+import psycopg2
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import alimentation_base
+from alimentation_base import (
+    nettoyer_colonnes, preparer_lot, filtrer_inchanges, cle_source, empreinte_fichier, lire_blocs,
+    lire_source
+)
+
+def test_nettoyage_colonnes_typees():
+    """Conversion colonne par colonne et rapport des valeurs corrigées."""
+    df = pd.DataFrame({
+        "Mode": [1, 2.7, None, " 3 ", "abc", 70000],
+        "Sit° Fam": ["ABC", None, "  ", 5, "x", "y"]
+    })
+    out, rapport = nettoyer_colonnes(df)
+
+    assert str(out["mode"].dtype) == "Int16"
+    assert out["mode"].tolist()[:2] == [1, 2]
+    assert out["mode"].isna().tolist() == [False, False, True, False, True, True]
+    assert rapport["mode"] == {"non_numeriques": 1, "decimaux_tronques": 1, "hors_plage": 1}
+
+    # Vides et blancs -> NULL (et non plus "na"), longueur du VARCHAR respectée
+    assert out["sit_fam"].tolist()[0] == "AB"
+    assert out["sit_fam"].isna().tolist()[1:3] == [True, True]
+    assert rapport["sit_fam"] == {"tronques": 1}
+
+    # Colonne absente du fichier : entièrement NULL, sans erreur
+    assert out["age"].isna().all()
+
+def test_preparation_demandes_format_long():
+    """Dem.1..3 -> lignes (num, pos, nature), positions consécutives par entretien."""
+    df = pd.DataFrame({
+        "Dem.1": [100, None, "x"],
+        "Dem.2": [None, 200.0, ""],
+        "Dem.3": [300, None, 0]
+    })
+    lot = preparer_lot(df, date(2024, 1, 1))
+    demandes = lot["demande"]
+
+    assert demandes.values.tolist() == [[0, 1, "100"], [0, 2, "300"], [1, 1, "200"], [2, 1, "x"]]
+    assert (lot["entretien"]["date_ent"] == date(2024, 1, 1)).all()
+
+def test_quarantaine_lignes_invalides():
+    """Les lignes hors référentiel sont écartées avec leur motif, les autres restent chargeables."""
+    df = pd.DataFrame({
+        "Mode": [1, 9, 2, None],
+        "Enfts": [2, 3, 40, 1],
+        "Dem.1": [100, 100, None, 555]
+    })
+    controles = {
+        "modalites": {"mode": {"1", "2"}},
+        "plages": {"enfant": (0, 13)},
+        "natures": {"demande": {"100"}}
+    }
+    lot = preparer_lot(df, date(2024, 1, 1), controles=controles)
+
+    assert lot["rejets"].index.tolist() == [1, 2, 3]
+    assert lot["rejets"]["motif_rejet"].tolist() == [
+        "mode=9 hors modalités",
+        "enfant=40 hors plage [0;13]",
+        "demande=555 inconnue"
+    ]
+    assert lot["entretien"].index.tolist() == [0]
+    assert lot["demande"]["num"].tolist() == [0]
+
+def test_manifeste_fichiers_inchanges(tmp_path):
+    """Un classeur déjà importé avec la même empreinte est ignoré, un classeur modifié est à remplacer."""
+    janvier = tmp_path / "janvier.xlsx"
+    fevrier = tmp_path / "fevrier.xlsx"
+    janvier.write_bytes(b"contenu janvier")
+    fevrier.write_bytes(b"contenu fevrier v2")
+    taches = [(str(janvier), "janvier.xlsx", date(2024, 1, 1)), (str(fevrier), "fevrier.xlsx", date(2024, 2, 1))]
+    manifeste = {
+        cle_source(str(janvier)): empreinte_fichier(str(janvier))[1],
+        cle_source(str(fevrier)): "empreinte de la version précédente"
+    }
+
+    a_importer, signatures = filtrer_inchanges(taches, manifeste)
+    assert [t[1] for t in a_importer] == ["fevrier.xlsx"]
+    source, taille, _, deja_importe = signatures[str(fevrier)]
+    assert (source, taille, deja_importe) == (cle_source(str(fevrier)), len(b"contenu fevrier v2"), True)
+
+    # --forcer : tout est réimporté
+    assert len(filtrer_inchanges(taches, manifeste, forcer=True)[0]) == 2
+
+def test_lecture_par_blocs(tmp_path):
+    """La lecture en flux rend les mêmes lignes que pd.read_excel, découpées en blocs."""
+    fichier = tmp_path / "mars.xlsx"
+    pd.DataFrame({
+        "Mode": [1, 2, 3, 1, 2],
+        "Commune": ["Vannes", None, "Auray", "Baud", "Elven"],
+        "Dem.1": [100, 200, None, 100, 300]
+    }).to_excel(fichier, index=False)
+
+    blocs = list(lire_blocs(str(fichier), taille_bloc=2))
+    assert [len(b) for b in blocs] == [2, 2, 1]
+    assert blocs[2].index.tolist() == [4]
+
+    attendu = pd.read_excel(fichier)
+    lu = pd.concat(blocs)
+    assert lu["Commune"].fillna("").tolist() == attendu["Commune"].fillna("").tolist()
+    assert pd.to_numeric(lu["Dem.1"]).equals(attendu["Dem.1"])
+
+def test_sources_csv_parquet(tmp_path):
+    """CSV (séparateur ;) et Parquet donnent le même lot que la feuille Excel équivalente."""
+    df = pd.DataFrame({"Mode": [1, 2, None], "Sit° Fam": ["5a", "5", None], "Dem.1": [100, None, 200]})
+    df.to_excel(tmp_path / "avril.xlsx", index=False)
+    df.to_parquet(tmp_path / "avril.parquet", index=False)
+    (tmp_path / "avril.csv").write_text("Mode;Sit° Fam;Dem.1\n1;5a;100\n2;5;\n;;200\n", encoding="utf-8")
+
+    attendu = preparer_lot(lire_source(str(tmp_path / "avril.xlsx")), date(2024, 4, 1))
+    for extension in (".csv", ".parquet"):
+        fichier = str(tmp_path / ("avril" + extension))
+        lot = preparer_lot(lire_source(fichier), date(2024, 4, 1))
+        pd.testing.assert_frame_equal(lot["entretien"], attendu["entretien"])
+        pd.testing.assert_frame_equal(lot["demande"], attendu["demande"])
+
+        # Lecture en flux : mêmes lignes, positions conservées
+        blocs = list(lire_blocs(fichier, taille_bloc=2))
+        assert [b.index.tolist() for b in blocs] == [[0, 1], [2]]
+
+
+class CurseurFactice:
+    """Curseur minimal : enregistre les INSERT du mode ligne à ligne"""
+    def __init__(self):
+        self.entretiens = []
+        self.demandes = []
+
+    def execute(self, sql, params=None):
+        if "INTO ENTRETIEN (" in sql:
+            self.entretiens.append(params)
+        elif "INTO DEMANDE" in sql:
+            self.demandes.append(params)
+
+    def fetchone(self):
+        return (len(self.entretiens),)
+
+    def close(self):
+        pass
+
+
+class ConnexionFactice:
+    def __init__(self):
+        self.curseur = CurseurFactice()
+        self.autocommit = True
+
+    def cursor(self):
+        return self.curseur
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def test_reprise_ligne_a_ligne_garde_les_controles(tmp_path, monkeypatch):
+    """COPY refusé : la reprise ligne à ligne n'insère pas les lignes hors référentiel, qui restent en quarantaine."""
+    fichier = tmp_path / "mai.xlsx"
+    pd.DataFrame({"Mode": [1, 9, 2], "Dem.1": [100, 100, 555]}).to_excel(fichier, index=False)
+    controles = {"modalites": {"mode": {"1", "2"}}, "plages": {}, "natures": {"demande": {"100"}}}
+
+    connexion = ConnexionFactice()
+    quarantaine = {}
+    monkeypatch.setattr(alimentation_base.psycopg2, "connect", lambda **kwargs: connexion)
+    monkeypatch.setattr(alimentation_base, "lister_fichiers", lambda dossier: [(str(fichier), "mai.xlsx", date(2024, 5, 1))])
+    monkeypatch.setattr(alimentation_base, "lire_manifeste", lambda cur: {})
+    monkeypatch.setattr(alimentation_base, "lire_metadonnees", lambda cur, conn: (None, controles))
+    monkeypatch.setattr(alimentation_base, "remplacer_fichier", lambda cur, signature, nom: "mai.xlsx")
+    monkeypatch.setattr(alimentation_base, "enregistrer_manifeste", lambda *args: None)
+    monkeypatch.setattr(alimentation_base, "ecrire_quarantaine", lambda rejets, nom, dossier=None: quarantaine.setdefault(nom, rejets))
+
+    def copy_refuse(cur, lot, source=None):
+        raise psycopg2.DataError("COPY refusé")
+    monkeypatch.setattr(alimentation_base, "charger_lot", copy_refuse)
+
+    alimentation_base.importer_dossier_excel(mode="bulk", dossier=str(tmp_path))
+
+    # Seule la première ligne est valide : mode=9 et demande=555 n'arrivent jamais dans ENTRETIEN
+    assert len(connexion.curseur.entretiens) == 1
+    assert [d[2] for d in connexion.curseur.demandes] == ["100"]
+    rejets = quarantaine["mai.xlsx"]
+    assert rejets.index.tolist() == [1, 2]
+    assert rejets["motif_rejet"].tolist() == ["mode=9 hors modalités", "demande=555 inconnue"]
+
+
+def test_quarantaine_hors_dossier_importe(tmp_path, monkeypatch):
+    """Chaque exécution écrit dans un nouveau dossier : le fichier corrigé qu'on réimporte n'est jamais touché."""
+    monkeypatch.setattr(alimentation_base, "DOSSIER_QUARANTAINE", str(tmp_path / "quarantaine"))
+    rejets = pd.DataFrame({"Mode": [9], "motif_rejet": ["mode=9 hors modalités"]})
+
+    premier = alimentation_base.dossier_quarantaine_execution(str(tmp_path / "data_entretien"))
+    chemin = alimentation_base.ecrire_quarantaine(rejets, "mai.xlsx", premier)
+    assert os.path.dirname(chemin) == premier
+
+    # Réimport du dossier de quarantaine corrigé : la sortie va ailleurs, rien n'est effacé
+    second = alimentation_base.dossier_quarantaine_execution(premier)
+    assert second != premier
+    assert alimentation_base.ecrire_quarantaine(None, "mai.xlsx", second) is None
+    assert os.path.exists(chemin)
+
+
+def test_lecture_par_blocs_premiere_feuille(tmp_path):
+    """Comme pd.read_excel, la lecture en flux lit la première feuille, même si une autre est active."""
+    import openpyxl
+    fichier = tmp_path / "juin.xlsx"
+    classeur = openpyxl.Workbook()
+    classeur.active.append(["Mode"])
+    classeur.active.append([1])
+    autre = classeur.create_sheet("Notes")
+    autre.append(["Remarque"])
+    autre.append(["à ignorer"])
+    classeur.active = 1
+    classeur.save(fichier)
+
+    blocs = list(lire_blocs(str(fichier), taille_bloc=10))
+    assert blocs[0].columns.tolist() == ["Mode"]
+    assert blocs[0]["Mode"].tolist() == pd.read_excel(fichier)["Mode"].tolist()
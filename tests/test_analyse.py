@@ -5,7 +5,8 @@ import os
 import pytest
 import psycopg2
 from streamlit.testing.v1 import AppTest
-from database import LOCAL_DB_CONFIG
+from database import LOCAL_DB_CONFIG, get_aggregat, get_mois_disponibles
+from transcodage import normaliser_code
 
 # Ajout du chemin racine
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
@@ -67,4 +68,18 @@ def test_page_analyse_filtres(inject_data_analyse):
 def test_page_analyse_donnees_brutes(inject_data_analyse):
     at = AppTest.from_file("pages/2_Analyse_Graphique.py")
     at.run()
-    assert len(at.dataframe) > 0
\ No newline at end of file
+    assert len(at.dataframe) > 0
+
+
+def test_agregat_cote_serveur(inject_data_analyse):
+    """Les comptages du graphique sont calculés par PostgreSQL (GROUP BY), filtres compris."""
+    # Sans filtre la répartition vient des agrégats mensuels (codes en texte)
+    par_mode = get_aggregat(["mode"])
+    assert {normaliser_code(m): nb for m, nb in zip(par_mode["mode"], par_mode["nb"])} == {"1": 2, "2": 1}
+    assert get_mois_disponibles() == ["2024-03", "2024-02", "2024-01"]
+
+    par_mois = get_aggregat(["mois"], {"mode": [1], "sexe": [1, None]})
+    assert par_mois.values.tolist() == [["2024-01", 1], ["2024-03", 1]]
+
+    with pytest.raises(ValueError):
+        get_aggregat(["mode; DROP TABLE ENTRETIEN"])
@@ -0,0 +1,163 @@
+# tests/test_database.py
+# -*- coding: utf-8 -*-
+import sys
+import os
+import threading
+import contextlib
+import pytest
+import psycopg2
+from psycopg2 import pool as pg_pool
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import database
+
+
+class ConnexionMorte:
+    closed = 1
+
+
+class PoolFactice:
+    """Comme ThreadedConnectionPool : rendre deux fois la même connexion lève PoolError"""
+    def __init__(self):
+        self.pretees = [ConnexionMorte()]
+        self.sorties = []
+
+    def getconn(self):
+        if not self.pretees:
+            raise psycopg2.OperationalError("serveur injoignable")
+        conn = self.pretees.pop()
+        self.sorties.append(conn)
+        return conn
+
+    def putconn(self, conn, close=False):
+        if conn not in self.sorties:
+            raise pg_pool.PoolError("trying to put unkeyed connection")
+        self.sorties.remove(conn)
+
+
+def test_reconnexion_impossible(monkeypatch):
+    """Connexion morte puis serveur injoignable : l'erreur réelle remonte et la place du pool est rendue."""
+    monkeypatch.setattr(database, "get_db_pool", lambda: PoolFactice())
+    monkeypatch.setattr(database, "_pool_slots", threading.BoundedSemaphore(1))
+
+    with pytest.raises(psycopg2.OperationalError):
+        with database.db_connection():
+            pass
+    assert database._pool_slots.acquire(timeout=0)
+
+
+class CurseurEnregistreur:
+    """Garde les requêtes exécutées ; to_regclass renvoie `table_presente`"""
+    def __init__(self, table_presente=True):
+        self.table_presente = table_presente
+        self.requetes = []
+
+    def execute(self, query, params=None):
+        self.requetes.append(" ".join(query.split()))
+
+    def fetchone(self):
+        return (self.table_presente,)
+
+
+def test_compteur_metadonnees_cree_si_absent(monkeypatch):
+    """Base antérieure au compteur : la modification d'administration le crée au lieu d'échouer."""
+    monkeypatch.setattr(database, "METADATA_SYNC_SECONDS", 5.0)
+    cur = CurseurEnregistreur(table_presente=False)
+    database._bump_metadata_version(cur)
+    assert cur.requetes[1].startswith("CREATE TABLE IF NOT EXISTS METADATA_VERSION")
+    assert "ON CONFLICT (ID) DO NOTHING" in cur.requetes[1]
+    assert cur.requetes[-1] == "UPDATE METADATA_VERSION SET version = version + 1 WHERE id = 1"
+
+    cur = CurseurEnregistreur(table_presente=True)
+    database._bump_metadata_version(cur)
+    assert len(cur.requetes) == 2
+
+
+class ConnexionPreparee:
+    """Attributs de _StatementCacheConnection, sans serveur"""
+    def __init__(self):
+        self.prepared_statements = {}
+        self.prepared_version = None
+        self.prepared_dirty = False
+        self.prepared_counter = 0
+
+
+class CurseurPrepare(CurseurEnregistreur):
+    def __init__(self):
+        super().__init__()
+        self.connection = ConnexionPreparee()
+
+
+def test_requetes_preparees_reutilisees(monkeypatch):
+    """Une requête n'est préparée qu'une fois par connexion ; paramètres %s -> $n."""
+    monkeypatch.setattr(database, "PREPARED_MAX", 4)
+    cur = CurseurPrepare()
+    database._execute_prepared(cur, "k", "SELECT %s, %s", [1, 2], (0, None))
+    database._execute_prepared(cur, "k", "SELECT %s, %s", [3, 4], (0, None))
+    assert cur.requetes == ["PREPARE stmt_1 AS SELECT $1, $2", "EXECUTE stmt_1 (%s, %s)", "EXECUTE stmt_1 (%s, %s)"]
+
+
+def test_requetes_preparees_eviction(monkeypatch):
+    """Au-delà de DB_PREPARED_MAX, la plus ancienne est libérée."""
+    monkeypatch.setattr(database, "PREPARED_MAX", 2)
+    cur = CurseurPrepare()
+    for cle in ("a", "b", "c"):
+        database._execute_prepared(cur, cle, "SELECT %s", [1], (0, None))
+    assert "DEALLOCATE stmt_1" in cur.requetes
+    assert cur.connection.prepared_statements == {"b": "stmt_2", "c": "stmt_3"}
+
+
+def test_requetes_preparees_invalidees(monkeypatch):
+    """Nouvelle version des métadonnées ou erreur sur la connexion : DEALLOCATE ALL puis nouvelle préparation."""
+    monkeypatch.setattr(database, "PREPARED_MAX", 4)
+    cur = CurseurPrepare()
+    database._execute_prepared(cur, "k", "SELECT %s", [1], (0, None))
+    cur.requetes.clear()
+    database._execute_prepared(cur, "k", "SELECT %s", [1], (1, None))
+    assert cur.requetes == ["DEALLOCATE ALL", "PREPARE stmt_2 AS SELECT $1", "EXECUTE stmt_2 (%s)"]
+
+    database._reset_prepared(cur.connection)
+    cur.requetes.clear()
+    database._execute_prepared(cur, "k", "SELECT %s", [1], (1, None))
+    assert cur.requetes[0] == "DEALLOCATE ALL"
+    assert cur.requetes[1] == "PREPARE stmt_3 AS SELECT $1"
+    assert not cur.connection.prepared_dirty
+
+
+def test_version_lue_avant_emprunt(monkeypatch):
+    """La version des métadonnées est lue avant d'emprunter la connexion : une seule à la fois."""
+    etat = {"emprunte": False}
+    cur = CurseurPrepare()
+
+    class Connexion(ConnexionPreparee):
+        def cursor(self):
+            return contextlib.nullcontext(cur)
+
+        def commit(self):
+            pass
+
+    @contextlib.contextmanager
+    def emprunt():
+        etat["emprunte"] = True
+        yield Connexion()
+        etat["emprunte"] = False
+
+    def version():
+        assert not etat["emprunte"], "connexion demandée pendant l'emprunt"
+        return (0, None)
+
+    monkeypatch.setattr(database, "db_connection", emprunt)
+    monkeypatch.setattr(database, "get_metadata_version", version)
+    monkeypatch.setattr(database, "PREPARED_MAX", 4)
+    cur.fetchone = lambda: (7,)
+    assert database.save_entretien_complet({"MODE": 1}, [100], [], date_ent="2024-01-01") == 7
+    assert cur.requetes[-1].startswith("EXECUTE stmt_1")
+
+
+def test_requete_dossier_complet():
+    """Un seul ordre : les lignes filles reprennent le NUM de la CTE ; liste vide = pas d'INSERT."""
+    query = database._sql_dossier_complet(["DATE_ENT", "MODE"], 2, 0)
+    assert query.startswith("WITH ent AS (INSERT INTO ENTRETIEN (DATE_ENT, MODE)")
+    assert "((SELECT NUM FROM ent), 1, %s), ((SELECT NUM FROM ent), 2, %s)" in query
+    assert "SOLUTION" not in query
+    assert query.count("%s") == 4
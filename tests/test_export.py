@@ -5,7 +5,10 @@ import os
 import pytest
 import psycopg2
 from streamlit.testing.v1 import AppTest
-from database import LOCAL_DB_CONFIG
+from datetime import date
+from database import LOCAL_DB_CONFIG, plages_mois
+import moteur_export
+import exportation_base
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
@@ -77,4 +80,126 @@ def test_onglet_detail_dossier_inconnu(inject_data_export):
     at.number_input[0].set_value(999999).run()
 
     assert len(at.error) > 0
-    assert "n'existe pas" in at.error[0].value
\ No newline at end of file
+    assert "n'existe pas" in at.error[0].value
+
+
+def test_plages_mois():
+    """Mois choisis -> intervalles [début, fin[ indexables, mois consécutifs fusionnés (passage d'année compris)."""
+    assert plages_mois(["2025-01", "2024-03", "2024-12"]) == [
+        (date(2024, 3, 1), date(2024, 4, 1)),
+        (date(2024, 12, 1), date(2025, 2, 1))
+    ]
+
+
+def test_excel_en_flux(tmp_path, monkeypatch):
+    """Lots écrits au fil de l'eau, transcodés, avec passage à une nouvelle feuille à la limite d'Excel."""
+    import openpyxl
+    monkeypatch.setattr(moteur_export, "XLSX_MAX_LIGNES", 3)
+    lots = [
+        (["num", "date_ent", "mode"], [(1, date(2024, 5, 2), 1), (2, None, 9)]),
+        (["num", "date_ent", "mode"], [(3, date(2024, 5, 1), None)])
+    ]
+    fichier = tmp_path / "export.xlsx"
+    nb = moteur_export.ecrire_xlsx_flux(iter(lots), str(fichier), {"mode": {1: "RDV", "1": "RDV"}})
+    assert nb == 3
+
+    classeur = openpyxl.load_workbook(fichier)
+    assert classeur.sheetnames == ["Données", "Données (2)"]
+    premiere = list(classeur["Données"].values)
+    assert premiere[0] == ("num", "date_ent", "mode")
+    assert [l[2] for l in premiere[1:]] == ["RDV", "9"]
+    assert list(classeur["Données (2)"].values)[1][0] == 3
+
+
+def test_export_csv_copy(inject_data_export, tmp_path):
+    """Mode flux : COPY vers un fichier gzip, même contenu que l'export pandas ; colonne de date contrôlée."""
+    import gzip
+    import pandas as pd
+    fichier = tmp_path / "extraction.csv.gz"
+    nb = exportation_base.export_entretien(
+        LOCAL_DB_CONFIG, date(2024, 1, 1), date(2024, 12, 31), "DATE_ENT", str(fichier), flux=True
+    )
+    assert nb == 1
+    with gzip.open(fichier, "rt", encoding="utf-8") as f:
+        lu = pd.read_csv(f)
+    assert lu["num"].tolist() == [500]
+    assert lu["date_ent"].tolist() == ["2024-05-15"]
+
+    # Même fichier que le mode pandas (UTF-8), malgré le client_encoding WIN1252 de la connexion
+    flux_csv, pandas_csv = tmp_path / "flux.csv", tmp_path / "pandas.csv"
+    for chemin, flux in ((flux_csv, True), (pandas_csv, False)):
+        exportation_base.export_entretien(
+            LOCAL_DB_CONFIG, date(2024, 1, 1), date(2024, 12, 31), "date_ent", str(chemin), flux=flux
+        )
+    assert flux_csv.read_text(encoding="utf-8").splitlines() == pandas_csv.read_text(encoding="utf-8").splitlines()
+
+    with pytest.raises(ValueError):
+        exportation_base.export_entretien(
+            LOCAL_DB_CONFIG, date(2024, 1, 1), date(2024, 12, 31), "date_ent; DROP TABLE entretien", str(fichier), flux=True
+        )
+
+
+def test_parquet_arrow_en_flux(tmp_path):
+    """Types conservés, libellés en dictionnaire (un row group par lot), demandes en listes transcodées."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    colonnes = [("num", 23), ("date_ent", 1082), ("mode", 21), ("demandes", 1015)]
+    lots = [
+        (colonnes, [(1, date(2024, 5, 2), 1, ["100", "101"]), (2, None, 9, [])]),
+        (colonnes, [(3, date(2024, 5, 1), None, ["100"])])
+    ]
+    transco = {"mode": {1: "RDV", "1": "RDV"}}
+    transco_listes = {"demandes": {"100": "Logement"}}
+
+    fichier = tmp_path / "export.parquet"
+    with open(fichier, "wb") as sortie:
+        assert moteur_export.ecrire_colonnes_flux(iter(lots), sortie, transco, transco_listes) == 3
+    meta = pq.ParquetFile(fichier)
+    assert meta.metadata.num_row_groups == 2
+    table = meta.read()
+    assert table.schema.field("num").type == pa.int32()
+    assert pa.types.is_dictionary(table.schema.field("mode").type)
+    df = table.to_pandas()
+    assert df["mode"].astype(object).where(df["mode"].notna(), None).tolist() == ["RDV", "9", None]
+    assert [list(l) for l in df["demandes"]] == [["Logement", "101"], [], ["Logement"]]
+
+    fichier = tmp_path / "export.arrows"
+    with open(fichier, "wb") as sortie:
+        moteur_export.ecrire_colonnes_flux(iter(lots), sortie, transco, transco_listes, format="arrow")
+    with pa.ipc.open_stream(fichier) as lecteur:
+        assert lecteur.read_all().column("num").to_pylist() == [1, 2, 3]
+
+
+def test_classeur_plusieurs_feuilles(tmp_path):
+    """Une feuille par requête, remplies l'une après l'autre dans le même classeur."""
+    import openpyxl
+    fichier = tmp_path / "dossiers.xlsx"
+    nb = moteur_export.ecrire_classeur_flux([
+        ("Dossiers", iter([(["num", "demandes_codes"], [(1, "100 ; 101"), (2, None)])]), None),
+        ("Demandes", iter([(["num", "pos", "code", "libelle"], [(1, 1, "100", "100"), (1, 2, "101", "101")])]),
+         {"libelle": {"100": "Logement"}})
+    ], str(fichier))
+    assert nb == {"Dossiers": 2, "Demandes": 2}
+
+    classeur = openpyxl.load_workbook(fichier)
+    assert classeur.sheetnames == ["Dossiers", "Demandes"]
+    assert [l[3] for l in classeur["Demandes"].values] == ["libelle", "Logement", "101"]
+
+
+def test_export_dossiers_complets(inject_data_export):
+    """Demandes et solutions agrégées sur la ligne de l'entretien, en une requête."""
+    import openpyxl
+    from travaux_export import export_dossiers_mois
+    fichier, nb = export_dossiers_mois(["2024-05"], detail=True)
+    with fichier:
+        classeur = openpyxl.load_workbook(fichier)
+    assert nb == {"Dossiers": 1, "Demandes": 1, "Solutions": 1}
+    entete, ligne = list(classeur["Dossiers"].values)
+    dossier = dict(zip(entete, ligne))
+    assert dossier["num"] == 500
+    assert dossier["demandes_codes"] == "100"
+    assert dossier["solutions_codes"] == "200"
+    # Libellés lus dans MODALITE par la requête elle-même
+    assert dossier["demandes_libelles"] == "Logement"
+    assert dossier["solutions_libelles"] == "Information"
+    assert [l[2:] for l in classeur["Demandes"].values] == [("code", "libelle"), ("100", "Logement")]
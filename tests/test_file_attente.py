@@ -0,0 +1,81 @@
+# tests/test_file_attente.py
+# -*- coding: utf-8 -*-
+import sys
+import os
+import datetime
+import pytest
+import psycopg2
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import file_attente
+
+def test_file_saisie_reprise_et_reconciliation(tmp_path, monkeypatch):
+    """Dossier accepté localement, conservé si la base est indisponible, puis relié à son NUM."""
+    monkeypatch.setattr(file_attente, "CHEMIN_JOURNAL", str(tmp_path / "journal.sqlite3"))
+    monkeypatch.setattr(file_attente, "demarrer_ecrivain", lambda: None)
+
+    ref_1 = file_attente.mettre_en_file({"MODE": 1, "SEXE": None}, [100], [200])
+    ref_2 = file_attente.mettre_en_file({"MODE": 2}, [100, 101], [])
+    assert file_attente.nb_en_attente() == 2
+
+    def base_coupee(dossiers):
+        raise psycopg2.OperationalError("connexion refusée")
+    monkeypatch.setattr(file_attente, "save_entretiens_lot", base_coupee)
+    # L'erreur de connexion remonte (reprise par l'écrivain) et le lot reste en file
+    with pytest.raises(psycopg2.OperationalError):
+        file_attente.vider_file()
+    assert file_attente.nb_en_attente() == 2
+
+    recus = []
+    def base_ok(dossiers):
+        recus.extend(dossiers)
+        return {dossiers[0]["cle"]: 41, dossiers[1]["cle"]: psycopg2.DataError("valeur invalide")}
+    monkeypatch.setattr(file_attente, "save_entretiens_lot", base_ok)
+
+    assert file_attente.vider_file() == 2
+    assert recus[0]["data"] == {"MODE": 1, "SEXE": None}
+    assert recus[1]["demandes"] == [100, 101]
+    assert recus[0]["date_ent"] == datetime.date.today()
+
+    etats = file_attente.etat_dossiers([ref_1, ref_2])
+    assert etats[ref_1][:2] == ("enregistre", 41)
+    assert etats[ref_2][0] == "rejete"
+    assert file_attente.nb_en_attente() == 0
+
+    # Dossier écrit : contenu vidé, puis ligne purgée ; le dossier rejeté est conservé
+    conn = file_attente._journal()
+    assert conn.execute("SELECT contenu FROM dossier WHERE statut = 'enregistre'").fetchone() == ("",)
+    conn.close()
+    assert file_attente.purger_journal(conservation_heures=0) == 1
+    assert list(file_attente.etat_dossiers([ref_1, ref_2])) == [ref_2]
+
+
+class Arret(BaseException):
+    pass
+
+
+def test_ecrivain_reprend_la_preparation(tmp_path, monkeypatch):
+    """Base indisponible au démarrage : la création de ENTRETIEN_SOURCE est retentée avant d'écrire."""
+    monkeypatch.setattr(file_attente, "CHEMIN_JOURNAL", str(tmp_path / "journal.sqlite3"))
+    appels = []
+
+    def preparation():
+        appels.append("ensure")
+        if appels.count("ensure") == 1:
+            raise psycopg2.OperationalError("connexion refusée")
+    monkeypatch.setattr(file_attente, "ensure_entretien_source", preparation)
+    monkeypatch.setattr(file_attente, "vider_file", lambda: appels.append("vider"))
+
+    class Reveil:
+        def clear(self):
+            pass
+
+        def wait(self, delai):
+            if appels.count("vider") == 2:
+                raise Arret()
+    monkeypatch.setattr(file_attente, "_reveil", Reveil())
+
+    with pytest.raises(Arret):
+        file_attente._boucle_ecrivain()
+    # Échec, nouvel essai réussi, puis plus de préparation aux tours suivants
+    assert appels == ["ensure", "ensure", "vider", "vider"]
@@ -1,7 +1,11 @@
 # -*- coding: utf-8 -*-
 import sys
 import os
+from datetime import date
+import pytest
+import psycopg2
 from streamlit.testing.v1 import AppTest
+import database
 from database import get_db_connection
 
 # Ajout du chemin racine pour importer database.py correctement
@@ -75,4 +79,67 @@ def test_validation_champs_manquants():
     all_success_messages = [s.value for s in at.success]
     found_validation = any("succès" in msg for msg in all_success_messages)
     
-    assert not found_validation, "L'application a validé le dossier alors qu'il est incomplet !"
\ No newline at end of file
+    assert not found_validation, "L'application a validé le dossier alors qu'il est incomplet !"
+
+
+class CurseurCompteur(psycopg2.extensions.cursor):
+    """Compte les ordres envoyés au serveur"""
+    nb = 0
+
+    def execute(self, query, vars=None):
+        self.nb += 1
+        return super().execute(query, vars)
+
+
+def lignes_dossier(cur, num):
+    cur.execute("SELECT date_ent, mode FROM ENTRETIEN WHERE num = %s", (num,))
+    entretien = cur.fetchall()
+    cur.execute("SELECT pos, nature FROM DEMANDE WHERE num = %s ORDER BY pos", (num,))
+    demandes = cur.fetchall()
+    cur.execute("SELECT pos, nature FROM SOLUTION WHERE num = %s ORDER BY pos", (num,))
+    return entretien, demandes, cur.fetchall()
+
+
+def test_dossier_en_une_requete():
+    """ENTRETIEN, DEMANDE et SOLUTION écrits par un seul ordre, positions dans l'ordre de saisie."""
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor(cursor_factory=CurseurCompteur)
+        num = database._insert_dossier(cur, {"MODE": 1, "SEXE": None}, [101, 100], [200], date(2024, 5, 2), (0, None))
+        assert cur.nb == 1
+        assert lignes_dossier(cur, num) == ([(date(2024, 5, 2), 1)], [(1, 101), (2, 100)], [(1, 200)])
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+def test_dossier_sans_solution():
+    """Liste de solutions vide : pas de CTE SOLUTION, le dossier est enregistré."""
+    num = database.save_entretien_complet({"MODE": 2}, [100], [], date_ent=date(2024, 6, 1))
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            assert lignes_dossier(cur, num) == ([(date(2024, 6, 1), 2)], [(1, 100)], [])
+            cur.execute("DELETE FROM DEMANDE WHERE num = %s; DELETE FROM ENTRETIEN WHERE num = %s", (num, num))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def test_dossier_refuse_rien_n_est_ecrit():
+    """Une valeur refusée par la base annule tout l'ordre : ni entretien, ni demande, ni solution."""
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT (SELECT COUNT(*) FROM ENTRETIEN), (SELECT COUNT(*) FROM DEMANDE), (SELECT COUNT(*) FROM SOLUTION)")
+            avant = cur.fetchone()
+        conn.rollback()
+
+        with pytest.raises(psycopg2.DataError):
+            database.save_entretien_complet({"MODE": 1}, [100, "pas un code"], [200], date_ent=date(2024, 6, 2))
+
+        with conn.cursor() as cur:
+            cur.execute("SELECT (SELECT COUNT(*) FROM ENTRETIEN), (SELECT COUNT(*) FROM DEMANDE), (SELECT COUNT(*) FROM SOLUTION)")
+            assert cur.fetchone() == avant
+    finally:
+        conn.close()
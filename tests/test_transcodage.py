@@ -0,0 +1,53 @@
+# tests/test_transcodage.py
+# -*- coding: utf-8 -*-
+import sys
+import os
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from transcodage import normaliser_code, transcoder_serie, transcoder_dataframe
+
+# Même forme que get_translation_dictionary() : chaque code en int et en str
+MAPPING_MODE = {1: "RDV", "1": "RDV", 2: "Sans RDV", "2": "Sans RDV"}
+
+def test_normaliser_code():
+    assert normaliser_code(1) == "1"
+    assert normaliser_code(1.0) == "1"
+    assert normaliser_code(" 1 ") == "1"
+    assert normaliser_code("AB") == "AB"
+    assert normaliser_code(None) is None
+    assert normaliser_code(np.nan) is None
+    assert normaliser_code("  ") is None
+
+def test_transcodage_categoriel():
+    serie = pd.Series([1, 2, None, 1.0], dtype=object)
+    result = transcoder_serie(serie, MAPPING_MODE)
+
+    assert isinstance(result.dtype, pd.CategoricalDtype)
+    assert list(result.cat.categories) == ["RDV", "Sans RDV"]
+    assert result.iloc[0] == "RDV"
+    assert result.iloc[1] == "Sans RDV"
+    assert pd.isna(result.iloc[2])
+    assert result.iloc[3] == "RDV"
+
+def test_transcodage_libelle_manquant():
+    """Vides et codes inconnus reçoivent le libellé de remplacement (page Analyse)."""
+    serie = pd.Series([1, np.nan, 9])
+    result = transcoder_serie(serie, MAPPING_MODE, libelle_manquant="Non renseigné")
+    assert result.tolist() == ["RDV", "Non renseigné", "Non renseigné"]
+
+def test_transcodage_garder_inconnus():
+    """Un code absent du dictionnaire reste affiché tel quel (page Export)."""
+    serie = pd.Series(["2", "99", None])
+    result = transcoder_serie(serie, MAPPING_MODE, garder_inconnus=True)
+    assert result.iloc[0] == "Sans RDV"
+    assert result.iloc[1] == "99"
+    assert pd.isna(result.iloc[2])
+
+def test_transcodage_dataframe():
+    df = pd.DataFrame({"num": [1, 2], "mode": [2, 1], "commune": ["Vannes", "Auray"]})
+    transcoder_dataframe(df, {"mode": MAPPING_MODE, "absente": {}})
+    assert df["mode"].tolist() == ["Sans RDV", "RDV"]
+    assert df["num"].tolist() == [1, 2]
+    assert df["commune"].tolist() == ["Vannes", "Auray"]
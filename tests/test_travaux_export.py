@@ -0,0 +1,60 @@
+# tests/test_travaux_export.py
+# -*- coding: utf-8 -*-
+import sys
+import os
+import io
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import travaux_export
+
+def test_travaux_export_cache(tmp_path, monkeypatch):
+    """Export produit une fois en arrière-plan, resservi depuis le cache, refait si les données changent."""
+    monkeypatch.setattr(travaux_export, "DOSSIER_CACHE", str(tmp_path / "cache"))
+    monkeypatch.setattr(travaux_export, "_travaux", {})
+    libelles = {"mode": {1: "RDV", "1": "RDV"}}
+    monkeypatch.setattr(travaux_export, "get_translation_dictionary", lambda table="ENTRETIEN": libelles if table == "ENTRETIEN" else {})
+    monkeypatch.setattr(travaux_export, "get_colonnes_entretien", lambda: ["num", "date_ent", "mode"])
+    signature = {"valeur": (3, 5, 5, 0)}
+    monkeypatch.setattr(travaux_export, "get_signature_mois", lambda mois: signature["valeur"])
+
+    appels = []
+    def generer(format, mois, progression=None):
+        appels.append((format, mois))
+        progression(2)
+        progression(1)
+        return io.BytesIO(f"{format}:{','.join(mois)}".encode()), 3
+    monkeypatch.setattr(travaux_export, "generer_export", generer)
+
+    travail = travaux_export.demander_export(["2024-02", "2024-01", "2024-02"], "parquet")
+    assert travaux_export.attendre(travail, 5)
+    assert travail["statut"] == "termine"
+    assert travaux_export.progression(travail) == 1.0
+    assert travaux_export.lire_export(travail) == b"parquet:2024-01,2024-02"
+    assert travail["chemin"].endswith(".parquet")
+
+    # Même demande (autre ordre des mois) : servie par le cache, y compris après redémarrage
+    monkeypatch.setattr(travaux_export, "_travaux", {})
+    assert travaux_export.demander_export(["2024-01", "2024-02"], "parquet")["statut"] == "termine"
+    assert len(appels) == 1
+
+    # Nouvelles saisies sur ces mois : nouvelle clé, nouvel export
+    signature["valeur"] = (4, 5, 5, 0)
+    travail = travaux_export.demander_export(["2024-01", "2024-02"], "parquet")
+    assert travaux_export.attendre(travail, 5)
+    assert len(appels) == 2
+
+    # Libellé modifié dans l'administration : l'ancien fichier n'est plus servi
+    cle = travail["cle"]
+    libelles["mode"] = {1: "Rendez-vous", "1": "Rendez-vous"}
+    assert travaux_export.cle_export(["2024-01", "2024-02"], "parquet", signature["valeur"]) != cle
+    libelles["mode"] = {1: "RDV", "1": "RDV"}
+
+    # Cache plein : le fichier le moins récemment servi est supprimé, le plus récent gardé
+    fichiers = os.listdir(tmp_path / "cache")
+    assert len(fichiers) == 2
+    ancien = [os.path.join(tmp_path / "cache", f) for f in fichiers if f != os.path.basename(travail["chemin"])][0]
+    os.utime(ancien, (time.time() - 3600, time.time() - 3600))
+    assert travaux_export.nettoyer_cache(taille_max=1) == 1
+    assert not os.path.exists(ancien)
+    assert travaux_export.lire_export(travail) is not None
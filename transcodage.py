@@ -0,0 +1,78 @@
+# transcodage.py
+# -*- coding: utf-8 -*-
+"""
+Transcodage code -> libellé des colonnes codées, sous forme de pandas Categorical
+(chaque libellé n'est stocké qu'une fois, au lieu d'une chaîne Python par ligne).
+"""
+import numpy as np
+import pandas as pd
+
+
+def normaliser_code(code):
+    """Forme canonique d'un code : '1' pour 1, 1.0, '1' ou ' 1 ' ; None si vide"""
+    if code is None:
+        return None
+    try:
+        if pd.isna(code):
+            return None
+    except (TypeError, ValueError):
+        pass
+    try:
+        f = float(code)
+        if f.is_integer():
+            return str(int(f))
+    except (TypeError, ValueError, OverflowError):
+        pass
+    s = str(code).strip()
+    return s or None
+
+
+def transcoder_serie(serie, mapping, libelle_manquant=None, garder_inconnus=False):
+    """
+    Convertit une colonne de codes en Categorical de libellés.
+    - libelle_manquant : libellé des valeurs vides ou sans correspondance (sinon NaN)
+    - garder_inconnus : un code absent du dictionnaire reste affiché tel quel
+    """
+    code_vers_libelle = {}
+    for code, lib in mapping.items():
+        cle = normaliser_code(code)
+        if cle is not None:
+            code_vers_libelle.setdefault(cle, lib)
+
+    # Catégories dans l'ordre du dictionnaire (ordre des modalités)
+    categories = list(dict.fromkeys(code_vers_libelle.values()))
+    index_libelle = {lib: i for i, lib in enumerate(categories)}
+
+    codes, uniques = pd.factorize(serie, use_na_sentinel=True)
+
+    # Une case par valeur distincte + une dernière pour les vides (code -1)
+    correspondance = np.full(len(uniques) + 1, -1, dtype=np.int64)
+    for i, valeur in enumerate(uniques):
+        cle = normaliser_code(valeur)
+        lib = code_vers_libelle.get(cle)
+        if lib is None and garder_inconnus and cle is not None:
+            lib = cle
+            if lib not in index_libelle:
+                index_libelle[lib] = len(categories)
+                categories.append(lib)
+        if lib is not None:
+            correspondance[i] = index_libelle[lib]
+
+    if libelle_manquant is not None:
+        if libelle_manquant not in index_libelle:
+            index_libelle[libelle_manquant] = len(categories)
+            categories.append(libelle_manquant)
+        correspondance[correspondance == -1] = index_libelle[libelle_manquant]
+
+    # codes == -1 (valeur vide) tombe sur la dernière case du tableau
+    codes_libelles = correspondance[codes] if len(codes) else np.array([], dtype=np.int64)
+    categorical = pd.Categorical.from_codes(codes_libelles, categories=categories)
+    return pd.Series(categorical, index=serie.index, name=serie.name)
+
+
+def transcoder_dataframe(df, transco, libelle_manquant=None, garder_inconnus=False):
+    """Applique transcoder_serie à chaque colonne du DataFrame présente dans `transco`"""
+    for col, mapping in transco.items():
+        if col in df.columns:
+            df[col] = transcoder_serie(df[col], mapping, libelle_manquant, garder_inconnus)
+    return df
@@ -0,0 +1,279 @@
+# travaux_export.py
+# -*- coding: utf-8 -*-
+"""
+Exports en arrière-plan pour la page Export : chaque demande (mois, format) devient un
+travail exécuté par un pool de threads, dont la page affiche la progression. Le fichier
+produit est gardé dans un cache disque borné en taille et partagé par toutes les sessions :
+une demande identique (mêmes mois, format, libellés et données) est servie sans
+nouvelle requête. Les exports des mois choisis (requêtes + moteur_export) sont définis ici.
+"""
+import os
+import json
+import shutil
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from database import (
+    db_connection,
+    clause_plages_dates,
+    plages_mois,
+    requete_export_mois,
+    get_colonnes_entretien,
+    get_signature_mois,
+    get_translation_dictionary
+)
+from moteur_export import (
+    export_excel_flux, export_colonnes_flux, export_classeur_flux,
+    requete_dossiers_denormalises, requete_detail_dossiers, SQL_DOSSIERS
+)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+DOSSIER_CACHE = os.getenv("EXPORT_CACHE_DIR", os.path.join(BASE_DIR, "data", "cache_export"))
+# Au-delà, les fichiers les moins récemment servis sont supprimés
+TAILLE_CACHE_MAX = int(os.getenv("EXPORT_CACHE_MO", "500")) * 1024 * 1024
+# Les exports passent surtout leur temps à attendre la base : des threads suffisent
+NB_TRAVAILLEURS = int(os.getenv("EXPORT_WORKERS", "2"))
+
+# Format -> extension du fichier produit
+EXTENSIONS = {
+    "xlsx": "xlsx",
+    "dossiers": "xlsx",
+    "dossiers_detail": "xlsx",
+    "parquet": "parquet",
+    "arrow": "arrows"
+}
+
+_travaux = {}
+_verrou = threading.Lock()
+_executeur = None
+
+
+def empreinte_metadonnees():
+    """
+    Empreinte des libellés (trois tables) et des colonnes de ENTRETIEN. Contrairement au
+    compteur de version local, elle est identique d'un redémarrage à l'autre tant que
+    les métadonnées n'ont pas changé : le cache disque reste valable, et seulement lui.
+    """
+    libelles = {
+        table: {col: sorted({(str(code), str(lib)) for code, lib in mapping.items()})
+                for col, mapping in get_translation_dictionary(table).items()}
+        for table in ("ENTRETIEN", "DEMANDE", "SOLUTION")
+    }
+    contenu = json.dumps([libelles, get_colonnes_entretien()], sort_keys=True)
+    return hashlib.sha256(contenu.encode("utf-8")).hexdigest()
+
+
+def cle_export(mois, format, signature):
+    """Clé du cache : mois, format, métadonnées (libellés, colonnes) et état des données"""
+    contenu = json.dumps([sorted(set(mois)), format, empreinte_metadonnees(), list(signature)], default=str)
+    return hashlib.sha256(contenu.encode("utf-8")).hexdigest()[:32]
+
+
+def chemin_cache(cle, format):
+    return os.path.join(DOSSIER_CACHE, f"{cle}.{EXTENSIONS[format]}")
+
+
+def requete_export_dossiers(mois):
+    """Entretiens des mois choisis avec leurs demandes et solutions en colonnes liste"""
+    condition, params = clause_plages_dates("e.date_ent", plages_mois(mois))
+    return SQL_DOSSIERS.format(condition=condition, ordre="e.date_ent DESC"), params
+
+
+def export_colonnes_mois(mois, format="parquet", progression=None):
+    """
+    Export Parquet / Arrow des mois choisis, libellés transcodés (chaînes dictionnaire)
+    et demandes / solutions en listes. Renvoie (fichier temporaire, nombre de lignes).
+    """
+    query, params = requete_export_dossiers(mois)
+    transco_listes = {
+        "demandes": get_translation_dictionary('DEMANDE').get('nature', {}),
+        "solutions": get_translation_dictionary('SOLUTION').get('nature', {})
+    }
+    with db_connection() as conn:
+        try:
+            return export_colonnes_flux(
+                conn, query, params, get_translation_dictionary(), transco_listes, format, progression
+            )
+        finally:
+            conn.rollback()
+
+
+def export_dossiers_mois(mois, transco=None, detail=False, progression=None):
+    """
+    Dossiers complets des mois choisis en une requête : une ligne par entretien avec
+    les codes et libellés de ses demandes et solutions (au lieu d'une lecture par dossier).
+    detail=True : feuilles « Demandes » et « Solutions » en plus, une ligne par code.
+    Renvoie (fichier temporaire, {feuille: nombre de lignes}).
+    """
+    condition, params = clause_plages_dates("e.date_ent", plages_mois(mois))
+    # Libellés des natures joints dans la requête (MODALITE), pas en Python
+    feuilles = [("Dossiers", requete_dossiers_denormalises(condition, "e.date_ent DESC"), params, transco)]
+    if detail:
+        for nom, table in (("Demandes", "DEMANDE"), ("Solutions", "SOLUTION")):
+            feuilles.append((nom, requete_detail_dossiers(table, condition, "e.date_ent DESC"), params, None))
+    with db_connection() as conn:
+        try:
+            return export_classeur_flux(conn, feuilles, progression)
+        finally:
+            conn.rollback()
+
+
+def export_excel_mois(mois, transco=None, progression=None):
+    """
+    Classeur Excel des mois choisis, écrit en flux (curseur serveur -> xlsxwriter constant_memory).
+    Renvoie (fichier temporaire, nombre de lignes).
+    """
+    query, params = requete_export_mois(mois)
+    with db_connection() as conn:
+        try:
+            return export_excel_flux(conn, query, params, transco, progression)
+        finally:
+            # Ferme la transaction ouverte par le curseur nommé avant de rendre la connexion
+            conn.rollback()
+
+
+def generer_export(format, mois, progression=None):
+    """Produit l'export : (fichier temporaire, nombre d'entretiens)"""
+    if format == "xlsx":
+        return export_excel_mois(mois, get_translation_dictionary(), progression)
+    if format in ("dossiers", "dossiers_detail"):
+        fichier, nb = export_dossiers_mois(
+            mois, get_translation_dictionary(), detail=(format == "dossiers_detail"), progression=progression
+        )
+        return fichier, nb["Dossiers"]
+    return export_colonnes_mois(mois, format, progression)
+
+
+def _executeur_exports():
+    global _executeur
+    with _verrou:
+        if _executeur is None:
+            _executeur = ThreadPoolExecutor(max_workers=NB_TRAVAILLEURS, thread_name_prefix="export")
+        return _executeur
+
+
+def _executer(travail):
+    def avancer(nb_lignes):
+        travail["lignes"] += nb_lignes
+
+    travail["statut"] = "en_cours"
+    # Un fichier provisoire par processus : le cache n'expose que des fichiers complets
+    provisoire = f"{travail['chemin']}.{os.getpid()}.tmp"
+    try:
+        fichier, nb = generer_export(travail["format"], travail["mois"], avancer)
+        os.makedirs(DOSSIER_CACHE, exist_ok=True)
+        with fichier, open(provisoire, "wb") as sortie:
+            shutil.copyfileobj(fichier, sortie)
+        os.replace(provisoire, travail["chemin"])
+        travail.update(lignes=nb, statut="termine")
+        nettoyer_cache()
+    except Exception as e:
+        travail.update(statut="erreur", erreur=str(e).strip())
+        if os.path.exists(provisoire):
+            os.remove(provisoire)
+    finally:
+        travail["fini"].set()
+
+
+def demander_export(mois, format):
+    """
+    Travail de l'export (mois, format) : déjà dans le cache, partagé avec un travail
+    identique en cours, ou lancé en arrière-plan. Rend la main immédiatement.
+    """
+    mois = sorted(set(mois))
+    signature = get_signature_mois(mois)
+    cle = cle_export(mois, format, signature)
+    chemin = chemin_cache(cle, format)
+
+    with _verrou:
+        travail = _travaux.get(cle)
+        if travail is not None and travail["statut"] in ("attente", "en_cours"):
+            return travail
+        if os.path.exists(chemin):
+            # Marque le fichier comme récemment servi (ordre d'éviction)
+            os.utime(chemin)
+            if travail is None or travail["statut"] != "termine":
+                travail = _nouveau_travail(cle, mois, format, signature[0], chemin)
+                travail.update(statut="termine", lignes=signature[0])
+                travail["fini"].set()
+                _travaux[cle] = travail
+            return travail
+
+        travail = _nouveau_travail(cle, mois, format, signature[0], chemin)
+        _travaux[cle] = travail
+
+    _executeur_exports().submit(_executer, travail)
+    return travail
+
+
+def _nouveau_travail(cle, mois, format, total, chemin):
+    return {
+        "cle": cle,
+        "mois": mois,
+        "format": format,
+        "statut": "attente",
+        "lignes": 0,
+        "total": total,
+        "chemin": chemin,
+        "erreur": None,
+        "fini": threading.Event()
+    }
+
+
+def attendre(travail, delai):
+    """Attend au plus `delai` secondes la fin du travail ; True s'il est fini"""
+    return travail["fini"].wait(delai)
+
+
+def progression(travail):
+    """Avancement entre 0 et 1 (lignes lues / entretiens attendus)"""
+    if travail["statut"] == "termine":
+        return 1.0
+    if not travail["total"]:
+        return 0.0
+    return min(travail["lignes"] / travail["total"], 0.99)
+
+
+def lire_export(travail):
+    """Contenu du fichier produit (None s'il a été évincé du cache entre-temps)"""
+    try:
+        with open(travail["chemin"], "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        with _verrou:
+            _travaux.pop(travail["cle"], None)
+        return None
+
+
+def nettoyer_cache(taille_max=None):
+    """Supprime les exports les moins récemment servis au-delà de la taille maximale ; renvoie leur nombre"""
+    taille_max = TAILLE_CACHE_MAX if taille_max is None else taille_max
+    if not os.path.isdir(DOSSIER_CACHE):
+        return 0
+    fichiers = []
+    for nom in os.listdir(DOSSIER_CACHE):
+        if nom.endswith(".tmp"):
+            continue
+        chemin = os.path.join(DOSSIER_CACHE, nom)
+        infos = os.stat(chemin)
+        fichiers.append((infos.st_mtime, infos.st_size, chemin))
+    fichiers.sort()
+
+    total = sum(taille for _, taille, _ in fichiers)
+    supprimes = 0
+    # Le plus récent est toujours gardé, même s'il dépasse à lui seul la limite
+    while total > taille_max and len(fichiers) > 1:
+        _, taille, chemin = fichiers.pop(0)
+        try:
+            os.remove(chemin)
+        except FileNotFoundError:
+            pass
+        total -= taille
+        supprimes += 1
+        with _verrou:
+            for cle, travail in list(_travaux.items()):
+                if travail["chemin"] == chemin and travail["statut"] == "termine":
+                    del _travaux[cle]
+    return supprimes